@@ -0,0 +1,12 @@
+ALTER TABLE posts ADD COLUMN plus_count integer NOT NULL DEFAULT 0;
+ALTER TABLE posts ADD COLUMN minus_count integer NOT NULL DEFAULT 0;
+UPDATE posts SET plus_count = counters.plus_count, minus_count = counters.minus_count
+FROM (
+    SELECT
+        message_id,
+        count(*) FILTER (WHERE vote = '+') AS plus_count,
+        count(*) FILTER (WHERE vote = '-') AS minus_count
+    FROM votes GROUP BY message_id
+) AS counters
+WHERE posts.message_id = counters.message_id;
+INSERT INTO migrations (version) VALUES (8);
@@ -0,0 +1,2 @@
+CREATE INDEX posts_user_id_date ON posts (user_id, date);
+INSERT INTO migrations (version) VALUES (9);
@@ -0,0 +1,5 @@
+CREATE INDEX posts_popular_id ON posts (popular_id) WHERE popular_id IS NOT NULL;
+CREATE INDEX posts_best_id ON posts (best_id) WHERE best_id IS NOT NULL;
+CREATE INDEX posts_comment_thread_id ON posts (comment_thread_id);
+CREATE INDEX posts_media_group ON posts (media_group) WHERE media_group IS NOT NULL;
+INSERT INTO migrations (version) VALUES (10);
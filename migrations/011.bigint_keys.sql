@@ -0,0 +1,163 @@
+-- migrate: no-transaction
+-- Converts ids to bigint and votes to smallint without rewriting votes and posts under a lock.
+-- New columns are added next to the old ones and kept in sync by triggers, filled in batches
+-- and indexed concurrently, then swapped in by one short transaction touching only the catalog.
+-- Every step can be run again, the version is recorded by the swap.
+
+-- Adding a column without a default only changes the catalog, but its lock must not queue
+-- behind a long transaction with voting stuck behind it
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+ALTER TABLE votes
+    ADD COLUMN IF NOT EXISTS message_id_bigint bigint,
+    ADD COLUMN IF NOT EXISTS user_id_bigint bigint,
+    ADD COLUMN IF NOT EXISTS vote_smallint smallint;
+ALTER TABLE posts
+    ADD COLUMN IF NOT EXISTS message_id_bigint bigint,
+    ADD COLUMN IF NOT EXISTS user_id_bigint bigint,
+    ADD COLUMN IF NOT EXISTS comment_thread_id_bigint bigint,
+    ADD COLUMN IF NOT EXISTS popular_id_bigint bigint,
+    ADD COLUMN IF NOT EXISTS best_id_bigint bigint;
+COMMIT;
+
+CREATE OR REPLACE FUNCTION votes_sync_bigint_keys() RETURNS trigger AS
+$$
+BEGIN
+    NEW.message_id_bigint := NEW.message_id::bigint;
+    NEW.user_id_bigint := NEW.user_id::bigint;
+    NEW.vote_smallint := CASE NEW.vote WHEN '+' THEN 1 WHEN '-' THEN -1 END;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION posts_sync_bigint_keys() RETURNS trigger AS
+$$
+BEGIN
+    NEW.message_id_bigint := NEW.message_id::bigint;
+    NEW.user_id_bigint := NEW.user_id::bigint;
+    NEW.comment_thread_id_bigint := NEW.comment_thread_id::bigint;
+    NEW.popular_id_bigint := NEW.popular_id::bigint;
+    NEW.best_id_bigint := NEW.best_id::bigint;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+CREATE OR REPLACE TRIGGER votes_sync_bigint_keys BEFORE INSERT OR UPDATE ON votes
+    FOR EACH ROW EXECUTE FUNCTION votes_sync_bigint_keys();
+CREATE OR REPLACE TRIGGER posts_sync_bigint_keys BEFORE INSERT OR UPDATE ON posts
+    FOR EACH ROW EXECUTE FUNCTION posts_sync_bigint_keys();
+COMMIT;
+
+-- Rows written from now on are converted by the triggers, older ones are filled 1000 pages
+-- (around 100k votes) per transaction. Rows are found by their physical position, so every
+-- batch reads only its own pages; an updated row moved past the last page is filled already.
+DO
+$$
+DECLARE
+    relation regclass;
+    pages bigint;
+    first_page bigint;
+BEGIN
+ FOREACH relation IN ARRAY ARRAY['votes'::regclass, 'posts'::regclass] LOOP
+    pages := pg_relation_size(relation) / current_setting('block_size')::bigint;
+    first_page := 0;
+    WHILE first_page <= pages LOOP
+        -- The triggers fill the new columns
+        EXECUTE format(
+            'UPDATE %s SET message_id = message_id WHERE ctid >= %L::tid AND ctid < %L::tid AND message_id_bigint IS NULL',
+            relation, format('(%s,0)', first_page), format('(%s,0)', first_page + 1000)
+        );
+        COMMIT;
+        first_page := first_page + 1000;
+    END LOOP;
+ END LOOP;
+END
+$$;
+
+-- Valid NOT NULL checks let the swap set NOT NULL without scanning the tables under its lock.
+-- Validation scans them, but with a lock that lets votes and posts be written meanwhile.
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+ALTER TABLE votes
+    DROP CONSTRAINT IF EXISTS votes_bigint_keys_not_null,
+    ADD CONSTRAINT votes_bigint_keys_not_null
+        CHECK (message_id_bigint IS NOT NULL AND user_id_bigint IS NOT NULL AND vote_smallint IS NOT NULL) NOT VALID;
+ALTER TABLE posts
+    DROP CONSTRAINT IF EXISTS posts_bigint_keys_not_null,
+    ADD CONSTRAINT posts_bigint_keys_not_null
+        CHECK (message_id_bigint IS NOT NULL AND user_id_bigint IS NOT NULL) NOT VALID;
+COMMIT;
+ALTER TABLE votes VALIDATE CONSTRAINT votes_bigint_keys_not_null;
+ALTER TABLE posts VALIDATE CONSTRAINT posts_bigint_keys_not_null;
+
+-- Indexes of the new columns, built without blocking writes. A build that failed leaves an
+-- invalid index behind, so they are dropped first when the migration is run again.
+DROP INDEX CONCURRENTLY IF EXISTS votes_bigint_pkey;
+CREATE UNIQUE INDEX CONCURRENTLY votes_bigint_pkey ON votes (message_id_bigint, user_id_bigint);
+DROP INDEX CONCURRENTLY IF EXISTS votes_bigint_message_vote;
+CREATE INDEX CONCURRENTLY votes_bigint_message_vote ON votes (message_id_bigint, vote_smallint);
+DROP INDEX CONCURRENTLY IF EXISTS posts_bigint_pkey;
+CREATE UNIQUE INDEX CONCURRENTLY posts_bigint_pkey ON posts (message_id_bigint);
+DROP INDEX CONCURRENTLY IF EXISTS posts_bigint_user_id_date;
+CREATE INDEX CONCURRENTLY posts_bigint_user_id_date ON posts (user_id_bigint, date);
+DROP INDEX CONCURRENTLY IF EXISTS posts_bigint_comment_thread_id;
+CREATE INDEX CONCURRENTLY posts_bigint_comment_thread_id ON posts (comment_thread_id_bigint);
+DROP INDEX CONCURRENTLY IF EXISTS posts_bigint_popular_id;
+CREATE INDEX CONCURRENTLY posts_bigint_popular_id ON posts (popular_id_bigint) WHERE popular_id_bigint IS NOT NULL;
+DROP INDEX CONCURRENTLY IF EXISTS posts_bigint_best_id;
+CREATE INDEX CONCURRENTLY posts_bigint_best_id ON posts (best_id_bigint) WHERE best_id_bigint IS NOT NULL;
+
+-- The swap: dropping and renaming columns and turning indexes into keys only changes the
+-- catalog, so writes wait for milliseconds. Old column data is reclaimed by later rewrites.
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+LOCK TABLE posts, votes IN ACCESS EXCLUSIVE MODE;
+
+-- Not used since the daily post count is an indexed range query, and depends on posts.user_id
+DROP VIEW IF EXISTS posts_count_for_last_day;
+
+DROP TRIGGER votes_sync_bigint_keys ON votes;
+DROP TRIGGER posts_sync_bigint_keys ON posts;
+DROP FUNCTION votes_sync_bigint_keys();
+DROP FUNCTION posts_sync_bigint_keys();
+
+-- Old indexes and keys go with their columns
+ALTER TABLE votes DROP COLUMN message_id, DROP COLUMN user_id, DROP COLUMN vote;
+ALTER TABLE votes RENAME COLUMN message_id_bigint TO message_id;
+ALTER TABLE votes RENAME COLUMN user_id_bigint TO user_id;
+ALTER TABLE votes RENAME COLUMN vote_smallint TO vote;
+ALTER TABLE votes
+    ALTER COLUMN message_id SET NOT NULL,
+    ALTER COLUMN user_id SET NOT NULL,
+    ALTER COLUMN vote SET NOT NULL,
+    DROP CONSTRAINT votes_bigint_keys_not_null;
+ALTER INDEX votes_bigint_pkey RENAME TO votes_pkey;
+ALTER TABLE votes ADD CONSTRAINT votes_pkey PRIMARY KEY USING INDEX votes_pkey;
+ALTER INDEX votes_bigint_message_vote RENAME TO votes_message_vote;
+
+ALTER TABLE posts
+    DROP COLUMN message_id,
+    DROP COLUMN user_id,
+    DROP COLUMN comment_thread_id,
+    DROP COLUMN popular_id,
+    DROP COLUMN best_id;
+ALTER TABLE posts RENAME COLUMN message_id_bigint TO message_id;
+ALTER TABLE posts RENAME COLUMN user_id_bigint TO user_id;
+ALTER TABLE posts RENAME COLUMN comment_thread_id_bigint TO comment_thread_id;
+ALTER TABLE posts RENAME COLUMN popular_id_bigint TO popular_id;
+ALTER TABLE posts RENAME COLUMN best_id_bigint TO best_id;
+ALTER TABLE posts
+    ALTER COLUMN message_id SET NOT NULL,
+    ALTER COLUMN user_id SET NOT NULL,
+    DROP CONSTRAINT posts_bigint_keys_not_null;
+ALTER INDEX posts_bigint_pkey RENAME TO posts_pkey;
+ALTER TABLE posts ADD CONSTRAINT posts_pkey PRIMARY KEY USING INDEX posts_pkey;
+ALTER INDEX posts_bigint_user_id_date RENAME TO posts_user_id_date;
+ALTER INDEX posts_bigint_comment_thread_id RENAME TO posts_comment_thread_id;
+ALTER INDEX posts_bigint_popular_id RENAME TO posts_popular_id;
+ALTER INDEX posts_bigint_best_id RENAME TO posts_best_id;
+
+INSERT INTO migrations (version) VALUES (11);
+COMMIT;
@@ -0,0 +1,154 @@
+-- migrate: no-transaction
+-- Moves votes to a table partitioned by date of the voted post without stopping voting.
+-- The new table is filled in batches while a trigger mirrors writes to the old one, then the
+-- tables are swapped by one short transaction. Votes of posts that don't exist are moved to
+-- votes_orphaned rather than dropped. Every step can be run again, the version is recorded
+-- by the swap.
+
+-- Votes of archived posts were dropped with their partition, only counters are left.
+-- A constant default only changes the catalog.
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS votes_archived boolean NOT NULL DEFAULT false;
+COMMIT;
+
+-- Partitioned by date of the voted post, so votes of recent posts and their indexes stay small.
+-- post_date is part of every key, queries pass it to read only one partition.
+CREATE TABLE IF NOT EXISTS votes_partitioned (
+    message_id bigint NOT NULL,
+    user_id bigint NOT NULL,
+    vote smallint NOT NULL,
+    post_date timestamp NOT NULL,
+    created_at timestamp NOT NULL DEFAULT now(),
+    CONSTRAINT votes_partitioned_pkey PRIMARY KEY (message_id, user_id, post_date)
+) PARTITION BY RANGE (post_date);
+
+CREATE INDEX IF NOT EXISTS votes_partitioned_message_vote ON votes_partitioned (message_id, vote);
+
+-- Catches votes of posts no monthly partition was created for yet, stays empty normally
+CREATE TABLE IF NOT EXISTS votes_default PARTITION OF votes_partitioned DEFAULT;
+
+-- One partition per month, from the oldest post to two months ahead
+DO
+$$
+DECLARE
+    month timestamp;
+BEGIN
+ FOR month IN
+    SELECT generate_series(
+        date_trunc('month', coalesce(min(date), localtimestamp)),
+        date_trunc('month', localtimestamp) + interval '2 months',
+        interval '1 month'
+    ) FROM posts
+ LOOP
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF votes_partitioned FOR VALUES FROM (%L) TO (%L)',
+        'votes_' || to_char(month, 'YYYYMM'), month, month + interval '1 month'
+    );
+ END LOOP;
+END
+$$;
+
+-- Votes whose post row is missing, they have no post date to be partitioned by
+CREATE TABLE IF NOT EXISTS votes_orphaned (
+    message_id bigint NOT NULL,
+    user_id bigint NOT NULL,
+    vote smallint NOT NULL,
+    PRIMARY KEY (message_id, user_id)
+);
+
+-- Mirrors every write to votes from now on, the batches below copy the older votes
+CREATE OR REPLACE FUNCTION votes_sync_partitioned() RETURNS trigger AS
+$$
+DECLARE
+    voted_post_date timestamp;
+BEGIN
+ IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    DELETE FROM votes_partitioned WHERE message_id = OLD.message_id AND user_id = OLD.user_id;
+    DELETE FROM votes_orphaned WHERE message_id = OLD.message_id AND user_id = OLD.user_id;
+ END IF;
+ IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    SELECT date INTO voted_post_date FROM posts WHERE message_id = NEW.message_id;
+    IF FOUND THEN
+        INSERT INTO votes_partitioned (message_id, user_id, vote, post_date)
+        VALUES (NEW.message_id, NEW.user_id, NEW.vote, voted_post_date)
+        ON CONFLICT (message_id, user_id, post_date) DO UPDATE SET vote = excluded.vote;
+    ELSE
+        INSERT INTO votes_orphaned (message_id, user_id, vote) VALUES (NEW.message_id, NEW.user_id, NEW.vote)
+        ON CONFLICT (message_id, user_id) DO UPDATE SET vote = excluded.vote;
+    END IF;
+ END IF;
+ RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+CREATE OR REPLACE TRIGGER votes_sync_partitioned AFTER INSERT OR UPDATE OR DELETE ON votes
+    FOR EACH ROW EXECUTE FUNCTION votes_sync_partitioned();
+COMMIT;
+
+-- Copies 10000 votes per transaction in key order. Copied votes are locked until the batch
+-- commits, so a vote deleted meanwhile is deleted from the new table after it was copied
+-- there, never before. Time of old votes is unknown, the post date is the closest one.
+DO
+$$
+DECLARE
+    last_message_id bigint := -1;
+    last_user_id bigint := -1;
+BEGIN
+ LOOP
+    WITH batch AS (
+        SELECT message_id, user_id, vote FROM votes
+        WHERE (message_id, user_id) > (last_message_id, last_user_id)
+        ORDER BY message_id, user_id
+        LIMIT 10000
+        FOR SHARE
+    ), copied AS (
+        INSERT INTO votes_partitioned (message_id, user_id, vote, post_date, created_at)
+        SELECT batch.message_id, batch.user_id, batch.vote, posts.date, posts.date
+        FROM batch JOIN posts ON posts.message_id = batch.message_id
+        ON CONFLICT (message_id, user_id, post_date) DO NOTHING
+    ), orphaned AS (
+        INSERT INTO votes_orphaned (message_id, user_id, vote)
+        SELECT message_id, user_id, vote FROM batch
+        WHERE NOT EXISTS (SELECT FROM posts WHERE posts.message_id = batch.message_id)
+        ON CONFLICT (message_id, user_id) DO NOTHING
+    )
+    SELECT message_id, user_id INTO last_message_id, last_user_id
+    FROM batch ORDER BY message_id DESC, user_id DESC LIMIT 1;
+
+    EXIT WHEN NOT FOUND;
+    COMMIT;
+ END LOOP;
+END
+$$;
+
+ANALYZE votes_partitioned;
+
+-- The swap only renames tables and drops the old one, so votes wait for milliseconds
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+LOCK TABLE votes IN ACCESS EXCLUSIVE MODE;
+
+DROP TRIGGER votes_sync_partitioned ON votes;
+DROP FUNCTION votes_sync_partitioned();
+DROP TABLE votes;
+
+ALTER TABLE votes_partitioned RENAME TO votes;
+ALTER INDEX votes_partitioned_pkey RENAME TO votes_pkey;
+ALTER INDEX votes_partitioned_message_vote RENAME TO votes_message_vote;
+
+DO
+$$
+DECLARE
+    orphaned bigint := (SELECT count(*) FROM votes_orphaned);
+BEGIN
+ IF orphaned > 0 THEN
+    RAISE WARNING '% votes of posts that don''t exist were moved to votes_orphaned', orphaned;
+ END IF;
+END
+$$;
+
+INSERT INTO migrations (version) VALUES (12);
+COMMIT;
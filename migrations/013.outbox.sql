@@ -0,0 +1,28 @@
+-- Bot API calls the bot still has to make, written together with the state change they
+-- belong to and run by outbox workers
+CREATE TABLE outbox (
+    id bigserial PRIMARY KEY,
+    kind text NOT NULL,
+    -- The same intent enqueued twice, e.g. from a redelivered update, is stored once
+    idempotency_key text NOT NULL UNIQUE,
+    payload jsonb NOT NULL,
+    -- Results of steps already done, a retried job continues after them
+    state jsonb NOT NULL DEFAULT '{}',
+    -- Author of a post being published, counts towards their daily limit
+    author_id bigint,
+    attempts integer NOT NULL DEFAULT 0,
+    run_at timestamp NOT NULL DEFAULT now(),
+    -- Worker running the job and until when, another one takes it over afterwards
+    lease_token text,
+    locked_until timestamp,
+    last_error text,
+    created_at timestamp NOT NULL DEFAULT now(),
+    finished_at timestamp,
+    failed boolean NOT NULL DEFAULT false
+);
+
+CREATE INDEX outbox_due ON outbox (run_at) WHERE finished_at IS NULL;
+CREATE INDEX outbox_pending_posts ON outbox (author_id) WHERE finished_at IS NULL AND author_id IS NOT NULL;
+CREATE INDEX outbox_finished ON outbox (finished_at) WHERE finished_at IS NOT NULL;
+
+INSERT INTO migrations (version) VALUES (13);
@@ -0,0 +1,7 @@
+-- migrate: no-transaction
+-- Posts of the last hours are loaded on start. posts_user_id_date can't serve a range of
+-- dates alone since user_id leads it. Built without blocking new posts; a build that failed
+-- leaves an invalid index behind, so it is dropped first when the migration is run again.
+DROP INDEX CONCURRENTLY IF EXISTS posts_date;
+CREATE INDEX CONCURRENTLY posts_date ON posts (date);
+INSERT INTO migrations (version) VALUES (14);
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from telegram import InputMediaPhoto, InputMediaVideo, Message
+from telegram.ext import CallbackContext
+
+
+class AlbumAssembler:
+    """Collects items of media groups before publishing them
+
+    Telegram sends every photo or video of an album as a separate update. Items are buffered
+    by media_group_id until no new item arrived for ``window`` seconds, then ``publish`` is
+    called once with all of them sorted in album order. Waiting is capped at ``max_wait``
+    seconds since the first item.
+    """
+
+    def __init__(
+            self,
+            window: float,
+            max_wait: float,
+            publish: Callable[[list[Message], CallbackContext], Awaitable[None]],
+    ):
+        self.window = window
+        self.max_wait = max_wait
+        self.publish = publish
+        self._albums: dict[str, list[Message]] = {}
+        self._deadlines: dict[str, float] = {}
+
+    def add(self, message: Message, context: CallbackContext):
+        media_group = message.media_group_id
+        now = asyncio.get_running_loop().time()
+        if media_group in self._albums:
+            self._albums[media_group].append(message)
+            self._deadlines[media_group] = now + self.window
+            return
+
+        self._albums[media_group] = [message]
+        self._deadlines[media_group] = now + self.window
+        context.application.create_task(self._publish_later(media_group, now + self.max_wait, context))
+
+    async def _publish_later(self, media_group: str, latest: float, context: CallbackContext):
+        loop = asyncio.get_running_loop()
+        while (delay := min(self._deadlines[media_group], latest) - loop.time()) > 0:
+            await asyncio.sleep(delay)
+
+        messages = sorted(self._albums.pop(media_group), key=lambda message: message.message_id)
+        del self._deadlines[media_group]
+        await self.publish(messages, context)
+
+
+def media_item(message: Message) -> dict[str, str]:
+    """Photo or video of a message as JSON, for outbox jobs"""
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id}
+    return {"type": "video", "file_id": message.video.file_id}
+
+
+def to_input_media(item: dict[str, str]) -> InputMediaPhoto | InputMediaVideo:
+    if item["type"] == "photo":
+        return InputMediaPhoto(item["file_id"])
+    return InputMediaVideo(item["file_id"])
@@ -1,10 +1,17 @@
+import time
+
+# Start of the import phase of the startup report
+_started = time.perf_counter()
+
+import asyncio
+import contextlib
 import logging
-import os
-import threading
+from urllib.parse import urlparse
 
-import flask
-from telegram import Update
+from telegram import Bot, Message, Update
+from telegram.constants import ChatType
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
@@ -14,79 +21,222 @@ from telegram.ext import (
 )
 
 import db
+import logs
+import metrics
+import partitions
 from config import (
     CHAT_ID_NEW, 
     CHAT_ID_POPULAR, 
     CHAT_ID_BEST,
-    BEST_CHANNEL_TOPIC_MESSAGE_ID,
     COMMENTS_GROUP_ID, 
     TOKEN,
     MAX_USER_POST_COUNT_PER_DAY,
-    POPULAR_POSITIVE_VOTES_PERCENTAGE,
-    POPULAR_POSITIVE_VOTES_MIN_COUNT,
-    BEST_POSITIVE_VOTES_PERCENTAGE,
-    BEST_POSITIVE_VOTES_MIN_COUNT,
-    BEST_COMMENT_MIN_COUNT,
     WELCOME_TEXT,
+    KEYBOARD_UPDATE_INTERVAL,
+    TELEGRAM_OVERALL_RATE_LIMIT,
+    TELEGRAM_GROUP_RATE_LIMIT,
+    TELEGRAM_PRIVATE_RATE_LIMIT,
+    TELEGRAM_MAX_RETRIES,
+    DB_MIGRATE_ON_STARTUP,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET_TOKEN,
+    HTTP_HOST,
+    HTTP_PORT,
+    COMMENT_FLUSH_INTERVAL,
+    COMMENT_FLUSH_MAX_PENDING,
+    ALBUM_WINDOW,
+    ALBUM_MAX_WAIT,
+    PROMOTION_INTERVAL,
+    PROMOTION_BATCH_SIZE,
+    PROMOTION_SWEEP_HOURS,
+    METRICS_ENABLED,
+    UPDATE_CONCURRENCY,
+    OUTBOX_WORKERS,
+    OUTBOX_LEASE,
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETENTION,
+    VOTE_POST_RATE,
+    VOTE_POST_BURST,
+    VOTE_USER_RATE,
+    VOTE_USER_BURST,
+    LOG_FILE,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_ROTATE_WHEN,
+    LOG_MAX_BYTES,
+    LOG_BACKUP_COUNT,
+    LOG_COMMENT_SAMPLE_RATE,
+    WARMUP_HOURS,
 )
+from albums import AlbumAssembler, media_item, to_input_media
+from comment_counter import CommentCounter
 from helpers import plural_ru
-from models import ButtonValues, PostKeyboard
+from keyboard_updater import KeyboardUpdater
+from migrate import migrate
+from models import ButtonValues, OutboxJob, Post, PostKeyboard
+from outbox import Outbox
+from promotion import PromotionEngine
+from rate_limiter import Priority, PriorityRateLimiter
+from update_processor import KeyedUpdateProcessor
+from vote_gate import VoteGate, votes_to_apply
+
+logs.setup(
+    LOG_FILE,
+    level=LOG_LEVEL,
+    json_format=LOG_FORMAT == "json",
+    max_bytes=LOG_MAX_BYTES,
+    rotate_when=LOG_ROTATE_WHEN,
+    backup_count=LOG_BACKUP_COUNT,
+    sample_rates={f"{__name__}.comments": LOG_COMMENT_SAMPLE_RATE},
+)
+logger = logging.getLogger(__name__)
+# Logs every comment, sampled with LOG_COMMENT_SAMPLE_RATE
+comments_logger = logging.getLogger(f"{__name__}.comments")
+
+# Seconds spent in startup phases, see on_startup
+startup_times = {"import": time.perf_counter() - _started}
+
+keyboard_updater = KeyboardUpdater(interval=KEYBOARD_UPDATE_INTERVAL)
+loop_lag_monitor = metrics.LoopLagMonitor()
+outbox = Outbox(
+    workers=OUTBOX_WORKERS,
+    lease=OUTBOX_LEASE,
+    poll_interval=OUTBOX_POLL_INTERVAL,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    retention=OUTBOX_RETENTION,
+)
+promotion_engine = PromotionEngine(
+    interval=PROMOTION_INTERVAL,
+    batch_size=PROMOTION_BATCH_SIZE,
+    sweep_hours=PROMOTION_SWEEP_HOURS,
+    outbox=outbox,
+    keyboard_updater=keyboard_updater,
+)
+album_assembler = AlbumAssembler(
+    window=ALBUM_WINDOW,
+    max_wait=ALBUM_MAX_WAIT,
+    publish=lambda messages, context: publish_album(messages, context),
+)
+comment_counter = CommentCounter(
+    interval=COMMENT_FLUSH_INTERVAL,
+    max_pending=COMMENT_FLUSH_MAX_PENDING,
+    on_flush=lambda posts: refresh_comment_count(posts),
+)
+rate_limiter = PriorityRateLimiter(
+    overall_max_rate=TELEGRAM_OVERALL_RATE_LIMIT,
+    group_max_rate=TELEGRAM_GROUP_RATE_LIMIT,
+    private_max_rate=TELEGRAM_PRIVATE_RATE_LIMIT,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
+vote_gate = VoteGate(
+    post_rate=VOTE_POST_RATE,
+    post_burst=VOTE_POST_BURST,
+    user_rate=VOTE_USER_RATE,
+    user_burst=VOTE_USER_BURST,
+)
+update_processor = KeyedUpdateProcessor(
+    max_concurrent_updates=UPDATE_CONCURRENCY,
+    key=lambda update: update_key(update),
+    admit=vote_gate.admit,
+)
 
-# Set up flask app
-flask_app = flask.Flask(__name__)
 
-# Set up logging to a file and console
-LOG_FILE = os.getenv('LOG_FILE', default='bot.log')
-logging.basicConfig(
-    filename=LOG_FILE,
-    format="%(asctime)s %(levelname)s | [%(name)s] %(message)s",
-    level=logging.INFO
-)
-logging.getLogger("httpx").setLevel(logging.ERROR)
+ALLOWED_UPDATES = [
+    Update.MESSAGE,
+    Update.CALLBACK_QUERY,
+]
 
-# Create a new console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s %(levelname)s | [%(name)s] %(message)s")
-console_handler.setFormatter(formatter)
 
-# Add the console handler to the root logger
-logging.getLogger().addHandler(console_handler)
+async def update_key(update: object) -> tuple | None:
+    """Updates with equal keys are processed one by one, see KeyedUpdateProcessor
 
-logger = logging.getLogger(__name__)
+    Votes are keyed by the voted post, whichever of its copies in the new, popular and best
+    channels was clicked, so two clicks never check and change one vote at the same time.
+    Posts are keyed by the author, so daily limit checks see earlier posts and album items
+    arrive in order, assembled albums are published under the same key. Comments are only
+    counted and need no key.
+    """
+    if not isinstance(update, Update):
+        return None
+    if update.callback_query is not None and update.callback_query.message is not None:
+        message = update.callback_query.message
+        try:
+            post = await get_clicked_post(message)
+        except Exception as e:
+            logger.warning("Failed to look up voted post %s: %s", message.message_id, e)
+            post = None
+        if post is None:
+            return "message", message.chat_id, message.message_id
+        return "post", post["message_id"]
+    if update.message is not None and update.message.chat.type == ChatType.PRIVATE and update.message.from_user:
+        return author_key(update.message.from_user.id)
+    return None
+
+
+def author_key(user_id: int) -> tuple:
+    return "user", user_id
+
+
+async def get_clicked_post(message: Message) -> Post | None:
+    """Post whose message in the new, popular or best channel was clicked"""
+    chat_id, chat_username = str(message.chat_id), f"@{message.chat.username}"
 
+    if CHAT_ID_BEST in [chat_id, chat_username]:
+        return await db.get_post_by_best_id(message.message_id)
+    if CHAT_ID_POPULAR in [chat_id, chat_username]:
+        return await db.get_post_by_popular_id(message.message_id)
+    return await db.get_post(message.message_id)
+
+
+def stats() -> dict:
+    """Runtime counters, e.g. database pool saturation and Bot API queue."""
+    return {
+        "db_pool": db.backend.stats(),
+        "db_replicas": db.replicas.stats(),
+        "post_cache": db.post_cache.stats(),
+        "vote_store": db.vote_store.stats(),
+        "telegram": rate_limiter.stats(),
+        "keyboard_edits": keyboard_updater.stats(),
+        "updates": update_processor.stats(),
+        "votes": vote_gate.stats(),
+        "outbox": outbox.stats(),
+        "startup": startup_times,
+    }
 
-@flask_app.route('/healthz', methods=['GET'])
-def healthcheck() -> tuple[str, int]:
-    """Health check route for the Flask web application."""
-    return 'Health check successful', 200
 
 async def start(update: Update, _):
     """Handler for the /start command."""
     await update.message.reply_text(WELCOME_TEXT)
 
 
+@metrics.handler
 async def vote_handler(update: Update, context: CallbackContext):
     query = update.callback_query
     updated = False
+    # Clicks that arrived while this one waited were merged into it, see VoteGate. Taken before
+    # anything can fail, a click left waiting would swallow the next ones of the user.
+    clicks = vote_gate.take(query)
 
     if not query.data:
         return
 
-    chat_id, chat_username = str(query.message.chat_id), f"@{query.message.chat.username}"
-
-    if CHAT_ID_BEST in [chat_id, chat_username]:
-        post = await db.get_post_by_best_id(query.message.message_id)
-    elif CHAT_ID_POPULAR in [chat_id, chat_username]:
-        post = await db.get_post_by_popular_id(query.message.message_id)
-    else:
-        post = await db.get_post(query.message.message_id)
+    post = await get_clicked_post(query.message)
+    if post is None:
+        # E.g. clicked before the job publishing it saved it
+        await query.answer()
+        return
 
     match query.data:
-        case ButtonValues.POSITIVE_VOTE:
-            updated = await db.set_user_vote(post["message_id"], query.from_user.id, ButtonValues.POSITIVE_VOTE)
-        case ButtonValues.NEGATIVE_VOTE:
-            updated = await db.set_user_vote(post["message_id"], query.from_user.id, ButtonValues.NEGATIVE_VOTE)
+        case ButtonValues.POSITIVE_VOTE | ButtonValues.NEGATIVE_VOTE:
+            if len(clicks) > 1:
+                user_vote = await db.get_user_vote(post["message_id"], query.from_user.id)
+                clicks = votes_to_apply(user_vote, clicks)
+            for click in clicks:
+                changed, *rating = await db.set_user_vote(post["message_id"], query.from_user.id, click)
+                updated = updated or changed
+            rating = tuple(rating) if clicks else None
         case ButtonValues.RATING:
             rating = await db.get_rating(post["message_id"])
             user_vote = await db.get_user_vote(post["message_id"], query.from_user.id)
@@ -99,164 +249,102 @@ async def vote_handler(update: Update, context: CallbackContext):
             return
 
     logger.debug(
-        f"Received vote \"{query.data}\" from user {query.from_user.username} on post {post['message_id']}"
+        "Received vote \"%s\" from user %s on post %s", query.data, query.from_user.username, post["message_id"]
     )
     await query.answer()
     if not updated:
         return
 
-    rating = await db.get_rating(post["message_id"])
     keyboard = PostKeyboard(
         rating=rating[0] - rating[1],
         thread_id=post["comment_thread_id"],
         comment_count=post["comment_count"],
     )
-    await context.bot.edit_message_reply_markup(
-        chat_id=CHAT_ID_NEW,
-        message_id=int(post["message_id"]),
-        reply_markup=keyboard.to_reply_markup()
-    )
-
+    keyboard_updater.schedule(CHAT_ID_NEW, post["message_id"], keyboard)
     if post.get("popular_id") is not None:
-        await context.bot.edit_message_reply_markup(
-            chat_id=CHAT_ID_POPULAR,
-            message_id=int(post["popular_id"]),
-            reply_markup=keyboard.to_reply_markup()
-        )
-
+        keyboard_updater.schedule(CHAT_ID_POPULAR, post["popular_id"], keyboard)
     if post.get("best_id") is not None:
-        await context.bot.edit_message_reply_markup(
-            chat_id=CHAT_ID_BEST,
-            message_id=int(post["best_id"]),
-            reply_markup=keyboard.to_reply_markup()
-        )
+        keyboard_updater.schedule(CHAT_ID_BEST, post["best_id"], keyboard)
 
-    if post.get("popular_id") is None and is_popular(rating):
-        msg = await query.message.copy(CHAT_ID_POPULAR, reply_markup=keyboard.to_reply_markup())
-        await db.add_to_popular(post["message_id"], msg.message_id)
-        logger.info(f"Post {post['message_id']} became popular")
+    promotion_engine.mark(post["message_id"])
 
-    if post.get("best_id") is None and is_best(rating, post["comment_count"]):
-        msg = await query.message.copy(
-            CHAT_ID_BEST,
-            reply_to_message_id=BEST_CHANNEL_TOPIC_MESSAGE_ID,
-            reply_markup=keyboard.to_reply_markup(),
-        )
-        await db.add_to_best(post["message_id"], msg.message_id)
-        logger.info(f"Post {post['message_id']} became best")
 
+@metrics.handler
+async def media_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for media files (photos and videos)."""
+    if update.message.media_group_id is not None:
+        album_assembler.add(update.message, context)
+        return
 
-def is_popular(rating: tuple[int, int]) -> bool:
-    """Checks if message is suitable for popular
-    
-    Takes into account number of positive votes and percentage of them.
-    """
-
-    positive_votes, negative_votes = rating
-    if positive_votes + negative_votes == 0:
-        return False
-    
-    positive_votes_percentage = positive_votes / (positive_votes + negative_votes) * 100
+    await publish_media([update.message], context)
 
-    # positive votes more than 80% and this is at least 20 positive votes
-    return (
-        positive_votes_percentage > POPULAR_POSITIVE_VOTES_PERCENTAGE 
-        and positive_votes >= POPULAR_POSITIVE_VOTES_MIN_COUNT
-    )
 
-def is_best(rating: tuple[int, int], comment_count: int) -> bool:
-    """Checks if message is suitable for best
-    
-    Takes into account number of positive votes, percentage of them
-    as well as number of comments.
-    """
+async def publish_album(messages: list[Message], context: CallbackContext) -> None:
+    """Publishes an assembled album in turn with other posts of its author"""
+    await update_processor.run_keyed(author_key(messages[0].from_user.id), publish_media(messages, context))
 
-    positive_votes, negative_votes = rating
-    if positive_votes + negative_votes == 0:
-        return False
-    
-    positive_votes_percentage = positive_votes / (positive_votes + negative_votes) * 100
 
-    return (
-        positive_votes_percentage > BEST_POSITIVE_VOTES_PERCENTAGE
-        and positive_votes >= BEST_POSITIVE_VOTES_MIN_COUNT
-        and comment_count > BEST_COMMENT_MIN_COUNT
-    )
+@metrics.handler
+async def publish_media(messages: list[Message], context: CallbackContext) -> None:
+    """Enqueues publishing a photo or video, or a whole album of them.
 
+    The first item becomes the post, the rest of the album is sent to its comments thread.
+    """
+    media_message = messages[0]
+    user_id: int = media_message.from_user.id
+    media_group = media_message.media_group_id
 
-async def media_handler(update: Update, context: CallbackContext) -> None:
-    """Handler for media files (photos)."""
-    user_id: int = update.message.from_user.id
-    media_message = update.message
-    caption: str | None = media_message.caption
+    if media_group is not None and await db.get_post_by_media_group(media_group) is not None:
+        await enqueue_album_items(messages)
+        return
 
     # Check the user's post count for today in the database
     user_post_count = await db.get_post_count_for_user(user_id)
 
     if user_post_count >= MAX_USER_POST_COUNT_PER_DAY:
         plural_posts_msg = plural_ru(MAX_USER_POST_COUNT_PER_DAY, ["пост", "поста", "постов"])
-        await update.message.reply_text(
+        await media_message.reply_text(
             'Вы достигли лимита постов на сегодня '
             f'({MAX_USER_POST_COUNT_PER_DAY} {plural_posts_msg}). Попробуйте завтра!'
         )
         return
 
-    media_group = media_message.media_group_id
-    if media_group is not None:
-        post = await db.get_post_by_media_group(media_group)
-        if post is not None:
-            if media_message.photo:
-                await context.bot.send_photo(
-                    photo=update.message.photo[-1],
-                    chat_id=COMMENTS_GROUP_ID,
-                    reply_to_message_id=int(post["comment_thread_id"]),
-                )
-            elif media_message.video:
-                await context.bot.send_video(
-                    video=media_message.video,
-                    chat_id=COMMENTS_GROUP_ID,
-                    reply_to_message_id=int(post["comment_thread_id"]),
-                )
-            else:
-                logger.error(f"Unknown media type in message {media_message}")
-            return
-
-    user_name = update.message.from_user.first_name  # Get user's first name
-    username = update.message.from_user.username  # Get user's username
+    user_name = media_message.from_user.first_name  # Get user's first name
+    username = media_message.from_user.username  # Get user's username
+    # Album caption is set on one of its items
+    caption: str | None = next((message.caption for message in messages if message.caption), None)
 
     name = f"@{username}" if username else user_name
     user_signature = f"{name}\n{caption}\n" if caption else f"{name}"
 
-    if media_message.photo:
-        msg = await context.bot.send_photo(
-            chat_id=CHAT_ID_NEW,
-            photo=media_message.photo[-1],
-            caption=user_signature,
-            reply_markup=PostKeyboard().to_reply_markup(),
-        )
-    elif media_message.video:
-        msg = await context.bot.send_video(
-            chat_id=CHAT_ID_NEW,
-            video=media_message.video,
-            caption=user_signature,
-            reply_markup=PostKeyboard().to_reply_markup(),
-        )
+    if media_group is not None:
+        key = f"post:album:{media_group}"
     else:
-        logger.error(f"Unknown media type in message {media_message}")
-        return
-
-    thread = await msg.copy(COMMENTS_GROUP_ID, disable_notification=True)
-    await context.bot.pin_chat_message(COMMENTS_GROUP_ID, thread.message_id)
-    keyboard = PostKeyboard(thread_id=thread.message_id)
-    await msg.edit_reply_markup(keyboard.to_reply_markup())
-
-    await db.add_post(msg.message_id, user_id, thread.message_id, media_group)
-
-    await post_feedback(update, user_post_count)
-
-    logger.info(f"Created new post {msg.message_id} by user {username}")
+        key = f"post:{media_message.chat_id}:{media_message.message_id}"
+    payload = {
+        "user_id": user_id,
+        "username": username,
+        "chat_id": media_message.chat_id,
+        "text": user_signature,
+        "media": [media_item(message) for message in messages],
+        "media_group": media_group,
+        "post_count": user_post_count,
+    }
+    if not await outbox.enqueue("publish_post", key, payload, author_id=user_id) and media_group is not None:
+        # Items that arrived after the album was enqueued
+        await enqueue_album_items(messages)
+
+
+async def enqueue_album_items(messages: list[Message]) -> None:
+    media_group = messages[0].media_group_id
+    await outbox.enqueue(
+        "album_items",
+        f"album:{media_group}:{messages[0].message_id}",
+        {"media_group": media_group, "media": [media_item(message) for message in messages]},
+    )
 
 
+@metrics.handler
 async def message_handler(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     # Check the user's post count for today in the database
@@ -270,28 +358,101 @@ async def message_handler(update: Update, context: CallbackContext):
         )
         return
 
-    keyboard = PostKeyboard()
-
     username = update.message.from_user.username
     user_name = update.message.from_user.first_name
     caption = update.message.caption
     name = f"@{username}" if username else user_name
     user_signature = f"{name}\n{caption}\n" if caption else f"{name}"
     content = f"{user_signature}\n{update.message.text}"
-    msg = await context.bot.send_message(CHAT_ID_NEW, content, reply_markup=keyboard.to_reply_markup())
 
-    thread = await msg.copy(COMMENTS_GROUP_ID, disable_notification=True)
-    keyboard.thread_id = thread.message_id
-    await context.bot.pin_chat_message(COMMENTS_GROUP_ID, thread.message_id)
-    await msg.edit_reply_markup(keyboard.to_reply_markup())
+    payload = {
+        "user_id": user_id,
+        "username": username,
+        "chat_id": update.message.chat_id,
+        "text": content,
+        "media": [],
+        "media_group": None,
+        "post_count": user_post_count,
+    }
+    await outbox.enqueue(
+        "publish_post", f"post:{update.message.chat_id}:{update.message.message_id}", payload, author_id=user_id
+    )
+
+
+async def publish_post(job: OutboxJob, bot: Bot) -> None:
+    """Outbox job sending a post to the channel, opening its comments thread and saving it"""
+    payload = job["payload"]
+    media = payload["media"]
+
+    async def send() -> int:
+        markup = PostKeyboard().to_reply_markup()
+        if not media:
+            msg = await bot.send_message(CHAT_ID_NEW, payload["text"], reply_markup=markup)
+        elif media[0]["type"] == "photo":
+            msg = await bot.send_photo(CHAT_ID_NEW, media[0]["file_id"], caption=payload["text"], reply_markup=markup)
+        else:
+            msg = await bot.send_video(CHAT_ID_NEW, media[0]["file_id"], caption=payload["text"], reply_markup=markup)
+        return msg.message_id
 
-    await db.add_post(msg.message_id, user_id, thread.message_id)
+    message_id = await outbox.step(job, "message_id", send)
+
+    async def open_thread() -> int:
+        thread = await bot.copy_message(COMMENTS_GROUP_ID, CHAT_ID_NEW, message_id, disable_notification=True)
+        return thread.message_id
+
+    thread_id = await outbox.step(job, "thread_id", open_thread)
+    # Saved before the remaining steps, so votes and comments on the post are counted while they run
+    if "post" not in job["state"]:
+        await db.add_post(message_id, payload["user_id"], thread_id, payload["media_group"], job=job)
+
+    await outbox.step(job, "pinned", lambda: bot.pin_chat_message(COMMENTS_GROUP_ID, thread_id))
+
+    keyboard = PostKeyboard(thread_id=thread_id)
+
+    async def attach_keyboard() -> bool:
+        # Part of publishing rather than a rating refresh, so it isn't queued behind those
+        await bot.edit_message_reply_markup(
+            CHAT_ID_NEW, message_id, reply_markup=keyboard.to_reply_markup(), rate_limit_args=Priority.HIGH
+        )
+        return True
 
-    await post_feedback(update, user_post_count)
+    await outbox.step(job, "keyboard", attach_keyboard)
+    keyboard_updater.shown(CHAT_ID_NEW, message_id, keyboard)
 
-    logger.info(f"Created new post {msg.message_id} by user {update.message.from_user.username}")
+    if len(media) > 1:
+        await outbox.step(job, "album", lambda: send_to_thread(bot, media[1:], thread_id))
 
+    await outbox.step(job, "feedback", lambda: post_feedback(bot, payload["chat_id"], payload["post_count"]))
 
+    logger.info("Created new post %s by user %s", message_id, payload["username"])
+
+
+async def publish_album_items(job: OutboxJob, bot: Bot) -> None:
+    """Outbox job sending album items that arrived after the album was published to its thread"""
+    post = await db.get_post_by_media_group(job["payload"]["media_group"])
+    if post is None:
+        # Retried until the job publishing the album saves the post
+        raise LookupError(f"Album {job['payload']['media_group']} is not published yet")
+
+    await outbox.step(job, "sent", lambda: send_to_thread(bot, job["payload"]["media"], post["comment_thread_id"]))
+
+
+async def send_to_thread(bot: Bot, media: list[dict[str, str]], thread_id: int) -> bool:
+    """Sends photos and videos to the comments thread of a post, in one request if there are several"""
+    if len(media) == 1 and media[0]["type"] == "photo":
+        await bot.send_photo(COMMENTS_GROUP_ID, media[0]["file_id"], reply_to_message_id=thread_id)
+    elif len(media) == 1:
+        await bot.send_video(COMMENTS_GROUP_ID, media[0]["file_id"], reply_to_message_id=thread_id)
+    else:
+        await bot.send_media_group(
+            COMMENTS_GROUP_ID,
+            [to_input_media(item) for item in media],
+            reply_to_message_id=thread_id,
+        )
+    return True
+
+
+@metrics.handler
 async def comments_handler(update: Update, context: CallbackContext):
     """Handler for user comments"""
 
@@ -299,44 +460,161 @@ async def comments_handler(update: Update, context: CallbackContext):
     if not thread_id or update.message.pinned_message:
         return
 
-    logger.info(f"User {update.message.from_user.username} left a comment in {thread_id} thread")
+    comments_logger.info("User %s left a comment in %s thread", update.message.from_user.username, thread_id)
 
-    post = await db.increase_comments_counter(thread_id)
-    rating = await db.get_rating(post["message_id"])
-    keyboard = PostKeyboard(
-        rating=rating[0] - rating[1],
-        thread_id=post["comment_thread_id"],
-        comment_count=post["comment_count"],
-    )
+    comment_counter.add(thread_id)
 
-    await context.bot.edit_message_reply_markup(
-        chat_id=CHAT_ID_NEW,
-        message_id=int(post["message_id"]),
-        reply_markup=keyboard.to_reply_markup()
-    )
 
-    if post.get("popular_id") is not None:
-        await context.bot.edit_message_reply_markup(
-            chat_id=CHAT_ID_POPULAR,
-            message_id=int(post["popular_id"]),
-            reply_markup=keyboard.to_reply_markup()
+def refresh_comment_count(posts: list[Post]):
+    """Updates keyboards of posts after their comment counters were written"""
+
+    for post in posts:
+        keyboard = PostKeyboard(
+            rating=post["plus_count"] - post["minus_count"],
+            thread_id=post["comment_thread_id"],
+            comment_count=post["comment_count"],
         )
+        keyboard_updater.schedule(CHAT_ID_NEW, post["message_id"], keyboard)
+        if post.get("popular_id") is not None:
+            keyboard_updater.schedule(CHAT_ID_POPULAR, post["popular_id"], keyboard)
+        promotion_engine.mark(post["message_id"])
 
 
-async def post_feedback(update: Update, user_post_count: int):
+async def post_feedback(bot: Bot, chat_id: int, user_post_count: int) -> bool:
     posts_limit_left = MAX_USER_POST_COUNT_PER_DAY - user_post_count
     plural_posts_msg = plural_ru(posts_limit_left, ["пост", "поста", "постов"])
-    await update.message.reply_text(
+    await bot.send_message(
+        chat_id,
         f"Ваш пост добавлен! Найти его можно здесь - https://t.me/new_kapibara\n"
         "Сегодня вы еще можете опубликовать "
         f"{posts_limit_left} {plural_posts_msg}."
     )
+    return True
 
 
-def main():
+@contextlib.contextmanager
+def startup_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_times[name] = time.perf_counter() - started
+
+
+async def on_startup(application: Application):
+    """Prepares everything updates need, they are consumed once it returns
+
+    Connections are opened and recent posts loaded here rather than by the first updates.
+    """
+    with startup_phase("connect"):
+        await db.connect()
+    with startup_phase("migrate"):
+        if DB_MIGRATE_ON_STARTUP:
+            await migrate()
+        await partitions.create_partitions()
+    with startup_phase("warm_up"):
+        await db.restore_votes()
+        posts = await db.warm_up(WARMUP_HOURS) if WARMUP_HOURS > 0 else 0
+    await keyboard_updater.start(application.bot)
+    await comment_counter.start()
+    await outbox.start(application.bot)
+    await promotion_engine.start()
+    await loop_lag_monitor.start()
+
+    metrics.track_backlog("updates", application.update_queue.qsize)
+    metrics.track_backlog("bot_api", lambda: rate_limiter.backlog)
+    metrics.track_backlog("serialized_updates", lambda: update_processor.backlog)
+    metrics.track_backlog("keyboard_edits", lambda: keyboard_updater.backlog)
+    metrics.track_backlog("comments", lambda: comment_counter.backlog)
+    metrics.track_backlog("promotions", lambda: promotion_engine.backlog)
+    metrics.track_backlog("outbox_running", lambda: outbox.backlog)
+
+    # Includes building the application and its initialization, which asks Telegram about the bot
+    startup_times["total"] = time.perf_counter() - _started
+    logger.info(
+        "Ready for updates %.3fs after start: import %.3fs, connect %.3fs, migrate %.3fs, warm-up %.3fs (%s posts)",
+        startup_times["total"], startup_times["import"], startup_times["connect"], startup_times["migrate"],
+        startup_times["warm_up"], posts,
+    )
+
+
+async def on_stop(_: Application):
+    """Stops background components in order, one failing to stop doesn't keep the rest running"""
+    stops = [
+        # Written comment counters schedule keyboard edits, so they go first
+        comment_counter.stop,
+        promotion_engine.stop,
+        # Jobs copying posts tell the keyboard updater about their keyboards
+        outbox.stop,
+        keyboard_updater.stop,
+        loop_lag_monitor.stop,
+        # Nothing writes votes anymore
+        db.save_votes,
+    ]
+    for stop in stops:
+        try:
+            await stop()
+        except Exception:
+            logger.exception("Failed to stop %s", stop.__qualname__)
+
+
+async def on_shutdown(_: Application):
+    await db.backend.close()
+    await db.replicas.close()
+
+
+async def run(application: Application):
+    """Runs the bot and the HTTP server in one event loop until SIGINT or SIGTERM
+
+    In webhook mode updates arrive through the HTTP server, otherwise they are polled.
+    """
+    # Only needed here, not by tools importing the app
+    import uvicorn
+    from web import build_web_app
+
+    webhook_path = None
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN:
+            raise RuntimeError("WEBHOOK_URL and WEBHOOK_SECRET_TOKEN are required in webhook mode")
+        webhook_path = urlparse(WEBHOOK_URL).path or "/"
+
+    web_app = build_web_app(
+        application,
+        stats,
+        webhook_path=webhook_path,
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        metrics_enabled=METRICS_ENABLED,
+    )
+    server = uvicorn.Server(uvicorn.Config(web_app, host=HTTP_HOST, port=HTTP_PORT, lifespan="off", log_level="warning"))
+
+    async with application:
+        await on_startup(application)
+        if webhook_path is not None:
+            await application.bot.set_webhook(
+                WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET_TOKEN
+            )
+        else:
+            await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        await application.start()
+        logger.info("Bot started in %s mode", BOT_MODE)
+
+        try:
+            # Returns once a termination signal is received
+            await server.serve()
+        finally:
+            if application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+            await on_stop(application)
+    await on_shutdown(application)
+
+
+def build_application(base_url: str = "https://api.telegram.org/bot") -> Application:
+    """Builds the application with all handlers, base_url points it to another Bot API server"""
     application = (
         ApplicationBuilder()
         .token(TOKEN)
+        .base_url(base_url)
         .connect_timeout(10)  # default 5s
         .read_timeout(30)  # default 5s
         .write_timeout(30)  # default 5s
@@ -345,25 +623,26 @@ def main():
         .get_updates_read_timeout(60)  # default 5s
         .get_updates_write_timeout(60)  # default 5s
         .pool_timeout(10)  # default 1s
+        .rate_limiter(rate_limiter)
+        .concurrent_updates(update_processor)
         .build()
     )
 
+    outbox.register("publish_post", publish_post)
+    outbox.register("album_items", publish_album_items)
+
     application.add_handler(CommandHandler("start", start, filters=filters.ChatType.PRIVATE))
     application.add_handler(MessageHandler(~filters.COMMAND & filters.TEXT & filters.ChatType.PRIVATE, message_handler))
     application.add_handler(
         MessageHandler(~filters.COMMAND & (filters.PHOTO | filters.VIDEO) & filters.ChatType.PRIVATE, media_handler))
     application.add_handler(CallbackQueryHandler(vote_handler))
     application.add_handler(MessageHandler(~filters.COMMAND & filters.Chat(int(COMMENTS_GROUP_ID)), comments_handler))
+    return application
 
-    application.run_polling(
-        allowed_updates=[
-            Update.MESSAGE, 
-            Update.CALLBACK_QUERY,
-        ]
-    )
+
+def main():
+    asyncio.run(run(build_application()))
 
 
 if __name__ == '__main__':
-    flask_thread = threading.Thread(target=flask_app.run, kwargs={"host": "0.0.0.0", "port": 8080})
-    flask_thread.start()
     main()
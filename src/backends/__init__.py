@@ -0,0 +1,18 @@
+"""Database drivers behind one interface, see Backend"""
+from backends.base import Backend, Connection, Row
+from backends.replicas import ReplicaSet
+
+
+def create_backend(name: str, params: dict[str, str], **pool_options) -> Backend:
+    """Creates backend by name, drivers are imported only when used"""
+    match name:
+        case "aiopg":
+            from backends.aiopg_backend import AiopgBackend
+            return AiopgBackend(params, **pool_options)
+        case "asyncpg":
+            from backends.asyncpg_backend import AsyncpgBackend
+            return AsyncpgBackend(params, **pool_options)
+    raise ValueError(f"Unknown database backend {name!r}, expected aiopg or asyncpg")
+
+
+__all__ = ["Backend", "Connection", "ReplicaSet", "Row", "create_backend"]
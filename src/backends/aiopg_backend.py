@@ -0,0 +1,105 @@
+import asyncio
+from typing import AsyncContextManager
+
+import aiopg
+import psycopg2
+from psycopg2.extras import DictCursor
+
+from backends.base import Backend, Connection, Params, Row
+
+
+class AiopgConnection(Connection):
+
+    def __init__(self, backend: Backend, conn: aiopg.Connection, cursor: aiopg.Cursor):
+        super().__init__(backend)
+        self.conn = conn
+        self.cursor = cursor
+
+    def transaction(self) -> AsyncContextManager:
+        return self.cursor.begin()
+
+    async def _fetch(self, stmt: str, params: Params) -> list[Row]:
+        await self.cursor.execute(stmt, params)
+        return await self.cursor.fetchall()
+
+    async def _fetchrow(self, stmt: str, params: Params) -> Row | None:
+        await self.cursor.execute(stmt, params)
+        return await self.cursor.fetchone()
+
+    async def _execute(self, stmt: str, params: Params, timeout: float | None) -> int:
+        await self.cursor.execute(stmt, params, timeout=timeout)
+        return self.cursor.rowcount
+
+
+class AiopgBackend(Backend):
+    """aiopg pool with psycopg2 dict rows, statements are sent as text every time
+
+    Connections that sat idle for longer than ``healthcheck_interval`` are pinged before
+    being handed out, and connections that fail with a connection-level error are dropped
+    so the pool reconnects on the next checkout.
+    """
+
+    name = "aiopg"
+    connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError, OSError, asyncio.TimeoutError)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool: aiopg.Pool | None = None
+
+    @property
+    def connected(self) -> bool:
+        return self._pool is not None and not self._pool.closed
+
+    async def _create_pool(self):
+        self._pool = await aiopg.create_pool(
+            " ".join(f"{key}={value}" for key, value in self.params.items()),
+            minsize=self.min_size,
+            maxsize=self.max_size,
+            timeout=self.timeout,
+            pool_recycle=self.recycle,
+            cursor_factory=DictCursor,
+        )
+
+    async def _acquire(self) -> AiopgConnection:
+        loop = asyncio.get_running_loop()
+        # Every dropped connection makes room for a new one, so this is bounded by the pool size
+        for _ in range(self.max_size + 1):
+            conn = await self._pool.acquire()
+            if await self._is_healthy(conn, loop.time()):
+                break
+            conn.close()
+            self._pool.release(conn)
+            self._reconnects += 1
+        else:
+            raise psycopg2.OperationalError("Could not check out a healthy database connection")
+
+        return AiopgConnection(self, conn, await conn.cursor())
+
+    async def _release(self, connection: AiopgConnection, error: BaseException | None):
+        connection.cursor.close()
+        if isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            # Broken connections are not put back, the pool opens a new one instead
+            connection.conn.close()
+            self._reconnects += 1
+        self._pool.release(connection.conn)
+
+    async def _is_healthy(self, conn: aiopg.Connection, now: float) -> bool:
+        if conn.closed:
+            return False
+        if now - conn.last_usage < self.healthcheck_interval:
+            return True
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT 1")
+        except (psycopg2.Error, asyncio.TimeoutError):
+            return False
+        return True
+
+    def _pool_size(self) -> tuple[int, int]:
+        return self._pool.size, self._pool.freesize
+
+    async def close(self):
+        if self.connected:
+            self._pool.close()
+            await self._pool.wait_closed()
+        self._pool = None
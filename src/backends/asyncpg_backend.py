@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import re
+from typing import Any, AsyncContextManager
+
+import asyncpg
+
+from backends.base import Backend, Connection, Params, Row
+
+_named_param = re.compile(r"%\((\w+)\)s")
+
+
+@functools.lru_cache(maxsize=256)
+def convert_placeholders(stmt: str) -> tuple[str, tuple[str, ...]]:
+    """Converts ``%(name)s`` placeholders to ``$n`` ones, returns the statement and names in order"""
+    names: list[str] = []
+
+    def replace(match: re.Match) -> str:
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    return _named_param.sub(replace, stmt), tuple(names)
+
+
+def _bind(stmt: str, params: Params) -> tuple[str, list[Any]]:
+    query, names = convert_placeholders(stmt)
+    return query, [params[name] for name in names]
+
+
+class AsyncpgConnection(Connection):
+
+    def __init__(self, backend: Backend, conn: asyncpg.Connection):
+        super().__init__(backend)
+        self.conn = conn
+
+    def transaction(self) -> AsyncContextManager:
+        return self.conn.transaction()
+
+    async def _fetch(self, stmt: str, params: Params) -> list[Row]:
+        query, args = _bind(stmt, params)
+        return await self.conn.fetch(query, *args)
+
+    async def _fetchrow(self, stmt: str, params: Params) -> Row | None:
+        query, args = _bind(stmt, params)
+        return await self.conn.fetchrow(query, *args)
+
+    async def _execute(self, stmt: str, params: Params, timeout: float | None) -> int:
+        query, args = _bind(stmt, params)
+        # Status is like "UPDATE 3" or "INSERT 0 1", the last number is the row count
+        status = await self.conn.execute(query, *args, timeout=timeout)
+        count = status.rsplit(" ", 1)[-1]
+        return int(count) if count.isdigit() else 0
+
+
+class AsyncpgBackend(Backend):
+    """asyncpg pool using the binary protocol
+
+    Statements with parameters are prepared once per connection and kept in asyncpg's
+    statement cache, later calls only send parameters. Broken connections are replaced by
+    the pool itself, idle ones are closed after ``recycle`` seconds.
+    """
+
+    name = "asyncpg"
+    connection_errors = (
+        asyncpg.PostgresConnectionError,
+        asyncpg.exceptions.OperatorInterventionError,
+        asyncpg.InterfaceError,
+        OSError,
+        asyncio.TimeoutError,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool: asyncpg.Pool | None = None
+
+    @property
+    def connected(self) -> bool:
+        return self._pool is not None and not self._pool.is_closing()
+
+    async def _create_pool(self):
+        params = dict(self.params)
+        params["database"] = params.pop("dbname")
+        params["port"] = int(params["port"])
+        self._pool = await asyncpg.create_pool(
+            **params,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            timeout=self.timeout,
+            command_timeout=self.timeout,
+            max_inactive_connection_lifetime=max(self.recycle, 0),
+        )
+
+    async def _acquire(self) -> AsyncpgConnection:
+        return AsyncpgConnection(self, await self._pool.acquire(timeout=self.timeout))
+
+    async def _release(self, connection: AsyncpgConnection, error: BaseException | None):
+        await self._pool.release(connection.conn)
+
+    def _pool_size(self) -> tuple[int, int]:
+        return self._pool.get_size(), self._pool.get_idle_size()
+
+    async def close(self):
+        if self.connected:
+            await self._pool.close()
+        self._pool = None
@@ -0,0 +1,183 @@
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Any, AsyncContextManager, AsyncIterator, Mapping, Sequence
+
+# Rows can be read both by column name and by position
+Row = Mapping[str, Any] | Sequence[Any]
+Params = dict[str, Any] | None
+
+
+class Connection(ABC):
+    """Connection checked out of a backend pool
+
+    Statements use ``%(name)s`` placeholders whatever the backend is.
+    """
+
+    def __init__(self, backend: 'Backend'):
+        self._backend = backend
+
+    async def fetch(self, stmt: str, params: Params = None) -> list[Row]:
+        self._backend.queries += 1
+        return await self._fetch(stmt, params)
+
+    async def fetchrow(self, stmt: str, params: Params = None) -> Row | None:
+        self._backend.queries += 1
+        return await self._fetchrow(stmt, params)
+
+    async def fetchval(self, stmt: str, params: Params = None) -> Any:
+        """First column of the first row"""
+        row = await self.fetchrow(stmt, params)
+        return row[0] if row is not None else None
+
+    async def execute(self, stmt: str, params: Params = None, timeout: float | None = None) -> int:
+        """Runs statement, returns number of affected rows
+
+        ``timeout`` replaces the backend one for this statement, e.g. for migrations.
+        """
+        self._backend.queries += 1
+        return await self._execute(stmt, params, timeout)
+
+    @abstractmethod
+    def transaction(self) -> AsyncContextManager:
+        ...
+
+    @abstractmethod
+    async def _fetch(self, stmt: str, params: Params) -> list[Row]:
+        ...
+
+    @abstractmethod
+    async def _fetchrow(self, stmt: str, params: Params) -> Row | None:
+        ...
+
+    @abstractmethod
+    async def _execute(self, stmt: str, params: Params, timeout: float | None) -> int:
+        ...
+
+
+class Backend(ABC):
+    """Pool of database connections of one driver
+
+    The pool is created on first use. Connections are checked out per statement by
+    ``fetch``, ``fetchrow``, ``fetchval`` and ``execute``, use ``connection`` to run
+    several statements or a transaction on one connection.
+    """
+
+    name: str
+    # Errors meaning the server is unreachable or gone rather than the statement failed
+    connection_errors: tuple[type[BaseException], ...] = (OSError, asyncio.TimeoutError)
+
+    def __init__(
+            self,
+            params: dict[str, str],
+            *,
+            min_size: int,
+            max_size: int,
+            timeout: float,
+            recycle: float,
+            healthcheck_interval: float,
+    ):
+        self.params = params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.healthcheck_interval = healthcheck_interval
+        self.queries = 0
+        self._lock = asyncio.Lock()
+        self._waiting = 0
+        self._acquired_total = 0
+        self._acquire_timeouts = 0
+        self._reconnects = 0
+        self._max_acquire_time = 0.0
+
+    @property
+    @abstractmethod
+    def connected(self) -> bool:
+        ...
+
+    @abstractmethod
+    async def _create_pool(self):
+        ...
+
+    @abstractmethod
+    async def _acquire(self) -> Connection:
+        ...
+
+    @abstractmethod
+    async def _release(self, connection: Connection, error: BaseException | None):
+        """Puts connection back, error is the exception raised while it was used if any"""
+
+    @abstractmethod
+    def _pool_size(self) -> tuple[int, int]:
+        """Number of open and of idle connections"""
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    async def connect(self):
+        if self.connected:
+            return
+        async with self._lock:
+            if not self.connected:
+                await self._create_pool()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Connection]:
+        await self.connect()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self._waiting += 1
+        try:
+            connection = await self._acquire()
+        except asyncio.TimeoutError:
+            self._acquire_timeouts += 1
+            raise
+        finally:
+            self._waiting -= 1
+        self._acquired_total += 1
+        self._max_acquire_time = max(self._max_acquire_time, loop.time() - started)
+
+        error = None
+        try:
+            yield connection
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await self._release(connection, error)
+
+    async def fetch(self, stmt: str, params: Params = None) -> list[Row]:
+        async with self.connection() as conn:
+            return await conn.fetch(stmt, params)
+
+    async def fetchrow(self, stmt: str, params: Params = None) -> Row | None:
+        async with self.connection() as conn:
+            return await conn.fetchrow(stmt, params)
+
+    async def fetchval(self, stmt: str, params: Params = None) -> Any:
+        async with self.connection() as conn:
+            return await conn.fetchval(stmt, params)
+
+    async def execute(self, stmt: str, params: Params = None) -> int:
+        async with self.connection() as conn:
+            return await conn.execute(stmt, params)
+
+    def stats(self) -> dict[str, Any]:
+        """Pool saturation counters, ``used == maxsize`` with ``waiting > 0`` means the pool is exhausted"""
+        size, free = self._pool_size() if self.connected else (0, 0)
+        return {
+            "backend": self.name,
+            "minsize": self.min_size,
+            "maxsize": self.max_size,
+            "size": size,
+            "free": free,
+            "used": size - free,
+            "waiting": self._waiting,
+            "acquired_total": self._acquired_total,
+            "acquire_timeouts": self._acquire_timeouts,
+            "reconnects": self._reconnects,
+            "max_acquire_time": round(self._max_acquire_time, 6),
+            "queries": self.queries,
+        }
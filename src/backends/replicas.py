@@ -0,0 +1,126 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable
+
+from backends.base import Backend
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaSet:
+    """Read replicas of the primary database picked in turn for reads
+
+    Keys of written rows, like ``("post", message_id)``, are remembered for ``sticky_for``
+    seconds and reads of them are sent to the primary, so a read right after a write sees
+    it even if replicas lag behind. A replica that failed with a connection error is
+    skipped for ``retry_after`` seconds. ``choose`` returns None when reads should go to
+    the primary.
+    """
+
+    def __init__(self, replicas: list[Backend], sticky_for: float, retry_after: float):
+        self.replicas = replicas
+        self.sticky_for = sticky_for
+        self.retry_after = retry_after
+        # Key -> time it stops being sticky, in write order, so expired keys are at the front
+        self._written: OrderedDict[Hashable, float] = OrderedDict()
+        self._down_until: dict[int, float] = {}
+        self._next = 0
+        self._replica_reads = 0
+        self._primary_reads = 0
+        self._sticky_reads = 0
+        self._failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def written(self, *keys: Hashable):
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        for key in keys:
+            self._written[key] = now + self.sticky_for
+            self._written.move_to_end(key)
+        self._expire(now)
+
+    def _expire(self, now: float):
+        while self._written:
+            key, until = next(iter(self._written.items()))
+            if until > now:
+                break
+            del self._written[key]
+
+    def is_sticky(self, keys: Iterable[Hashable]) -> bool:
+        now = time.monotonic()
+        self._expire(now)
+        return any(key in self._written for key in keys)
+
+    def choose(self, keys: Iterable[Hashable] = ()) -> Backend | None:
+        """Replica to read rows of given keys from, None to read them from the primary"""
+
+        if not self.enabled:
+            return None
+
+        if self.is_sticky(keys):
+            self._sticky_reads += 1
+            self._primary_reads += 1
+            return None
+
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            index = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+            if self._down_until.get(index, 0) <= now:
+                self._replica_reads += 1
+                return self.replicas[index]
+
+        self._primary_reads += 1
+        return None
+
+    def failed(self, replica: Backend, error: BaseException):
+        """Marks replica as down after a connection error, the read is retried on the primary"""
+
+        self._failures += 1
+        self._primary_reads += 1
+        index = self.replicas.index(replica)
+        if self._down_until.get(index, 0) <= time.monotonic():
+            logger.warning(
+                "Replica %s:%s failed, reading from primary for %ss: %r",
+                replica.params["host"], replica.params["port"], self.retry_after, error,
+            )
+        self._down_until[index] = time.monotonic() + self.retry_after
+
+    def missed(self):
+        """Counts a read retried on the primary because the replica had no row yet"""
+        self._primary_reads += 1
+
+    async def connect(self):
+        """Opens replica pools, a replica that can't be reached is skipped like after a failed read"""
+        for index, replica in enumerate(self.replicas):
+            try:
+                await replica.connect()
+            except replica.connection_errors as e:
+                logger.warning(
+                    "Replica %s:%s is unreachable, reading from primary for %ss: %r",
+                    replica.params["host"], replica.params["port"], self.retry_after, e,
+                )
+                self._down_until[index] = time.monotonic() + self.retry_after
+
+    async def close(self):
+        for replica in self.replicas:
+            await replica.close()
+
+    def stats(self) -> dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "replicas": len(self.replicas),
+            "healthy": sum(1 for index in range(len(self.replicas)) if self._down_until.get(index, 0) <= now),
+            "replica_reads": self._replica_reads,
+            "primary_reads": self._primary_reads,
+            "sticky_reads": self._sticky_reads,
+            "failures": self._failures,
+            "sticky_keys": len(self._written),
+            "pools": [replica.stats() for replica in self.replicas],
+        }
@@ -0,0 +1,298 @@
+import struct
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Iterable
+
+from models import Post
+
+# Post fields a cached post can be looked up by, besides message_id
+POST_INDEX_FIELDS = ("popular_id", "best_id", "comment_thread_id", "media_group")
+
+
+class PostCache:
+    """Bounded LRU cache of posts with a TTL
+
+    Posts are stored by message_id and can also be found by any of ``POST_INDEX_FIELDS``.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._posts: OrderedDict[int, tuple[Post, float]] = OrderedDict()
+        self._indexes: dict[str, dict[int | str, int]] = {field: {} for field in POST_INDEX_FIELDS}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, field: str, value: int | str) -> Post | None:
+        message_id = value if field == "message_id" else self._indexes[field].get(value)
+        entry = self._posts.get(message_id) if message_id is not None else None
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                self.invalidate(message_id)
+            self.misses += 1
+            return None
+
+        self._posts.move_to_end(message_id)
+        self.hits += 1
+        return Post(**entry[0])
+
+    def put(self, post: Post):
+        if self.max_size <= 0:
+            return
+
+        message_id = post["message_id"]
+        self.invalidate(message_id)
+        self._posts[message_id] = (Post(**post), time.monotonic() + self.ttl)
+        self._index(message_id, post)
+        while len(self._posts) > self.max_size:
+            self.invalidate(next(iter(self._posts)))
+
+    def update(self, message_id: int, **fields):
+        """Updates fields of a cached post, does nothing if post is not cached"""
+        entry = self._posts.get(message_id)
+        if entry is None:
+            return
+
+        post = entry[0]
+        self._unindex(message_id, post)
+        post.update(fields)
+        self._index(message_id, post)
+
+    def invalidate(self, message_id: int):
+        entry = self._posts.pop(message_id, None)
+        if entry is not None:
+            self._unindex(message_id, entry[0])
+
+    def clear(self):
+        self._posts.clear()
+        for index in self._indexes.values():
+            index.clear()
+
+    def _index(self, message_id: int, post: Post):
+        for field, index in self._indexes.items():
+            if post.get(field) is not None:
+                index[post[field]] = message_id
+
+    def _unindex(self, message_id: int, post: Post):
+        for field, index in self._indexes.items():
+            if post.get(field) is not None and index.get(post[field]) == message_id:
+                del index[post[field]]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._posts),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class PostQuota:
+    """Sliding window of post times per user
+
+    Holds times of posts users made within the last ``window`` seconds, so daily post count
+    can be checked without querying the database. Users are loaded on the first check and
+    evicted in LRU order once there are more than ``max_users``.
+    """
+
+    def __init__(self, max_users: int, window: float):
+        self.max_users = max_users
+        self.window = window
+        self._users: OrderedDict[int, deque[float]] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0
+
+    def count(self, user_id: int) -> int | None:
+        """Number of posts in the window, None if user is not loaded"""
+        posts = self._users.get(user_id)
+        if posts is None:
+            return None
+
+        self._users.move_to_end(user_id)
+        threshold = time.monotonic() - self.window
+        while posts and posts[0] <= threshold:
+            posts.popleft()
+        return len(posts)
+
+    def load(self, user_id: int, ages: Iterable[float]):
+        """Loads user posts given their ages in seconds"""
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        self._users[user_id] = deque(sorted(now - age for age in ages))
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def add(self, user_id: int):
+        """Records a new post, does nothing if user is not loaded"""
+        posts = self._users.get(user_id)
+        if posts is not None:
+            posts.append(time.monotonic())
+
+
+class PostVotes:
+    """Votes of one post by user id, with counters kept in sync"""
+
+    __slots__ = ("date", "votes", "plus", "minus")
+
+    def __init__(self, date: float, votes: Iterable[tuple[int, int]] = ()):
+        self.date = date
+        self.votes: dict[int, int] = {}
+        self.plus = 0
+        self.minus = 0
+        for user_id, vote in votes:
+            self.set(user_id, vote)
+
+    def get(self, user_id: int) -> int | None:
+        return self.votes.get(user_id)
+
+    def set(self, user_id: int, vote: int | None):
+        """Sets user vote, None removes it"""
+        previous = self.votes.pop(user_id, None)
+        if previous is not None:
+            self._count(previous, -1)
+        if vote is not None:
+            self.votes[user_id] = vote
+            self._count(vote, 1)
+
+    def _count(self, vote: int, delta: int):
+        if vote > 0:
+            self.plus += delta
+        else:
+            self.minus += delta
+
+
+class VoteStore:
+    """Votes of posts published within the last ``window`` seconds
+
+    Posts are added empty when published or loaded from the database on first use, from then
+    on every written vote is applied here too, so votes of recent posts can be read without
+    querying the database. Votes written while a post is being loaded are applied once it is
+    loaded. The store can be saved to a file on shutdown and restored from it on start.
+    """
+
+    # Magic and save time, then per post: message_id, date, vote count, user ids and votes
+    _SNAPSHOT_HEADER = struct.Struct("<8sd")
+    _SNAPSHOT_MAGIC = b"VOTES\x00\x00\x01"
+    _POST_HEADER = struct.Struct("<qdI")
+
+    def __init__(self, window: float):
+        self.window = window
+        self._posts: dict[int, PostVotes] = {}
+        self._loading: dict[int, list[tuple[int, int | None]]] = {}
+        self._evicted_at = time.time()
+        self.hits = 0
+        self.loads = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def is_recent(self, date: float) -> bool:
+        return self.enabled and date > time.time() - self.window
+
+    def get(self, message_id: int) -> PostVotes | None:
+        votes = self._posts.get(message_id)
+        if votes is None:
+            return None
+        if not self.is_recent(votes.date):
+            del self._posts[message_id]
+            return None
+        self.hits += 1
+        return votes
+
+    def message_ids(self) -> list[int]:
+        """Posts whose votes are stored"""
+        return [message_id for message_id, votes in self._posts.items() if self.is_recent(votes.date)]
+
+    def is_loading(self, message_id: int) -> bool:
+        return message_id in self._loading
+
+    def add(self, message_id: int, date: float, votes: Iterable[tuple[int, int]] = ()) -> PostVotes:
+        """Adds post with all its votes"""
+        post_votes = self._posts[message_id] = PostVotes(date, votes)
+        self._evict()
+        return post_votes
+
+    def begin_load(self, message_id: int):
+        self._loading[message_id] = []
+
+    def finish_load(self, message_id: int, date: float, votes: Iterable[tuple[int, int]]) -> PostVotes:
+        """Adds loaded post and applies votes written since its loading began"""
+        post_votes = self.add(message_id, date, votes)
+        for user_id, vote in self._loading.pop(message_id, ()):
+            post_votes.set(user_id, vote)
+        self.loads += 1
+        return post_votes
+
+    def abort_load(self, message_id: int):
+        self._loading.pop(message_id, None)
+
+    def set_vote(self, message_id: int, user_id: int, vote: int | None):
+        """Applies a vote written to the database, does nothing if post is not stored"""
+        if message_id in self._loading:
+            self._loading[message_id].append((user_id, vote))
+        elif (post_votes := self._posts.get(message_id)) is not None:
+            post_votes.set(user_id, vote)
+
+    def _evict(self):
+        now = time.time()
+        if now - self._evicted_at < 60:
+            return
+        self._evicted_at = now
+        self._posts = {
+            message_id: votes for message_id, votes in self._posts.items() if self.is_recent(votes.date)
+        }
+
+    def save(self, path: Path):
+        """Writes posts to path, written to a temporary file first so it is never partial"""
+        chunks = [self._SNAPSHOT_HEADER.pack(self._SNAPSHOT_MAGIC, time.time())]
+        for message_id, post_votes in self._posts.items():
+            if not self.is_recent(post_votes.date):
+                continue
+            chunks.append(self._POST_HEADER.pack(message_id, post_votes.date, len(post_votes.votes)))
+            chunks.append(array("q", post_votes.votes.keys()).tobytes())
+            chunks.append(array("b", post_votes.votes.values()).tobytes())
+
+        temporary = path.with_name(path.name + ".tmp")
+        temporary.write_bytes(zlib.compress(b"".join(chunks), 1))
+        temporary.replace(path)
+
+    def load(self, path: Path) -> int:
+        """Adds posts saved to path that are still recent, returns their number
+
+        Raises ValueError if the file is not a snapshot.
+        """
+        data = zlib.decompress(path.read_bytes())
+        magic, _ = self._SNAPSHOT_HEADER.unpack_from(data)
+        if magic != self._SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a vote snapshot")
+
+        loaded = 0
+        offset = self._SNAPSHOT_HEADER.size
+        while offset < len(data):
+            message_id, date, count = self._POST_HEADER.unpack_from(data, offset)
+            offset += self._POST_HEADER.size
+            users = array("q", data[offset:offset + count * 8])
+            offset += count * 8
+            votes = array("b", data[offset:offset + count])
+            offset += count
+            if self.is_recent(date):
+                self.add(message_id, date, zip(users, votes))
+                loaded += 1
+        return loaded
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "posts": len(self._posts),
+            "votes": sum(len(post_votes.votes) for post_votes in self._posts.values()),
+            "hits": self.hits,
+            "loads": self.loads,
+        }
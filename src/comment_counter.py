@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Callable
+
+import db
+from models import Post
+
+logger = logging.getLogger(__name__)
+
+
+class CommentCounter:
+    """Write-behind buffer of comment counts
+
+    Comments are counted per thread in memory and written with one set-based update every
+    ``interval`` seconds, or as soon as ``max_pending`` comments are buffered. ``on_flush``
+    receives the updated posts. Pending counts are written on stop, so at most ``max_pending``
+    comments or ``interval`` seconds of them are lost if the process crashes.
+    """
+
+    def __init__(self, interval: float, max_pending: int, on_flush: Callable[[list[Post]], None]):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.on_flush = on_flush
+        self._pending: Counter[int] = Counter()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def add(self, thread_id: int):
+        self._pending[thread_id] += 1
+        if self._pending.total() >= self.max_pending:
+            self._full.set()
+
+    @property
+    def backlog(self) -> int:
+        return self._pending.total()
+
+    async def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the loop and writes pending counts"""
+        if self._task is not None:
+            # Not cancelled, so a write in progress is never interrupted
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, Counter()
+        try:
+            posts = await db.increase_comments_counters(pending)
+        except Exception:
+            # Put counts back to retry with the next flush
+            self._pending.update(pending)
+            raise
+
+        self.on_flush(posts)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write comment counters")
@@ -9,6 +9,37 @@ BEST_CHANNEL_TOPIC_MESSAGE_ID = os.getenv("TELEGRAM_BEST_CHANNEL_TOPIC_MESSAGE_I
 COMMENTS_GROUP_ID = os.getenv("TELEGRAM_COMMENTS_GROUP_ID")
 COMMENTS_GROUP_TAG = os.getenv("TELEGRAM_COMMENTS_GROUP_TAG")
 
+# How updates are received: "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Public HTTPS URL Telegram sends updates to in webhook mode, its path is served by the bot
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Secret Telegram sends with every update in webhook mode
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+# Address of the HTTP server serving health checks and the webhook
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", 8080))
+# Serve Prometheus metrics on /metrics and collect them, switched off to save the overhead
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+
+# Log file, written by a background thread along with the console
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "text" or "json", one object per line with fields passed to loggers in extra
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# The log file is rotated at this time if set, e.g. "midnight" or "h", otherwise once it grows over max bytes
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 50 * 1024 * 1024))
+# Number of rotated log files kept
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+# Share of comments logged, from 0 to 1
+LOG_COMMENT_SAMPLE_RATE = float(os.getenv("LOG_COMMENT_SAMPLE_RATE", 1))
+
+# Posts of this many last hours are loaded in one query on start, before updates are consumed, 0 disables it
+WARMUP_HOURS = float(os.getenv("WARMUP_HOURS", 24))
+
+# Apply pending database migrations when the bot starts
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "false").lower() == "true"
+
 MAX_USER_POST_COUNT_PER_DAY = int(os.getenv("MAX_USER_POST_COUNT_PER_DAY", 5))
 
 POPULAR_POSITIVE_VOTES_PERCENTAGE = int(os.getenv("POPULAR_POSITIVE_VOTES_PERCENTAGE", 80))
@@ -16,6 +47,50 @@ POPULAR_POSITIVE_VOTES_MIN_COUNT = int(os.getenv("POPULAR_POSITIVE_VOTES_MIN_COU
 BEST_POSITIVE_VOTES_PERCENTAGE = int(os.getenv("BEST_POSITIVE_VOTES_PERCENTAGE", 60))
 BEST_POSITIVE_VOTES_MIN_COUNT = int(os.getenv("BEST_POSITIVE_VOTES_MIN_COUNT", 80))
 BEST_COMMENT_MIN_COUNT = int(os.getenv("BEST_COMMENT_MIN_COUNT", 5))
+# Posts are checked for promotion to popular and best every this many seconds, in batches of this size
+PROMOTION_INTERVAL = float(os.getenv("PROMOTION_INTERVAL", 5))
+PROMOTION_BATCH_SIZE = int(os.getenv("PROMOTION_BATCH_SIZE", 100))
+# Posts of this many last hours are checked for promotion on start, 0 disables the check
+PROMOTION_SWEEP_HOURS = float(os.getenv("PROMOTION_SWEEP_HOURS", 48))
+
+# Posts are published and promoted by this many outbox workers, a worker owns a job for lease seconds
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", 60))
+# Seconds between checks for jobs enqueued by other processes or due for a retry
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+# Failed jobs are retried with exponential backoff this many times
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+# Seconds finished jobs are kept, the same post or promotion is not enqueued twice meanwhile
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", 24 * 60 * 60))
+
+# Updates processed at the same time, updates of one post or from one user still go one by one
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+# Votes a user can cast on one post per second, and in a burst
+VOTE_POST_RATE = float(os.getenv("VOTE_POST_RATE", 0.5))
+VOTE_POST_BURST = float(os.getenv("VOTE_POST_BURST", 5))
+# Votes a user can cast on all posts per second, and in a burst
+VOTE_USER_RATE = float(os.getenv("VOTE_USER_RATE", 3))
+VOTE_USER_BURST = float(os.getenv("VOTE_USER_BURST", 30))
+
+# Minimal interval in seconds between two keyboard edits of the same message
+KEYBOARD_UPDATE_INTERVAL = float(os.getenv("KEYBOARD_UPDATE_INTERVAL", 1))
+
+# Album items are published together once no new item arrived for this many seconds,
+# but no later than ALBUM_MAX_WAIT seconds after the first one
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 1))
+ALBUM_MAX_WAIT = float(os.getenv("ALBUM_MAX_WAIT", 5))
+
+# Comment counters are written every this many seconds or once this many comments are buffered
+COMMENT_FLUSH_INTERVAL = float(os.getenv("COMMENT_FLUSH_INTERVAL", 5))
+COMMENT_FLUSH_MAX_PENDING = int(os.getenv("COMMENT_FLUSH_MAX_PENDING", 100))
+
+# Bot API rate limits: requests per second overall, per minute to a group or channel,
+# per second to a private chat
+TELEGRAM_OVERALL_RATE_LIMIT = int(os.getenv("TELEGRAM_OVERALL_RATE_LIMIT", 30))
+TELEGRAM_GROUP_RATE_LIMIT = int(os.getenv("TELEGRAM_GROUP_RATE_LIMIT", 20))
+TELEGRAM_PRIVATE_RATE_LIMIT = int(os.getenv("TELEGRAM_PRIVATE_RATE_LIMIT", 1))
+# How many times a request is retried after flood control or a network error
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
 
 _default_welcome_text = """
 Добро пожаловать в бот канала Капибара Новое! 
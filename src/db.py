@@ -1,197 +1,526 @@
+import asyncio
+import json
+import logging
 import os
-from typing import Optional
+import time
+import uuid
+from datetime import timezone
+from pathlib import Path
+
+import backends
+import metrics
+from backends import Backend, ReplicaSet
+from backends.base import Connection, Params, Row
+from cache import PostCache, PostQuota, PostVotes, VoteStore
+from models import ButtonValues, OutboxJob, Post
+
+logger = logging.getLogger(__name__)
+
+# Votes are stored as smallint
+VOTE_VALUES = {ButtonValues.POSITIVE_VOTE: 1, ButtonValues.NEGATIVE_VOTE: -1}
+VOTE_BUTTONS = {value: button for button, value in VOTE_VALUES.items()}
+
+
+def connection_params() -> dict[str, str]:
+    return {
+        "dbname": os.getenv('DB_NAME', default="main"),
+        "user": os.getenv('DB_USER', default="postgres"),
+        "password": os.getenv('DB_PASSWORD', default=""),
+        "host": os.getenv('DB_HOST', default="localhost"),
+        "port": os.getenv('DB_PORT', default="5432"),
+    }
+
+
+def replica_params(address: str) -> dict[str, str]:
+    """Connection params of a replica at "host" or "host:port", the rest are the primary ones"""
+    host, _, port = address.partition(":")
+    params = connection_params()
+    params["host"] = host
+    if port:
+        params["port"] = port
+    return params
+
+
+# Database driver: aiopg, or asyncpg for prepared statements and the binary protocol
+DB_BACKEND = os.getenv('DB_BACKEND', default="aiopg")
+POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', default=1))
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', default=10))
+# Seconds to wait for a free connection (also used as connect and query timeout)
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', default=10))
+# Seconds after which an idle connection is closed and reopened, -1 disables recycling
+POOL_RECYCLE = float(os.getenv('DB_POOL_RECYCLE', default=-1))
+# Connections idle for longer than this many seconds are pinged before use (aiopg only)
+POOL_HEALTHCHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTHCHECK_INTERVAL', default=30))
+
+# Comma separated "host" or "host:port" of read replicas, reads go to the primary without them
+REPLICA_HOSTS = [address.strip() for address in os.getenv('DB_REPLICA_HOSTS', default="").split(",") if address.strip()]
+# Seconds reads of a just written post or user go to the primary, keep above the replication lag
+REPLICA_STICKY_SECONDS = float(os.getenv('DB_REPLICA_STICKY_SECONDS', default=5))
+# Seconds a replica that failed with a connection error is skipped for
+REPLICA_RETRY_SECONDS = float(os.getenv('DB_REPLICA_RETRY_SECONDS', default=30))
+
+# Number of posts kept in memory, 0 disables the cache
+POST_CACHE_SIZE = int(os.getenv('POST_CACHE_SIZE', default=10000))
+# Seconds after which a cached post is fetched from the database again
+POST_CACHE_TTL = float(os.getenv('POST_CACHE_TTL', default=3600))
+
+# Number of users whose recent post times are kept in memory for quota checks, 0 disables it
+POST_QUOTA_CACHE_SIZE = int(os.getenv('POST_QUOTA_CACHE_SIZE', default=10000))
+
+post_cache = PostCache(max_size=POST_CACHE_SIZE, ttl=POST_CACHE_TTL)
+# Votes of posts younger than this many seconds are kept in memory, 0 disables it
+VOTE_STORE_WINDOW = float(os.getenv('VOTE_STORE_WINDOW', default=2 * 24 * 60 * 60))
+# File votes kept in memory are saved to on shutdown and restored from on start
+VOTE_STORE_SNAPSHOT = Path(os.getenv('VOTE_STORE_SNAPSHOT', default="votes.snapshot"))
+
+post_quota = PostQuota(max_users=POST_QUOTA_CACHE_SIZE, window=24 * 60 * 60)
+vote_store = VoteStore(window=VOTE_STORE_WINDOW)
+
+
+def create_backend(name: str = DB_BACKEND, params: dict[str, str] | None = None) -> Backend:
+    return backends.create_backend(
+        name,
+        params or connection_params(),
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        timeout=POOL_TIMEOUT,
+        recycle=POOL_RECYCLE,
+        healthcheck_interval=POOL_HEALTHCHECK_INTERVAL,
+    )
+
+
+# Process-wide connection pool, connects on first use
+backend = create_backend()
+# Replica pools for reads that may lag behind, also connect on first use
+replicas = ReplicaSet(
+    [create_backend(params=replica_params(address)) for address in REPLICA_HOSTS],
+    sticky_for=REPLICA_STICKY_SECONDS,
+    retry_after=REPLICA_RETRY_SECONDS,
+)
+
+
+def post_key(message_id: int) -> tuple[str, int]:
+    return "post", message_id
+
+
+def user_key(user_id: int) -> tuple[str, int]:
+    return "user", user_id
+
+
+async def _read(method: str, stmt: str, params: Params, keys: tuple, retry_missing: bool):
+    replica = replicas.choose(keys)
+    if replica is not None:
+        try:
+            result = await getattr(replica, method)(stmt, params)
+        except replica.connection_errors as e:
+            replicas.failed(replica, e)
+        else:
+            if result or not retry_missing:
+                return result
+            replicas.missed()
+    return await getattr(backend, method)(stmt, params)
+
+
+async def read_row(stmt: str, params: Params, *keys, retry_missing: bool = False) -> Row | None:
+    """Reads row from a replica unless rows of keys were just written or replicas are down
+
+    With retry_missing, a row missing on the replica is read from the primary, for lookups
+    of rows that may have been added moments ago by another key.
+    """
+    return await _read("fetchrow", stmt, params, keys, retry_missing)
+
+
+async def read_rows(stmt: str, params: Params, *keys) -> list[Row]:
+    """Reads rows from a replica like read_row"""
+    return await _read("fetch", stmt, params, keys, False)
+
+
+async def connect():
+    """Opens the primary and replica pools, so the first updates don't wait for connections"""
+    await backend.connect()
+    await replicas.connect()
+
+
+@metrics.query
+async def warm_up(hours: float) -> int:
+    """Loads posts of the last ``hours`` with one query, returns their number
+
+    Fills the post cache with them along with their ratings and comment counts, votes kept
+    in memory with votes of recent ones and, when a whole day is loaded, daily post counts
+    of their authors. Read from the primary, like votes loaded on demand. Votes of posts
+    already in memory, restored from the snapshot, are not aggregated again.
+    """
+
+    stored = set(vote_store.message_ids())
+
+    stmt = """
+    SELECT p.message_id, p.user_id, p.date, p.comment_thread_id, p.comment_count, p.popular_id, p.best_id,
+    p.media_group, p.plus_count, p.minus_count, extract(epoch FROM now() - p.date) AS age, v.user_ids, v.votes
+    FROM posts p
+    LEFT JOIN LATERAL (
+        -- Post date selects the partition
+        SELECT array_agg(user_id) AS user_ids, array_agg(vote) AS votes FROM votes
+        WHERE message_id = p.message_id AND post_date = p.date
+    ) v ON p.date > now() - %(vote_window)s::float8 * interval '1 second' AND p.message_id <> ALL(%(stored)s::bigint[])
+    WHERE p.date > now() - %(hours)s::float8 * interval '1 hour' AND p.date <= now()
+    ORDER BY p.date;
+    """
+
+    params = {
+        "hours": hours,
+        "vote_window": VOTE_STORE_WINDOW,
+        "stored": list(stored),
+    }
+
+    result = await backend.fetch(stmt, params)
+
+    ages: dict[int, list[float]] = {}
+    for row in result:
+        row = dict(row)
+        age, user_ids, votes = float(row.pop("age")), row.pop("user_ids"), row.pop("votes")
+        post = Post(**row)
+        # Oldest first, so the newest posts are the last to be evicted
+        post_cache.put(post)
+        if vote_store.is_recent(post_timestamp(post)) and post["message_id"] not in stored:
+            vote_store.add(post["message_id"], post_timestamp(post), zip(user_ids or (), votes or ()))
+        if age < 24 * 60 * 60:
+            ages.setdefault(post["user_id"], []).append(age)
+
+    if hours >= 24 and post_quota.enabled:
+        stmt = """
+        SELECT author_id, extract(epoch FROM now() - created_at) FROM outbox
+        WHERE author_id IS NOT NULL AND finished_at IS NULL AND state->'post' IS NULL
+          AND created_at > now() - interval '1' DAY;
+        """
+        for user_id, age in await backend.fetch(stmt):
+            ages.setdefault(user_id, []).append(float(age))
+        for user_id, user_ages in ages.items():
+            post_quota.load(user_id, user_ages)
+
+    return len(result)
+
+
+async def restore_votes():
+    """Restores votes kept in memory from the snapshot saved on shutdown
+
+    The snapshot is removed once read: votes written after a later crash would be missing
+    from it, so it is only ever used right after a clean shutdown.
+    """
 
-import aiopg
-from psycopg2.extras import DictCursor
+    if not vote_store.enabled or not VOTE_STORE_SNAPSHOT.exists():
+        return
 
-from models import Post
+    try:
+        loaded = await asyncio.to_thread(vote_store.load, VOTE_STORE_SNAPSHOT)
+        logger.info("Restored votes of %s posts from %s", loaded, VOTE_STORE_SNAPSHOT)
+    except (OSError, ValueError, EOFError) as e:
+        logger.warning("Failed to restore votes from %s, loading them on demand: %s", VOTE_STORE_SNAPSHOT, e)
+    finally:
+        VOTE_STORE_SNAPSHOT.unlink(missing_ok=True)
 
 
-def build_dsn():
-    dbname = os.getenv('DB_NAME', default="main")
-    user = os.getenv('DB_USER', default="postgres")
-    password = os.getenv('DB_PASSWORD', default="")
-    host = os.getenv('DB_HOST', default="localhost")
-    port = os.getenv('DB_PORT', default="5432")
-    return f"dbname={dbname} user={user} password={password} host={host} port={port}"
+async def save_votes():
+    """Saves votes kept in memory, call once no more votes are written"""
 
+    if not vote_store.enabled:
+        return
 
-class ConnectionManager:
-    _instance: Optional['ConnectionManager'] = None
-    _connection: aiopg.Connection | None = None
+    await asyncio.to_thread(vote_store.save, VOTE_STORE_SNAPSHOT)
+    logger.info("Saved votes to %s", VOTE_STORE_SNAPSHOT)
 
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls, *args, **kwargs)
-        return cls._instance
 
-    @property
-    def connected(self) -> bool:
-        return self._connection is not None and not self._connection.closed
+def post_timestamp(post: Post) -> float:
+    """Unix time of post date, which is stored without time zone in the database one (UTC by default)"""
+    date = post["date"]
+    return (date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)).timestamp()
 
-    async def connection(self) -> aiopg.Connection:
-        return await self.__aenter__()
 
-    async def __aenter__(self) -> aiopg.Connection:
-        if not self.connected:
-            self._connection = await aiopg.connect(build_dsn(), cursor_factory=DictCursor)
+async def get_recent_votes(message_id: int) -> PostVotes | None:
+    """Votes of a recent post kept in memory, loaded on first use, None for older posts"""
 
-        return self._connection
+    if not vote_store.enabled:
+        return None
+
+    votes = vote_store.get(message_id)
+    if votes is not None or vote_store.is_loading(message_id):
+        return votes
+
+    # Marked before the first await, so concurrent callers don't start loading it again and
+    # votes written meanwhile are applied once it is loaded
+    vote_store.begin_load(message_id)
+    try:
+        post = await get_post(message_id)
+        if post is None or not vote_store.is_recent(post_timestamp(post)):
+            vote_store.abort_load(message_id)
+            return None
+
+        stmt = """
+        SELECT user_id, vote FROM votes WHERE message_id = %(message_id)s AND post_date = %(post_date)s;
+        """
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.connected:
-            await self._connection.close()
+        params = {
+            "message_id": message_id,
+            "post_date": post["date"],
+        }
 
+        # From the primary, votes stay in memory for the post's lifetime and must not be stale
+        result = await backend.fetch(stmt, params)
+    except BaseException:
+        vote_store.abort_load(message_id)
+        raise
 
-async def get_user_vote(message_id: int | str, user_id: int | str) -> str | None:
+    return vote_store.finish_load(message_id, post_timestamp(post), ((row[0], row[1]) for row in result))
+
+
+@metrics.query
+async def get_user_vote(message_id: int, user_id: int) -> str | None:
+    votes = await get_recent_votes(message_id)
+    if votes is not None:
+        vote = votes.get(user_id)
+        return VOTE_BUTTONS[vote] if vote is not None else None
+
+    post = await get_post(message_id)
+    if post is None:
+        return None
+
+    # Post date selects the partition
     stmt = """
-    SELECT vote FROM votes WHERE (message_id, user_id) = (%(message_id)s, %(user_id)s);
+    SELECT vote FROM votes WHERE (message_id, user_id, post_date) = (%(message_id)s, %(user_id)s, %(post_date)s);
     """
     params = {
-        "message_id": str(message_id),
-        "user_id": str(user_id)
+        "message_id": message_id,
+        "user_id": user_id,
+        "post_date": post["date"],
     }
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchone()
+    result = await read_row(stmt, params, post_key(message_id))
 
-    return result[0] if result else None
+    return VOTE_BUTTONS[result[0]] if result else None
 
 
-async def set_user_vote(message_id: int | str, user_id: int | str, vote: str) -> bool:
-    current_vote = await get_user_vote(message_id, user_id)
-    if current_vote is None:
-        stmt = """
-        INSERT INTO votes (message_id, user_id, vote) VALUES (%(message_id)s, %(user_id)s, %(vote)s);
-        """
-    elif vote != current_vote:
-        stmt = """
-        DELETE FROM votes WHERE (message_id, user_id) = (%(message_id)s, %(user_id)s);
-        """
-    else:
-        return False
+@metrics.query
+async def set_user_vote(message_id: int, user_id: int, vote: str) -> tuple[bool, int, int]:
+    """Toggles user vote and returns whether it changed along with the new rating
+
+    A vote is added when the user has none and removed when the opposite button is pressed,
+    pressing the same button again does nothing. Vote counters on the post are updated
+    in the same statement. Votes of recent posts are also kept in memory, which answers
+    repeated presses of the same button without a query. Posts whose votes were archived
+    can't be voted on anymore.
+    """
+
+    votes = await get_recent_votes(message_id)
+    if votes is not None and votes.get(user_id) == VOTE_VALUES[vote]:
+        return False, votes.plus, votes.minus
+
+    post = await get_post(message_id)
+    if post is None:
+        return False, 0, 0
+
+    stmt = """
+    WITH inserted AS (
+        INSERT INTO votes (message_id, user_id, vote, post_date)
+        SELECT %(message_id)s::bigint, %(user_id)s::bigint, %(vote)s::smallint, %(post_date)s::timestamp
+        WHERE NOT EXISTS (SELECT FROM posts WHERE message_id = %(message_id)s AND votes_archived)
+        ON CONFLICT (message_id, user_id, post_date) DO NOTHING
+        RETURNING vote
+    ), deleted AS (
+        DELETE FROM votes
+        WHERE (message_id, user_id, post_date) = (%(message_id)s, %(user_id)s, %(post_date)s) AND vote <> %(vote)s
+        RETURNING vote
+    ), deltas AS (
+        SELECT
+            coalesce(sum(delta) FILTER (WHERE vote = 1), 0) AS plus,
+            coalesce(sum(delta) FILTER (WHERE vote = -1), 0) AS minus
+        FROM (
+            SELECT vote, 1 AS delta FROM inserted
+            UNION ALL
+            SELECT vote, -1 AS delta FROM deleted
+        ) AS changes
+    ), updated AS (
+        UPDATE posts SET plus_count = plus_count + deltas.plus, minus_count = minus_count + deltas.minus
+        FROM deltas
+        WHERE message_id = %(message_id)s AND (EXISTS (SELECT FROM inserted) OR EXISTS (SELECT FROM deleted))
+        RETURNING plus_count, minus_count
+    )
+    SELECT
+        EXISTS (SELECT FROM inserted) OR EXISTS (SELECT FROM deleted) AS changed,
+        coalesce(updated.plus_count, posts.plus_count, 0) AS plus,
+        coalesce(updated.minus_count, posts.minus_count, 0) AS minus,
+        CASE WHEN EXISTS (SELECT FROM deleted) THEN NULL ELSE %(vote)s END AS vote
+    FROM (SELECT) AS one
+    LEFT JOIN updated ON true
+    LEFT JOIN posts ON posts.message_id = %(message_id)s;
+    """
 
     params = {
-        "message_id": str(message_id),
-        "user_id": str(user_id),
-        "vote": vote
+        "message_id": message_id,
+        "user_id": user_id,
+        "vote": VOTE_VALUES[vote],
+        "post_date": post["date"],
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
+    changed, plus, minus, user_vote = await backend.fetchrow(stmt, params)
 
-    return True
+    post_cache.update(message_id, plus_count=plus, minus_count=minus)
+    if changed:
+        replicas.written(post_key(message_id))
+        vote_store.set_vote(message_id, user_id, user_vote)
+    return changed, plus, minus
 
 
-async def get_rating(message_id: int | str) -> tuple[int, int]:
+@metrics.query
+async def get_rating(message_id: int) -> tuple[int, int]:
+    votes = await get_recent_votes(message_id)
+    if votes is not None:
+        return votes.plus, votes.minus
+
     stmt = """
-    SELECT vote, COUNT(vote) FROM votes WHERE message_id = %(message_id)s GROUP BY vote;
+    SELECT plus_count, minus_count FROM posts WHERE message_id = %(message_id)s;
     """
 
     params = {
-        "message_id": str(message_id),
+        "message_id": message_id,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchall()
-    
-    result = dict(result)
-    return result.get("+", 0), result.get("-", 0)
+    result = await read_row(stmt, params, post_key(message_id))
+
+    return (result[0], result[1]) if result else (0, 0)
 
 
+@metrics.query
 async def add_post(
-        message_id: int | str,
-        user_id: int | str,
-        thread_id: int | str,
-        media_group: str | None = None
-):
-    """Save post information"""
+        message_id: int,
+        user_id: int,
+        thread_id: int,
+        media_group: str | None = None,
+        job: OutboxJob | None = None,
+) -> Post:
+    """Save post information
+
+    A post published by an outbox job is saved together with the job state, so a retried job
+    doesn't save it twice. It was counted towards the daily limit when the job was enqueued.
+    """
 
     stmt = """
     INSERT INTO posts (message_id, user_id, date, comment_thread_id, media_group) 
-    VALUES (%(message_id)s, %(user_id)s, now(), %(thread_id)s, %(media_group)s);
+    VALUES (%(message_id)s, %(user_id)s, now(), %(thread_id)s, %(media_group)s)
+    RETURNING message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group,
+        plus_count, minus_count;
     """
 
     params = {
-        "message_id": str(message_id),
-        "user_id": str(user_id),
-        "thread_id": str(thread_id),
+        "message_id": message_id,
+        "user_id": user_id,
+        "thread_id": thread_id,
         "media_group": media_group
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-
-
-async def get_post(message_id: int | str) -> Post:
+    if job is None:
+        result = await backend.fetchrow(stmt, params)
+        post_quota.add(user_id)
+    else:
+        async with backend.connection() as conn, conn.transaction():
+            result = await conn.fetchrow(stmt, params)
+            job["state"]["post"] = message_id
+            await _save_job_state(conn, job)
+
+    post = Post(**result)
+    replicas.written(post_key(message_id), user_key(user_id))
+    post_cache.put(post)
+    # Just published, so it's recent whatever time zone the database is in
+    if vote_store.enabled:
+        vote_store.add(message_id, time.time())
+    return post
+
+
+@metrics.query
+async def get_post(message_id: int) -> Post:
     """Fetch post"""
 
+    post = post_cache.get("message_id", message_id)
+    if post is not None:
+        return post
+
     stmt = """
-    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group
+    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group,
+    plus_count, minus_count
     FROM posts WHERE message_id = %(message_id)s;
     """
 
     params = {
-        "message_id": str(message_id),
+        "message_id": message_id,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchone()
+    result = await read_row(stmt, params, post_key(message_id), retry_missing=True)
 
-    return Post(**result) if result else None
+    post = Post(**result) if result else None
+    if post is not None:
+        post_cache.put(post)
+    return post
 
 
-async def get_post_by_popular_id(popular_id: int | str) -> Post:
+@metrics.query
+async def get_post_by_popular_id(popular_id: int) -> Post:
     """Fetch post by popular_id"""
 
+    post = post_cache.get("popular_id", popular_id)
+    if post is not None:
+        return post
+
     stmt = """
-    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group
+    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group,
+    plus_count, minus_count
     FROM posts WHERE popular_id = %(popular_id)s;
     """
 
     params = {
-        "popular_id": str(popular_id),
+        "popular_id": popular_id,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchone()
+    result = await read_row(stmt, params, retry_missing=True)
 
-    return Post(**result) if result else None
+    post = Post(**result) if result else None
+    if post is not None:
+        post_cache.put(post)
+    return post
 
-async def get_post_by_best_id(best_id: int | str) -> Post:
+@metrics.query
+async def get_post_by_best_id(best_id: int) -> Post:
     """Fetch post by best_id"""
 
+    post = post_cache.get("best_id", best_id)
+    if post is not None:
+        return post
+
     stmt = """
-    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group
+    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group,
+    plus_count, minus_count
     FROM posts WHERE best_id = %(best_id)s;
     """
 
     params = {
-        "best_id": str(best_id),
+        "best_id": best_id,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchone()
+    result = await read_row(stmt, params, retry_missing=True)
 
-    return Post(**result) if result else None
+    post = Post(**result) if result else None
+    if post is not None:
+        post_cache.put(post)
+    return post
 
 
+@metrics.query
 async def get_post_by_media_group(media_group: str) -> Post:
     """Fetch post by group_id"""
 
+    post = post_cache.get("media_group", media_group)
+    if post is not None:
+        return post
+
     stmt = """
-    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group
+    SELECT message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group,
+    plus_count, minus_count
     FROM posts WHERE media_group = %(media_group)s;
     """
 
@@ -199,75 +528,400 @@ async def get_post_by_media_group(media_group: str) -> Post:
         "media_group": media_group,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchone()
+    result = await read_row(stmt, params, retry_missing=True)
+
+    post = Post(**result) if result else None
+    if post is not None:
+        post_cache.put(post)
+    return post
+
+
+@metrics.query
+async def increase_comments_counters(counts: dict[int, int]) -> list[Post]:
+    """Increases comment counters of posts by thread id"""
+
+    stmt = """
+    UPDATE posts SET comment_count = posts.comment_count + counts.count
+    FROM unnest(%(thread_ids)s::bigint[], %(counts)s::integer[]) AS counts (thread_id, count)
+    WHERE posts.comment_thread_id = counts.thread_id
+    RETURNING posts.message_id, posts.user_id, posts.date, posts.comment_thread_id, posts.comment_count,
+        posts.popular_id, posts.best_id, posts.media_group, posts.plus_count, posts.minus_count;
+    """
+
+    # Sorted, so concurrent updates lock rows in the same order
+    thread_ids = sorted(counts)
+    params = {
+        "thread_ids": thread_ids,
+        "counts": [counts[thread_id] for thread_id in thread_ids],
+    }
+
+    result = await backend.fetch(stmt, params)
+
+    posts = [Post(**row) for row in result]
+    replicas.written(*(post_key(post["message_id"]) for post in posts))
+    for post in posts:
+        post_cache.put(post)
+    return posts
 
-    return Post(**result) if result else None
 
+@metrics.query
+async def get_post_count_for_user(user_id: int) -> int:
+    """Fetch post count for last 24 hours, posts still being published by outbox jobs included"""
 
-async def increase_comments_counter(thread_id: int | str) -> Post:
-    """Increases comments counter by 1"""
+    count = post_quota.count(user_id)
+    if count is not None:
+        return count
 
     stmt = """
-    UPDATE posts SET comment_count = comment_count + 1 WHERE comment_thread_id = %(thread_id)s
-    RETURNING message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group;
+    SELECT extract(epoch FROM now() - date) FROM posts
+    WHERE user_id = %(user_id)s AND date > now() - interval '1' DAY AND date <= now()
+    UNION ALL
+    SELECT extract(epoch FROM now() - created_at) FROM outbox
+    WHERE author_id = %(user_id)s AND finished_at IS NULL AND state->'post' IS NULL
+      AND created_at > now() - interval '1' DAY;
     """
 
     params = {
-        "thread_id": str(thread_id),
+        "user_id": user_id,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchone()
+    result = await read_rows(stmt, params, user_key(user_id))
 
-    return Post(**result) if result else None
+    post_quota.load(user_id, (float(age) for age, in result))
+    return len(result)
 
 
-async def get_post_count_for_user(user_id: int | str) -> int:
-    """Fetch post count for last 24 hours"""
+@metrics.query
+async def add_to_popular(message_id: int, popular_id: int, job: OutboxJob | None = None) -> bool:
+    """Records popular copy of post, returns False if post already has one
 
-    stmt = "SELECT posts_count FROM posts_count_for_last_day WHERE user_id = %(user_id)s"
+    The state of the outbox job that made the copy is saved in the same transaction.
+    """
+
+    stmt = """
+    UPDATE posts SET popular_id = %(popular_id)s WHERE message_id = %(message_id)s AND popular_id IS NULL;
+    """
 
     params = {
-        "user_id": str(user_id),
+        "message_id": message_id,
+        "popular_id": popular_id,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
-        result = await cur.fetchone()
+    if job is None:
+        updated = await backend.execute(stmt, params) > 0
+    else:
+        async with backend.connection() as conn, conn.transaction():
+            updated = await conn.execute(stmt, params) > 0
+            job["state"]["recorded"] = updated
+            await _save_job_state(conn, job)
 
-    return result[0] if result else 0
+    if updated:
+        replicas.written(post_key(message_id))
+        post_cache.update(message_id, popular_id=popular_id)
+    return updated
 
 
-async def add_to_popular(message_id: int | str, popular_id: int | str):
+@metrics.query
+async def add_to_best(message_id: int, best_id: int, job: OutboxJob | None = None) -> bool:
+    """Records best copy of post, returns False if post already has one
+
+    The state of the outbox job that made the copy is saved in the same transaction.
+    """
+
     stmt = """
-    UPDATE posts SET popular_id = %(popular_id)s WHERE message_id = %(message_id)s;
+    UPDATE posts SET best_id = %(best_id)s WHERE message_id = %(message_id)s AND best_id IS NULL;
     """
 
     params = {
-        "message_id": str(message_id),
-        "popular_id": str(popular_id),
+        "message_id": message_id,
+        "best_id": best_id,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
+    if job is None:
+        updated = await backend.execute(stmt, params) > 0
+    else:
+        async with backend.connection() as conn, conn.transaction():
+            updated = await conn.execute(stmt, params) > 0
+            job["state"]["recorded"] = updated
+            await _save_job_state(conn, job)
+
+    if updated:
+        replicas.written(post_key(message_id))
+        post_cache.update(message_id, best_id=best_id)
+    return updated
+
+
+@metrics.query
+async def get_promotion_candidates(
+        message_ids: list[int] | None,
+        popular_thresholds: tuple[int, int],
+        best_thresholds: tuple[int, int, int],
+        after_message_id: int = 0,
+        limit: int = 100,
+        hours: float | None = None,
+) -> list[tuple[Post, bool, bool]]:
+    """Fetch posts that crossed popular or best thresholds but were not promoted there yet
+
+    Thresholds are (positive votes percentage, positive votes count) for popular and
+    the same plus comment count for best. Only given posts are checked, posts of the last
+    ``hours`` if message_ids is None, all posts if both are None. Returns tuples of (post, goes to popular, goes to best) ordered
+    by message_id, use after_message_id to fetch the next batch.
+    """
+
+    stmt = """
+    SELECT * FROM (
+        SELECT
+            message_id, user_id, date, comment_thread_id, comment_count, popular_id, best_id, media_group,
+            plus_count, minus_count,
+            popular_id IS NULL
+                AND plus_count * 100.0 / nullif(plus_count + minus_count, 0) > %(popular_percentage)s::integer
+                AND plus_count >= %(popular_min_count)s::integer AS to_popular,
+            best_id IS NULL
+                AND plus_count * 100.0 / nullif(plus_count + minus_count, 0) > %(best_percentage)s::integer
+                AND plus_count >= %(best_min_count)s::integer
+                AND comment_count > %(best_comment_min_count)s::integer AS to_best
+        FROM posts
+        WHERE (%(message_ids)s::bigint[] IS NULL OR message_id = ANY(%(message_ids)s::bigint[]))
+          AND (%(hours)s::float8 IS NULL OR date > now() - %(hours)s::float8 * interval '1 hour')
+          AND message_id > %(after_message_id)s
+          AND (popular_id IS NULL OR best_id IS NULL)
+    ) AS posts
+    WHERE to_popular OR to_best
+    ORDER BY message_id
+    LIMIT %(limit)s;
+    """
+
+    params = {
+        "message_ids": message_ids,
+        "popular_percentage": popular_thresholds[0],
+        "popular_min_count": popular_thresholds[1],
+        "best_percentage": best_thresholds[0],
+        "best_min_count": best_thresholds[1],
+        "best_comment_min_count": best_thresholds[2],
+        "after_message_id": after_message_id,
+        "limit": limit,
+        "hours": hours,
+    }
+
+    # From the primary, counters on a lagging replica would delay promotions until the next mark
+    result = await backend.fetch(stmt, params)
+
+    candidates = []
+    for row in result:
+        row = dict(row)
+        to_popular, to_best = row.pop("to_popular"), row.pop("to_best")
+        candidates.append((Post(**row), bool(to_popular), bool(to_best)))
+    return candidates
+
+
+@metrics.query
+async def get_inconsistent_vote_counters() -> list[tuple[int, int, int, int, int]]:
+    """Fetch posts whose vote counters differ from actual votes
+
+    Returns tuples of (message_id, plus_count, minus_count, actual plus, actual minus).
+    """
+
+    stmt = """
+    SELECT posts.message_id, posts.plus_count, posts.minus_count, counters.plus, counters.minus
+    FROM posts
+    CROSS JOIN LATERAL (
+        SELECT
+            count(*) FILTER (WHERE vote = 1) AS plus,
+            count(*) FILTER (WHERE vote = -1) AS minus
+        FROM votes WHERE votes.message_id = posts.message_id AND votes.post_date = posts.date
+    ) AS counters
+    WHERE NOT posts.votes_archived
+      AND (posts.plus_count, posts.minus_count) <> (counters.plus, counters.minus)
+    ORDER BY posts.date;
+    """
+
+    result = await backend.fetch(stmt)
+
+    return [tuple(row) for row in result]
+
+
+@metrics.query
+async def fix_vote_counters() -> int:
+    """Recount vote counters from votes, returns number of fixed posts"""
+
+    stmt = """
+    UPDATE posts SET plus_count = counters.plus, minus_count = counters.minus
+    FROM posts AS p
+    CROSS JOIN LATERAL (
+        SELECT
+            count(*) FILTER (WHERE vote = 1) AS plus,
+            count(*) FILTER (WHERE vote = -1) AS minus
+        FROM votes WHERE votes.message_id = p.message_id AND votes.post_date = p.date
+    ) AS counters
+    WHERE posts.message_id = p.message_id
+      AND NOT p.votes_archived
+      AND (p.plus_count, p.minus_count) <> (counters.plus, counters.minus);
+    """
+
+    return await backend.execute(stmt)
+
+
+class JobLeaseLost(Exception):
+    """Outbox job was taken over by another worker after its lease had expired"""
+
+
+def _job(row: Row) -> OutboxJob:
+    return OutboxJob(
+        id=row[0], kind=row[1], payload=json.loads(row[2]), state=json.loads(row[3]), attempts=row[4],
+        lease_token=row[5],
+    )
+
+
+@metrics.query
+async def enqueue_job(kind: str, idempotency_key: str, payload: dict, author_id: int | None = None) -> bool:
+    """Writes a job to the outbox, returns False if one with the same key was enqueued before
+
+    Jobs with an author publish a post, they count towards the author's daily limit.
+    """
+
+    stmt = """
+    INSERT INTO outbox (kind, idempotency_key, payload, author_id)
+    VALUES (%(kind)s, %(idempotency_key)s, %(payload)s::jsonb, %(author_id)s::bigint)
+    ON CONFLICT (idempotency_key) DO NOTHING;
+    """
+
+    params = {
+        "kind": kind,
+        "idempotency_key": idempotency_key,
+        "payload": json.dumps(payload),
+        "author_id": author_id,
+    }
+
+    inserted = await backend.execute(stmt, params) > 0
+
+    if inserted and author_id is not None:
+        replicas.written(user_key(author_id))
+        post_quota.add(author_id)
+    return inserted
+
+
+@metrics.query
+async def claim_job(lease: float) -> OutboxJob | None:
+    """Takes the job due first for ``lease`` seconds, None if there is none"""
+
+    # Jobs taken by other workers are skipped rather than waited for
+    stmt = """
+    UPDATE outbox SET
+        lease_token = %(lease_token)s,
+        locked_until = now() + make_interval(secs => %(lease)s::double precision),
+        attempts = attempts + 1
+    WHERE id = (
+        SELECT id FROM outbox
+        WHERE finished_at IS NULL AND run_at <= now() AND (locked_until IS NULL OR locked_until < now())
+        ORDER BY run_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, payload::text, state::text, attempts, lease_token;
+    """
+
+    params = {
+        "lease_token": uuid.uuid4().hex,
+        "lease": lease,
+    }
+
+    result = await backend.fetchrow(stmt, params)
+
+    return _job(result) if result else None
+
+
+async def _save_job_state(conn: Connection, job: OutboxJob):
+    stmt = """
+    UPDATE outbox SET state = %(state)s::jsonb WHERE id = %(id)s AND lease_token = %(lease_token)s;
+    """
+
+    params = {
+        "id": job["id"],
+        "lease_token": job["lease_token"],
+        "state": json.dumps(job["state"]),
+    }
+
+    if await conn.execute(stmt, params) == 0:
+        raise JobLeaseLost(f"Lost lease of outbox job {job['id']}")
+
+
+@metrics.query
+async def save_job_state(job: OutboxJob):
+    """Saves results of the job steps done so far, raises JobLeaseLost if another worker took it over"""
+    async with backend.connection() as conn:
+        await _save_job_state(conn, job)
+
+
+@metrics.query
+async def extend_job_lease(job: OutboxJob, lease: float):
+    """Renews the job lease for ``lease`` seconds from now, raises JobLeaseLost if another worker took it over"""
+
+    stmt = """
+    UPDATE outbox SET locked_until = now() + make_interval(secs => %(lease)s::double precision)
+    WHERE id = %(id)s AND lease_token = %(lease_token)s;
+    """
+
+    params = {
+        "id": job["id"],
+        "lease_token": job["lease_token"],
+        "lease": lease,
+    }
+
+    if await backend.execute(stmt, params) == 0:
+        raise JobLeaseLost(f"Lost lease of outbox job {job['id']}")
+
+
+@metrics.query
+async def finish_job(job: OutboxJob, error: str | None = None):
+    """Marks job as done, or as failed for good if there is an error"""
+
+    stmt = """
+    UPDATE outbox SET
+        finished_at = now(), failed = %(failed)s, last_error = %(error)s, lease_token = NULL, locked_until = NULL
+    WHERE id = %(id)s AND lease_token = %(lease_token)s;
+    """
+
+    params = {
+        "id": job["id"],
+        "lease_token": job["lease_token"],
+        "failed": error is not None,
+        "error": error,
+    }
+
+    await backend.execute(stmt, params)
+
+
+@metrics.query
+async def retry_job(job: OutboxJob, delay: float, error: str):
+    """Releases job to be run again in ``delay`` seconds"""
+
+    stmt = """
+    UPDATE outbox SET
+        run_at = now() + make_interval(secs => %(delay)s::double precision), last_error = %(error)s,
+        lease_token = NULL, locked_until = NULL
+    WHERE id = %(id)s AND lease_token = %(lease_token)s;
+    """
+
+    params = {
+        "id": job["id"],
+        "lease_token": job["lease_token"],
+        "delay": delay,
+        "error": error,
+    }
+
+    await backend.execute(stmt, params)
+
+
+@metrics.query
+async def delete_finished_jobs(older_than: float) -> int:
+    """Deletes jobs finished more than ``older_than`` seconds ago, their keys can be enqueued again"""
 
-async def add_to_best(message_id: int | str, best_id: int | str):
     stmt = """
-    UPDATE posts SET best_id = %(best_id)s WHERE message_id = %(message_id)s;
+    DELETE FROM outbox WHERE finished_at < now() - make_interval(secs => %(older_than)s::double precision);
     """
 
     params = {
-        "message_id": str(message_id),
-        "best_id": str(best_id),
+        "older_than": older_than,
     }
 
-    conn = await ConnectionManager().connection()
-    async with conn.cursor() as cur:
-        await cur.execute(stmt, params)
+    return await backend.execute(stmt, params)
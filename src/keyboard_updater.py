@@ -0,0 +1,150 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from models import PostKeyboard
+
+logger = logging.getLogger(__name__)
+
+
+class KeyboardUpdater:
+    """Coalesces inline keyboard edits of posts
+
+    Handlers schedule the latest keyboard of a message and return right away. Every message
+    is edited at most once per ``interval`` seconds, a burst of votes or comments in between
+    collapses into a single edit carrying the keyboard scheduled last.
+
+    Keyboards last sent to the ``max_tracked`` most recently edited messages are remembered,
+    a keyboard equal to the one a message already shows is not sent again, e.g. after a +1
+    and a -1 from different users.
+    """
+
+    def __init__(self, interval: float, max_tracked: int = 10000):
+        self.interval = interval
+        self.max_tracked = max_tracked
+        self._bot: Bot | None = None
+        self._dirty: dict[tuple[str, int], PostKeyboard] = {}
+        self._last_edit: dict[tuple[str, int], float] = {}
+        self._shown: OrderedDict[tuple[str, int], tuple] = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self._sent = 0
+        self._coalesced = 0
+        self._unchanged = 0
+
+    def schedule(self, chat_id: str, message_id: int | str, keyboard: PostKeyboard):
+        """Marks message keyboard as dirty, replaces previously scheduled keyboard"""
+        key = (chat_id, int(message_id))
+        if key in self._dirty:
+            self._coalesced += 1
+        if self._shown.get(key) == keyboard.key:
+            # Back to what the message shows, an edit scheduled before is not needed either
+            self._unchanged += 1
+            self._dirty.pop(key, None)
+            return
+        self._dirty[key] = keyboard
+        self._wakeup.set()
+
+    def shown(self, chat_id: str, message_id: int | str, keyboard: PostKeyboard):
+        """Records keyboard a message was sent or edited with outside of the updater"""
+        key = (chat_id, int(message_id))
+        self._shown[key] = keyboard.key
+        self._shown.move_to_end(key)
+        while len(self._shown) > self.max_tracked:
+            self._shown.popitem(last=False)
+
+    @property
+    def backlog(self) -> int:
+        return len(self._dirty)
+
+    async def start(self, bot: Bot):
+        self._bot = bot
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the loop once edits it sends are done, then sends all pending edits
+
+        The loop is not cancelled, keyboards it took for an edit would be lost.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                logger.exception("Keyboard updater loop failed")
+            self._task = None
+
+        pending, self._dirty = self._dirty, {}
+        await asyncio.gather(*(self._edit(key, keyboard) for key, keyboard in pending.items()))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self._dirty and not self._stopping:
+                now = loop.time()
+                self._last_edit = {
+                    key: edited for key, edited in self._last_edit.items() if now - edited < self.interval
+                }
+                due = [key for key in self._dirty if key not in self._last_edit]
+                if not due:
+                    # Woken early by stop, or by a schedule that is looked at again
+                    try:
+                        await asyncio.wait_for(
+                            self._wakeup.wait(), min(self._last_edit[key] for key in self._dirty) + self.interval - now
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    continue
+
+                for key in due:
+                    self._last_edit[key] = now
+                await asyncio.gather(*(self._edit(key, self._dirty.pop(key)) for key in due))
+
+    async def _edit(self, key: tuple[str, int], keyboard: PostKeyboard):
+        chat_id, message_id = key
+        if self._shown.get(key) == keyboard.key:
+            self._unchanged += 1
+            return
+        try:
+            await self._bot.edit_message_reply_markup(
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=keyboard.to_reply_markup(),
+            )
+            self._sent += 1
+            self.shown(chat_id, message_id, keyboard)
+        except RetryAfter as e:
+            logger.warning(
+                "Flood control on keyboard edit of %s in %s, retry in %ss", message_id, chat_id, e.retry_after
+            )
+            self._last_edit[key] = asyncio.get_running_loop().time() + e.retry_after
+            # Newer keyboard may have been scheduled meanwhile, it wins
+            self._dirty.setdefault(key, keyboard)
+        except BadRequest as e:
+            if "not modified" in e.message:
+                self.shown(chat_id, message_id, keyboard)
+            else:
+                logger.error("Failed to edit keyboard of %s in %s: %s", message_id, chat_id, e)
+        except TelegramError as e:
+            logger.error("Failed to edit keyboard of %s in %s: %s", message_id, chat_id, e)
+
+    def stats(self) -> dict[str, int]:
+        """Edits sent and saved, by coalescing scheduled keyboards or skipping unchanged ones"""
+        return {
+            "sent": self._sent,
+            "coalesced": self._coalesced,
+            "unchanged": self._unchanged,
+            "saved": self._coalesced + self._unchanged,
+            "pending": len(self._dirty),
+            "tracked": len(self._shown),
+        }
@@ -0,0 +1,109 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s | [%(name)s] %(message)s"
+
+# Attributes every record has, the rest were passed with ``extra`` and go to JSON as fields
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, fields passed with ``extra`` included"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((name, value) for name, value in vars(record).items() if name not in _RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Passes only a share of records of high volume loggers, e.g. ``{"app.comments": 0.1}``
+
+    Warnings and errors always pass.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.name)
+        if rate is None or rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class _QueueHandler(QueueHandler):
+    """Hands records to the listener thread with the message and traceback rendered
+
+    Arguments may change once the handler returns, so the message is rendered here, but the
+    formatting of the whole line is left to the listener. Unlike ``QueueHandler`` the
+    traceback is kept apart from the message, so JSON has it in its own field.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(
+        file: str,
+        level: str = "INFO",
+        json_format: bool = False,
+        max_bytes: int = 0,
+        rotate_when: str = "",
+        backup_count: int = 0,
+        sample_rates: dict[str, float] | None = None,
+) -> QueueListener:
+    """Sends records of the root logger to the file and console through a queue
+
+    Handlers only put records to the queue, a listener thread formats and writes them, so a
+    slow disk doesn't stall the event loop. The file is rotated at ``rotate_when`` (e.g.
+    ``midnight``) if set, otherwise once it grows over ``max_bytes``, 0 never rotates it.
+    The listener is stopped and the queue drained at exit.
+    """
+    if rotate_when:
+        file_handler = TimedRotatingFileHandler(file, when=rotate_when, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    console_handler = logging.StreamHandler()
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    logging.getLogger("httpx").setLevel(logging.ERROR)
+
+    listener = QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
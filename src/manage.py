@@ -0,0 +1,86 @@
+"""Maintenance commands
+
+Usage: python manage.py <command> [options]
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+import db
+import partitions
+from migrate import migrate
+
+logger = logging.getLogger(__name__)
+
+
+async def check_counters(args: argparse.Namespace) -> int:
+    """Compares vote counters on posts with actual votes"""
+
+    mismatches = await db.get_inconsistent_vote_counters()
+    for message_id, plus_count, minus_count, plus, minus in mismatches:
+        logger.warning(
+            "Post %s has counters +%s/-%s, actual votes +%s/-%s", message_id, plus_count, minus_count, plus, minus
+        )
+
+    if mismatches and args.fix:
+        fixed = await db.fix_vote_counters()
+        logger.info("Fixed vote counters on %s posts", fixed)
+        return 0
+
+    logger.info("Found %s posts with inconsistent vote counters", len(mismatches))
+    return 1 if mismatches else 0
+
+
+async def apply_migrations(_: argparse.Namespace) -> int:
+    """Applies pending database migrations"""
+
+    applied = await migrate()
+    if not applied:
+        logger.info("Database is up to date")
+    return 0
+
+
+async def maintain_votes(args: argparse.Namespace) -> int:
+    """Creates upcoming vote partitions and archives votes past retention"""
+
+    await partitions.create_partitions()
+    archived = await partitions.archive_partitions(drop=args.drop)
+    if not archived:
+        logger.info("No vote partitions to archive")
+    return 0
+
+
+async def run(args: argparse.Namespace) -> int:
+    try:
+        return await args.command(args)
+    finally:
+        await db.backend.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Bot maintenance commands")
+    subparsers = parser.add_subparsers(required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="apply pending database migrations")
+    migrate_parser.set_defaults(command=apply_migrations)
+
+    check_counters_parser = subparsers.add_parser(
+        "check-counters", help="compare vote counters on posts with actual votes"
+    )
+    check_counters_parser.add_argument("--fix", action="store_true", help="recount inconsistent counters")
+    check_counters_parser.set_defaults(command=check_counters)
+
+    maintain_votes_parser = subparsers.add_parser(
+        "maintain-votes", help="create upcoming vote partitions and archive votes past retention"
+    )
+    maintain_votes_parser.add_argument("--drop", action="store_true", help="drop archived partitions")
+    maintain_votes_parser.set_defaults(command=maintain_votes)
+
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(levelname)s | [%(name)s] %(message)s", level=logging.INFO)
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import asyncio
+import functools
+import time
+from contextlib import nullcontext
+from typing import Awaitable, Callable, TypeVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from config import METRICS_ENABLED
+
+F = TypeVar("F", bound=Callable[..., Awaitable])
+
+REGISTRY = CollectorRegistry()
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Time spent in update handlers", ["handler"], registry=REGISTRY
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Exceptions raised by update handlers", ["handler"], registry=REGISTRY
+)
+DB_QUERY_LATENCY = Histogram(
+    "bot_db_query_duration_seconds",
+    "Time spent in database functions, including waiting for a connection",
+    ["function"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+    registry=REGISTRY,
+)
+DB_QUERY_ERRORS = Counter(
+    "bot_db_query_errors_total", "Exceptions raised by database functions", ["function"], registry=REGISTRY
+)
+BOT_API_LATENCY = Histogram(
+    "bot_api_request_duration_seconds",
+    "Bot API request time by method, waiting for rate limits excluded",
+    ["method"],
+    registry=REGISTRY,
+)
+BOT_API_REQUESTS = Counter(
+    "bot_api_requests_total",
+    "Bot API requests by method and result: ok, retry_after, bad_request, network_error or error",
+    ["method", "result"],
+    registry=REGISTRY,
+)
+BOT_API_FLOOD_WAIT = Counter(
+    "bot_api_flood_wait_seconds_total", "Seconds Telegram asked to wait with 429 responses", ["method"],
+    registry=REGISTRY,
+)
+VOTES_DROPPED = Counter(
+    "bot_votes_dropped_total",
+    "Vote clicks answered without processing: rejected by rate limits or merged into a waiting click",
+    ["reason"],
+    registry=REGISTRY,
+)
+BACKLOG = Gauge("bot_backlog", "Items waiting to be processed by queue", ["queue"], registry=REGISTRY)
+EVENT_LOOP_LAG = Gauge(
+    "bot_event_loop_lag_seconds", "How late the last event loop lag probe woke up", registry=REGISTRY
+)
+
+
+def _timed(histogram: Histogram, errors: Counter, label: str, func: F) -> F:
+    latency = histogram.labels(label)
+    failures = errors.labels(label)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            failures.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def handler(func: F) -> F:
+    """Records latency of an update handler, the function is returned as is when metrics are disabled"""
+    if not METRICS_ENABLED:
+        return func
+    return _timed(HANDLER_LATENCY, HANDLER_ERRORS, func.__name__, func)
+
+
+def query(func: F) -> F:
+    """Records latency of a database function, the function is returned as is when metrics are disabled"""
+    if not METRICS_ENABLED:
+        return func
+    return _timed(DB_QUERY_LATENCY, DB_QUERY_ERRORS, func.__name__, func)
+
+
+class _BotApiCall:
+    __slots__ = ("method", "started")
+
+    def __init__(self, method: str):
+        self.method = method
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, traceback):
+        BOT_API_LATENCY.labels(self.method).observe(time.perf_counter() - self.started)
+        if exc is None:
+            result = "ok"
+        elif isinstance(exc, RetryAfter):
+            result = "retry_after"
+            BOT_API_FLOOD_WAIT.labels(self.method).inc(exc.retry_after)
+        elif isinstance(exc, BadRequest):
+            result = "bad_request"
+        elif isinstance(exc, NetworkError):
+            result = "network_error"
+        else:
+            result = "error"
+        BOT_API_REQUESTS.labels(self.method, result).inc()
+
+
+def bot_api_call(method: str):
+    """Context manager recording latency and result of one Bot API request"""
+    if not METRICS_ENABLED:
+        return nullcontext()
+    return _BotApiCall(method)
+
+
+def track_backlog(queue: str, size: Callable[[], int]):
+    """Reports size() as backlog of queue whenever metrics are scraped"""
+    if METRICS_ENABLED:
+        BACKLOG.labels(queue).set_function(size)
+
+
+def render() -> tuple[bytes, str]:
+    """Metrics in Prometheus text format and their content type"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class LoopLagMonitor:
+    """Measures how late a sleeping task wakes up, which is how long callbacks block the event loop"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if METRICS_ENABLED:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.set(max(loop.time() - expected, 0))
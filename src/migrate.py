@@ -0,0 +1,121 @@
+import logging
+import os
+import re
+from pathlib import Path
+
+import db
+from backends import Connection
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(os.getenv(
+    'MIGRATIONS_DIR', default=Path(__file__).resolve().parent.parent / "migrations"
+))
+
+# Seconds a migration statement may run, backfills and index builds take longer than queries
+MIGRATION_TIMEOUT = float(os.getenv('DB_MIGRATION_TIMEOUT', default=6 * 60 * 60))
+
+# Arbitrary key of the advisory lock held while migrations are applied
+MIGRATIONS_LOCK_ID = 7_001_001
+
+# First line of migrations run statement by statement outside a transaction, see migrate
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+_migration_file_pattern = re.compile(r"^(\d+)\..+\.sql$")
+# Tokens a statement separator can't be inside of: strings, quoted names, dollar quotes and comments
+_sql_token = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|(\$\w*\$)|--[^\n]*|/\*.*?\*/|;", re.DOTALL)
+
+
+def get_migrations() -> list[tuple[int, Path]]:
+    """Migration files sorted by version, version is the number prefix of file name"""
+    migrations = []
+    for path in MIGRATIONS_DIR.iterdir():
+        match = _migration_file_pattern.match(path.name)
+        if match:
+            migrations.append((int(match.group(1)), path))
+    return sorted(migrations)
+
+
+def split_statements(sql: str) -> list[str]:
+    """Splits SQL into statements at semicolons outside of strings, dollar quotes and comments"""
+    statements = []
+    start = position = 0
+    while match := _sql_token.search(sql, position):
+        position = match.end()
+        if match.group(1) is not None:
+            # Dollar quoted body, e.g. of a DO block, ends with the same tag
+            end = sql.find(match.group(1), position)
+            position = len(sql) if end < 0 else end + len(match.group(1))
+        elif match.group() == ";":
+            statements.append(sql[start:position])
+            start = position
+    statements.append(sql[start:])
+    return [statement.strip() for statement in statements if _has_code(statement)]
+
+
+def _has_code(statement: str) -> bool:
+    return bool(_sql_token.sub(lambda match: match.group() if match.group(1) else "", statement).strip(" \n;"))
+
+
+async def migrate() -> list[int]:
+    """Applies pending migrations, returns applied versions
+
+    Every migration runs in its own transaction, unless its first line is
+    ``NO_TRANSACTION_MARKER``: such migrations run statement by statement, so they can build
+    indexes concurrently, backfill in batches committed one by one (a ``DO`` block with
+    ``COMMIT``) and take short explicit ``BEGIN``/``COMMIT`` transactions. They must be safe to
+    run again from the start after failing midway, and record their version in the same
+    transaction as their last change.
+
+    The database version is the highest one recorded in the migrations table, a database
+    without that table is considered empty. An advisory lock makes concurrently started
+    instances wait for each other.
+    """
+
+    applied = []
+    async with db.backend.connection() as conn:
+        await conn.execute("SELECT pg_advisory_lock(%(lock_id)s)", {"lock_id": MIGRATIONS_LOCK_ID})
+        try:
+            current_version = await get_current_version(conn)
+            for version, path in get_migrations():
+                if version <= current_version:
+                    continue
+
+                logger.info("Applying migration %s", path.name)
+                sql = path.read_text()
+                if sql.startswith(NO_TRANSACTION_MARKER):
+                    for statement in split_statements(sql):
+                        await conn.execute(statement, timeout=MIGRATION_TIMEOUT)
+                    await record_version(conn, version)
+                else:
+                    async with conn.transaction():
+                        await conn.execute(sql, timeout=MIGRATION_TIMEOUT)
+                        await record_version(conn, version)
+                applied.append(version)
+        finally:
+            # Drops settings a failed migration left on the connection, along with the lock
+            await conn.execute("ROLLBACK")
+            await conn.execute("RESET ALL")
+            await conn.execute("SELECT pg_advisory_unlock(%(lock_id)s)", {"lock_id": MIGRATIONS_LOCK_ID})
+
+    if applied:
+        logger.info("Database migrated to version %s", applied[-1])
+    return applied
+
+
+async def get_current_version(conn: Connection) -> int:
+    if not await conn.fetchval("SELECT to_regclass('migrations') IS NOT NULL"):
+        return 0
+    return await conn.fetchval("SELECT coalesce(max(version), 0) FROM migrations")
+
+
+async def record_version(conn: Connection, version: int):
+    """Records version unless the migration did it itself"""
+    if not await conn.fetchval("SELECT to_regclass('migrations') IS NOT NULL"):
+        return
+
+    stmt = """
+    INSERT INTO migrations (version) SELECT %(version)s::integer
+    WHERE NOT EXISTS (SELECT FROM migrations WHERE version >= %(version)s);
+    """
+    await conn.execute(stmt, {"version": version})
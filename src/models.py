@@ -1,6 +1,7 @@
 import enum
+import functools
 from datetime import datetime
-from typing import TypedDict
+from typing import Any, TypedDict
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
@@ -14,14 +15,25 @@ class ButtonValues(enum.StrEnum):
 
 
 class Post(TypedDict):
-    message_id: str
-    user_id: str
+    message_id: int
+    user_id: int
     date: datetime
-    comment_thread_id: str
+    comment_thread_id: int
     comment_count: int
-    popular_id: str
-    best_id: str
-    media_group: str
+    popular_id: int | None
+    best_id: int | None
+    media_group: str | None
+    plus_count: int
+    minus_count: int
+
+
+class OutboxJob(TypedDict):
+    id: int
+    kind: str
+    payload: dict[str, Any]
+    state: dict[str, Any]
+    attempts: int
+    lease_token: str
 
 
 class PostKeyboard:
@@ -31,22 +43,33 @@ class PostKeyboard:
             *,
             rating: int = 0,
             comment_count: int = 0,
-            thread_id: int | str = None
+            thread_id: int | None = None
     ):
         self.rating = rating
         self.comment_count = comment_count
         self.thread_id = thread_id
 
+    @property
+    def key(self) -> tuple[int, int, int | None]:
+        """Everything the markup depends on, keyboards with equal keys render the same"""
+        return self.rating, self.comment_count, self.thread_id
+
     def to_reply_markup(self) -> InlineKeyboardMarkup:
-        keyboad = [
-            [
-                InlineKeyboardButton("👍", callback_data=ButtonValues.POSITIVE_VOTE),
-                InlineKeyboardButton(f"{self.rating:+0d}", callback_data=ButtonValues.RATING),
-                InlineKeyboardButton("👎", callback_data=ButtonValues.NEGATIVE_VOTE)
-            ],
-        ]
-        if self.thread_id is not None:
-            url = f"https://t.me/{COMMENTS_GROUP_TAG.removeprefix('@')}/{self.thread_id}/{self.thread_id}"
-            text = "Комментарии 💬" if self.comment_count == 0 else f"Комментарии ({self.comment_count}) 💬"
-            keyboad.append([InlineKeyboardButton(text=text, url=url)])
-        return InlineKeyboardMarkup(keyboad)
+        return _render_reply_markup(*self.key)
+
+
+# Markup objects are immutable, so the same one is shared by all keyboards with equal keys
+@functools.lru_cache(maxsize=4096)
+def _render_reply_markup(rating: int, comment_count: int, thread_id: int | None) -> InlineKeyboardMarkup:
+    keyboad = [
+        [
+            InlineKeyboardButton("👍", callback_data=ButtonValues.POSITIVE_VOTE),
+            InlineKeyboardButton(f"{rating:+0d}", callback_data=ButtonValues.RATING),
+            InlineKeyboardButton("👎", callback_data=ButtonValues.NEGATIVE_VOTE)
+        ],
+    ]
+    if thread_id is not None:
+        url = f"https://t.me/{COMMENTS_GROUP_TAG.removeprefix('@')}/{thread_id}/{thread_id}"
+        text = "Комментарии 💬" if comment_count == 0 else f"Комментарии ({comment_count}) 💬"
+        keyboad.append([InlineKeyboardButton(text=text, url=url)])
+    return InlineKeyboardMarkup(keyboad)
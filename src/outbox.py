@@ -0,0 +1,216 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from telegram import Bot
+from telegram.error import BadRequest
+
+import db
+from models import OutboxJob
+
+logger = logging.getLogger(__name__)
+
+JobRunner = Callable[[OutboxJob, Bot], Awaitable[None]]
+
+
+class Outbox:
+    """Runs Bot API calls written to the outbox table with a pool of ``workers``
+
+    Handlers enqueue a job with its idempotency key and return, a job enqueued twice with one
+    key is run once. Workers take due jobs with ``SELECT ... FOR UPDATE SKIP LOCKED`` for
+    ``lease`` seconds and renew the lease every third of it while the job runs, e.g. waits for
+    the rate limiter, so only a job of a crashed or stuck worker is taken over once its lease
+    expires.
+
+    A job is a sequence of steps, see ``step``: result of every Bot API call is saved before
+    the next one, so a retried job continues where it failed instead of sending everything
+    again. Failed jobs are retried with exponential backoff up to ``max_attempts`` times,
+    ``BadRequest`` fails them right away. Finished jobs are deleted after ``retention``
+    seconds, their keys can be enqueued again afterwards.
+    """
+
+    def __init__(
+            self,
+            workers: int,
+            lease: float,
+            poll_interval: float,
+            max_attempts: int,
+            retention: float,
+    ):
+        self.workers = workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._runners: dict[str, JobRunner] = {}
+        self._bot: Bot | None = None
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks: list[asyncio.Task] = []
+        self._purge_task: asyncio.Task | None = None
+        self._running = 0
+        self._enqueued = 0
+        self._duplicates = 0
+        self._done = 0
+        self._retried = 0
+        self._failed = 0
+
+    def register(self, kind: str, runner: JobRunner):
+        self._runners[kind] = runner
+
+    async def enqueue(
+            self,
+            kind: str,
+            idempotency_key: str,
+            payload: dict[str, Any],
+            author_id: int | None = None,
+    ) -> bool:
+        """Writes job to the outbox, returns False if its key was enqueued before"""
+        if await db.enqueue_job(kind, idempotency_key, payload, author_id):
+            self._enqueued += 1
+            self._wakeup.set()
+            return True
+        self._duplicates += 1
+        return False
+
+    @staticmethod
+    async def step(job: OutboxJob, name: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs call once per job and returns its result, which must be JSON serializable
+
+        The result is saved to the job state, a retried job gets it without calling again.
+        """
+        if name in job["state"]:
+            return job["state"][name]
+
+        result = await call()
+        job["state"][name] = result
+        await db.save_job_state(job)
+        return result
+
+    @property
+    def backlog(self) -> int:
+        return self._running
+
+    async def start(self, bot: Bot):
+        self._bot = bot
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._purge_task = asyncio.create_task(self._purge())
+
+    async def stop(self, timeout: float = 10):
+        """Lets workers run jobs that are due already, for up to ``timeout`` seconds
+
+        Jobs left are run after the next start.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            self._purge_task = None
+        if not self._tasks:
+            return
+
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self):
+        while True:
+            try:
+                job = await db.claim_job(self.lease)
+            except Exception as e:
+                logger.error("Failed to claim outbox job: %s", e)
+                job = None
+
+            if job is None:
+                if self._stopping:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            self._running += 1
+            try:
+                await self._run(job)
+            except Exception as e:
+                # Job result could not be written, it is run again once the lease expires
+                logger.error("Failed to finish outbox job %s: %s", job["id"], e)
+            finally:
+                self._running -= 1
+
+    async def _run(self, job: OutboxJob):
+        runner = self._runners.get(job["kind"])
+        try:
+            if runner is None:
+                raise ValueError(f"Unknown outbox job kind {job['kind']!r}")
+            await self._run_leased(runner, job)
+        except db.JobLeaseLost as e:
+            logger.warning("%s, it is run by another worker now", e)
+            return
+        except (BadRequest, ValueError) as e:
+            logger.error("Outbox job %s (%s) failed: %r", job["id"], job["kind"], e)
+            self._failed += 1
+            await db.finish_job(job, error=repr(e))
+            return
+        except Exception as e:
+            if job["attempts"] >= self.max_attempts:
+                logger.error(
+                    "Outbox job %s (%s) failed %s times, giving up: %r", job["id"], job["kind"], job["attempts"], e
+                )
+                self._failed += 1
+                await db.finish_job(job, error=repr(e))
+                return
+            delay = min(2 ** job["attempts"], 300)
+            logger.warning("Outbox job %s (%s) failed, retry in %ss: %r", job["id"], job["kind"], delay, e)
+            self._retried += 1
+            await db.retry_job(job, delay, repr(e))
+            return
+
+        self._done += 1
+        await db.finish_job(job)
+
+    async def _run_leased(self, runner: JobRunner, job: OutboxJob):
+        """Runs job renewing its lease, cancels it and raises JobLeaseLost if the lease is lost"""
+        run = asyncio.ensure_future(runner(job, self._bot))
+        try:
+            while True:
+                done, _ = await asyncio.wait({run}, timeout=self.lease / 3)
+                if done:
+                    return run.result()
+                try:
+                    await db.extend_job_lease(job, self.lease)
+                except db.JobLeaseLost:
+                    raise
+                except Exception as e:
+                    # The lease is still held for a while, renewing is tried again
+                    logger.warning("Failed to renew lease of outbox job %s: %s", job["id"], e)
+        finally:
+            if not run.done():
+                run.cancel()
+                await asyncio.gather(run, return_exceptions=True)
+
+    async def _purge(self):
+        while True:
+            try:
+                deleted = await db.delete_finished_jobs(self.retention)
+                if deleted:
+                    logger.info("Deleted %s finished outbox jobs", deleted)
+            except Exception as e:
+                logger.error("Failed to delete finished outbox jobs: %s", e)
+            await asyncio.sleep(min(self.retention, 3600))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "enqueued": self._enqueued,
+            "duplicates": self._duplicates,
+            "done": self._done,
+            "retried": self._retried,
+            "failed": self._failed,
+        }
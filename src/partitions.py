@@ -0,0 +1,140 @@
+import logging
+import os
+import re
+from datetime import datetime
+
+import db
+from backends import Connection
+
+logger = logging.getLogger(__name__)
+
+# Monthly partitions of votes are created this many months ahead
+VOTES_PARTITIONS_AHEAD = int(os.getenv('VOTES_PARTITIONS_AHEAD', default=2))
+# Votes of posts older than this many whole months are archived, 0 keeps all votes
+VOTES_RETENTION_MONTHS = int(os.getenv('VOTES_RETENTION_MONTHS', default=0))
+
+_partition_name_pattern = re.compile(r"^votes_(\d{4})(\d{2})$")
+
+
+def partition_name(month: datetime) -> str:
+    return f"votes_{month:%Y%m}"
+
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+async def is_partitioned(conn: Connection) -> bool:
+    """Whether votes are partitioned, i.e. migrations up to 012 were applied"""
+    return await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('votes')") or False
+
+
+async def get_partitions(conn: Connection) -> list[datetime]:
+    """First days of months that have a partition attached, sorted"""
+    stmt = """
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = 'votes'::regclass;
+    """
+    months = []
+    for (name,) in await conn.fetch(stmt):
+        match = _partition_name_pattern.match(name)
+        if match:
+            months.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+async def create_partitions(ahead: int = VOTES_PARTITIONS_AHEAD) -> list[str]:
+    """Creates partitions from the current month to ``ahead`` months later, returns their names
+
+    Votes that went to the default partition because their month had none are moved to
+    the new partition.
+    """
+
+    created = []
+    async with db.backend.connection() as conn:
+        if not await is_partitioned(conn):
+            logger.warning("Votes are not partitioned yet, apply migrations first")
+            return created
+
+        existing = set(await get_partitions(conn))
+        month = await conn.fetchval("SELECT date_trunc('month', localtimestamp)")
+        for _ in range(ahead + 1):
+            if month not in existing:
+                await create_partition(conn, month)
+                created.append(partition_name(month))
+            month = next_month(month)
+
+    for name in created:
+        logger.info("Created partition %s", name)
+    return created
+
+
+async def create_partition(conn: Connection, month: datetime):
+    name, start, end = partition_name(month), f"{month:%Y-%m-%d}", f"{next_month(month):%Y-%m-%d}"
+    # DDL takes no parameters, values come from datetime formatting only
+    async with conn.transaction():
+        await conn.execute(f"CREATE TABLE {name} (LIKE votes INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        await conn.execute(f"""
+        WITH moved AS (
+            DELETE FROM votes_default WHERE post_date >= '{start}' AND post_date < '{end}'
+            RETURNING message_id, user_id, vote, post_date, created_at
+        )
+        INSERT INTO {name} (message_id, user_id, vote, post_date, created_at) SELECT * FROM moved
+        """)
+        await conn.execute(f"ALTER TABLE votes ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+async def archive_partitions(retention_months: int = VOTES_RETENTION_MONTHS, drop: bool = False) -> list[str]:
+    """Archives votes of posts older than ``retention_months`` whole months, returns partition names
+
+    Vote counters of posts in an archived month are recounted from its votes one last time
+    and posts are marked as archived, so they can't be voted on anymore. The partition is
+    then detached and kept as a standalone table, or dropped if ``drop`` is set.
+    """
+
+    archived = []
+    if retention_months <= 0:
+        return archived
+
+    async with db.backend.connection() as conn:
+        if not await is_partitioned(conn):
+            logger.warning("Votes are not partitioned yet, apply migrations first")
+            return archived
+
+        cutoff = await conn.fetchval(
+            "SELECT date_trunc('month', localtimestamp) - make_interval(months => %(months)s::integer)",
+            {"months": retention_months},
+        )
+        for month in await get_partitions(conn):
+            if next_month(month) > cutoff:
+                break
+            await archive_partition(conn, month, drop)
+            archived.append(partition_name(month))
+
+    for name in archived:
+        logger.info("Archived partition %s", name)
+    return archived
+
+
+async def archive_partition(conn: Connection, month: datetime, drop: bool):
+    name, start, end = partition_name(month), f"{month:%Y-%m-%d}", f"{next_month(month):%Y-%m-%d}"
+    async with conn.transaction():
+        await conn.execute("SET LOCAL lock_timeout = '5s'")
+        await conn.execute(f"""
+        UPDATE posts SET plus_count = counters.plus, minus_count = counters.minus, votes_archived = true
+        FROM (
+            SELECT
+                posts.message_id,
+                count(votes.vote) FILTER (WHERE votes.vote = 1) AS plus,
+                count(votes.vote) FILTER (WHERE votes.vote = -1) AS minus
+            FROM posts
+            LEFT JOIN {name} AS votes ON votes.message_id = posts.message_id
+            WHERE posts.date >= '{start}' AND posts.date < '{end}' AND NOT posts.votes_archived
+            GROUP BY posts.message_id
+        ) AS counters
+        WHERE posts.message_id = counters.message_id
+        """)
+        await conn.execute(f"ALTER TABLE votes DETACH PARTITION {name}")
+        if drop:
+            await conn.execute(f"DROP TABLE {name}")
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+
+from telegram import Bot
+
+import db
+from config import (
+    CHAT_ID_NEW,
+    CHAT_ID_POPULAR,
+    CHAT_ID_BEST,
+    BEST_CHANNEL_TOPIC_MESSAGE_ID,
+    POPULAR_POSITIVE_VOTES_PERCENTAGE,
+    POPULAR_POSITIVE_VOTES_MIN_COUNT,
+    BEST_POSITIVE_VOTES_PERCENTAGE,
+    BEST_POSITIVE_VOTES_MIN_COUNT,
+    BEST_COMMENT_MIN_COUNT,
+)
+from keyboard_updater import KeyboardUpdater
+from models import OutboxJob, Post, PostKeyboard
+from outbox import Outbox
+from rate_limiter import Priority
+
+logger = logging.getLogger(__name__)
+
+
+class PromotionEngine:
+    """Copies posts that became popular or best to their channels
+
+    Handlers mark posts whose rating or comment count changed, every ``interval`` seconds
+    marked posts are checked against thresholds with one query and promoted in batches of
+    ``batch_size``. Posts of the last ``sweep_hours`` are checked once on start, so marks lost
+    across restarts are not missed; older posts rarely get votes, 0 disables the check.
+    Copies are made by outbox jobs, one per post and channel however often it is checked.
+
+    A post is a popular one when more than POPULAR_POSITIVE_VOTES_PERCENTAGE of votes are
+    positive and there are at least POPULAR_POSITIVE_VOTES_MIN_COUNT of them. Best posts
+    need BEST_* percentage and count of positive votes and more than BEST_COMMENT_MIN_COUNT
+    comments.
+    """
+
+    def __init__(
+            self,
+            interval: float,
+            batch_size: int,
+            sweep_hours: float,
+            outbox: Outbox,
+            keyboard_updater: KeyboardUpdater | None = None,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sweep_hours = sweep_hours
+        self.outbox = outbox
+        outbox.register("promote", self._run_job)
+        # Told about keyboards of copies, so votes that don't change them don't edit them
+        self.keyboard_updater = keyboard_updater
+        self._marked: set[int] = set()
+        self._task: asyncio.Task | None = None
+
+    def mark(self, message_id: int):
+        self._marked.add(message_id)
+
+    @property
+    def backlog(self) -> int:
+        return len(self._marked)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        message_ids = None if self.sweep_hours > 0 else []
+        while True:
+            try:
+                await self.promote(message_ids)
+            except Exception:
+                logger.exception("Failed to promote posts")
+                # Checked again on the next tick
+                if message_ids is not None:
+                    self._marked.update(message_ids)
+
+            await asyncio.sleep(self.interval)
+            message_ids, self._marked = sorted(self._marked), set()
+
+    async def promote(self, message_ids: list[int] | None):
+        """Promotes given posts that crossed thresholds, posts of the last ``sweep_hours`` if message_ids is None"""
+        if message_ids == []:
+            return
+
+        after_message_id = 0
+        while True:
+            candidates = await db.get_promotion_candidates(
+                message_ids,
+                popular_thresholds=(POPULAR_POSITIVE_VOTES_PERCENTAGE, POPULAR_POSITIVE_VOTES_MIN_COUNT),
+                best_thresholds=(BEST_POSITIVE_VOTES_PERCENTAGE, BEST_POSITIVE_VOTES_MIN_COUNT, BEST_COMMENT_MIN_COUNT),
+                after_message_id=after_message_id,
+                limit=self.batch_size,
+                hours=self.sweep_hours if message_ids is None else None,
+            )
+            for post, to_popular, to_best in candidates:
+                if to_popular:
+                    await self._promote(post, "popular")
+                if to_best:
+                    await self._promote(post, "best")
+
+            if len(candidates) < self.batch_size:
+                return
+            after_message_id = candidates[-1][0]["message_id"]
+
+    async def _promote(self, post: Post, channel: str):
+        """Enqueues copying post to popular or best channel"""
+        await self.outbox.enqueue(
+            "promote",
+            f"promote:{channel}:{post['message_id']}",
+            {"message_id": post["message_id"], "channel": channel},
+        )
+
+    async def _run_job(self, job: OutboxJob, bot: Bot):
+        """Copies post to popular or best channel and records the copy"""
+        message_id, channel = job["payload"]["message_id"], job["payload"]["channel"]
+        if channel == "popular":
+            chat_id, reply_to_message_id, record = CHAT_ID_POPULAR, None, db.add_to_popular
+        else:
+            chat_id, reply_to_message_id, record = CHAT_ID_BEST, BEST_CHANNEL_TOPIC_MESSAGE_ID, db.add_to_best
+
+        post = await db.get_post(message_id)
+        if post is None or (post[f"{channel}_id"] is not None and "copy_id" not in job["state"]):
+            return
+
+        keyboard = PostKeyboard(
+            rating=post["plus_count"] - post["minus_count"],
+            thread_id=post["comment_thread_id"],
+            comment_count=post["comment_count"],
+        )
+
+        async def copy() -> int:
+            msg = await bot.copy_message(
+                chat_id,
+                CHAT_ID_NEW,
+                message_id,
+                reply_to_message_id=reply_to_message_id,
+                reply_markup=keyboard.to_reply_markup(),
+                rate_limit_args=Priority.NORMAL,
+            )
+            return msg.message_id
+
+        copy_id = await self.outbox.step(job, "copy_id", copy)
+        if "recorded" not in job["state"]:
+            await record(message_id, copy_id, job=job)
+
+        if not job["state"]["recorded"]:
+            logger.warning("Post %s was already %s, deleting duplicate copy", message_id, channel)
+            await self.outbox.step(job, "deleted", lambda: bot.delete_message(chat_id, copy_id))
+            return
+
+        if self.keyboard_updater is not None:
+            self.keyboard_updater.shown(chat_id, copy_id, keyboard)
+        logger.info("Post %s became %s", message_id, channel)
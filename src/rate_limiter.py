@@ -0,0 +1,271 @@
+import asyncio
+import bisect
+import enum
+import itertools
+import logging
+from collections import deque
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+JSONDict = Dict[str, Any]
+
+
+class Priority(enum.IntEnum):
+    # Lower value is sent first
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# Priority of a request when it isn't passed explicitly through ``rate_limit_args``
+ENDPOINT_PRIORITIES = {
+    "answerCallbackQuery": Priority.HIGH,
+    "sendMessage": Priority.HIGH,
+    "sendPhoto": Priority.HIGH,
+    "sendVideo": Priority.HIGH,
+    "sendMediaGroup": Priority.HIGH,
+    "copyMessage": Priority.HIGH,
+    "pinChatMessage": Priority.HIGH,
+    "editMessageReplyMarkup": Priority.LOW,
+}
+
+# Requests that can be repeated safely after a network failure
+IDEMPOTENT_ENDPOINTS = {"answerCallbackQuery", "editMessageReplyMarkup", "pinChatMessage"}
+
+
+class SlidingWindow:
+    """Allows at most ``max_rate`` events per ``time_period`` seconds"""
+
+    def __init__(self, max_rate: int, time_period: float):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._events: deque[float] = deque()
+
+    def delay(self, now: float) -> float:
+        """Seconds until the next event is allowed"""
+        while self._events and self._events[0] <= now - self.time_period:
+            self._events.popleft()
+        if len(self._events) < self.max_rate:
+            return 0
+        return self._events[0] + self.time_period - now
+
+    def add(self, now: float):
+        self._events.append(now)
+
+    @property
+    def idle(self) -> bool:
+        return not self._events
+
+
+class _Request:
+    __slots__ = ("priority", "chat_id", "future", "enqueued_at")
+
+    def __init__(self, priority: Priority, chat_id: int | str | None, future: asyncio.Future, enqueued_at: float):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Rate limiter sending Bot API requests in priority order
+
+    Enforces the overall limit of the bot and per-chat limits, which are stricter for groups
+    and channels than for private chats. Among waiting requests the one with the highest
+    priority that fits the limits goes first, so user-facing replies are not stuck behind
+    keyboard refreshes. ``RetryAfter`` pauses the affected chat (or the whole bot for requests
+    without a chat) for the requested time and the request is retried, idempotent requests
+    are also retried with exponential backoff on network errors.
+
+    Priority can be passed per request as ``rate_limit_args``, otherwise it's taken from
+    ``ENDPOINT_PRIORITIES``.
+    """
+
+    def __init__(
+            self,
+            *,
+            overall_max_rate: int = 30,
+            overall_time_period: float = 1,
+            group_max_rate: int = 20,
+            group_time_period: float = 60,
+            private_max_rate: int = 1,
+            private_time_period: float = 1,
+            max_retries: int = 3,
+            backoff: float = 1,
+    ):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._group_limit = (group_max_rate, group_time_period)
+        self._private_limit = (private_max_rate, private_time_period)
+        self._overall = SlidingWindow(overall_max_rate, overall_time_period)
+        self._chats: dict[int | str, SlidingWindow] = {}
+        self._blocked_until: dict[int | str | None, float] = {}
+
+        self._queue: list[tuple[int, int, _Request]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+        self._sent = {priority: 0 for priority in Priority}
+        self._total_wait = {priority: 0.0 for priority in Priority}
+        self._max_wait = {priority: 0.0 for priority in Priority}
+        self._retry_after_count = 0
+        self._retry_count = 0
+
+    async def initialize(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def process_request(
+            self,
+            callback: Callable[..., Coroutine[Any, Any, Union[bool, JSONDict, List[JSONDict]]]],
+            args: Any,
+            kwargs: Dict[str, Any],
+            endpoint: str,
+            data: Dict[str, Any],
+            rate_limit_args: Optional[int],
+    ) -> Union[bool, JSONDict, List[JSONDict]]:
+        priority = Priority(rate_limit_args) if rate_limit_args is not None else (
+            ENDPOINT_PRIORITIES.get(endpoint, Priority.NORMAL)
+        )
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                with metrics.bot_api_call(endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self._retry_after_count += 1
+                logger.warning("Flood control on %s to %s, retry in %ss", endpoint, chat_id, e.retry_after)
+                now = asyncio.get_running_loop().time()
+                self._blocked_until = {key: until for key, until in self._blocked_until.items() if until > now}
+                self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0), now + e.retry_after)
+                self._wakeup.set()
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if attempt == self.max_retries or endpoint not in IDEMPOTENT_ENDPOINTS:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning("Network error on %s to %s, retry in %ss: %s", endpoint, chat_id, delay, e)
+                await asyncio.sleep(delay)
+            self._retry_count += 1
+
+    async def _acquire(self, priority: Priority, chat_id: int | str | None):
+        """Waits until request is allowed to be sent"""
+        if self._task is None:
+            await self.initialize()
+
+        loop = asyncio.get_running_loop()
+        request = _Request(priority, chat_id, loop.create_future(), loop.time())
+        # Sequence number is unique, so requests themselves are never compared
+        bisect.insort(self._queue, (priority, next(self._sequence), request))
+        self._wakeup.set()
+        await request.future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            now = loop.time()
+            delay = max(self._overall.delay(now), self._blocked_until.get(None, 0) - now)
+            if delay > 0:
+                await self._wait(delay)
+                continue
+
+            delay = None
+            for index, (_, _, request) in enumerate(self._queue):
+                if request.future.done():
+                    # The caller was cancelled while waiting
+                    break
+                window = self._chat_window(request.chat_id)
+                chat_delay = max(
+                    window.delay(now) if window is not None else 0,
+                    self._blocked_until.get(request.chat_id, 0) - now,
+                )
+                if chat_delay <= 0:
+                    break
+                delay = chat_delay if delay is None else min(delay, chat_delay)
+            else:
+                await self._wait(delay)
+                continue
+
+            _, _, request = self._queue.pop(index)
+            if request.future.done():
+                continue
+
+            self._overall.add(now)
+            if (window := self._chat_window(request.chat_id)) is not None:
+                window.add(now)
+            waited = now - request.enqueued_at
+            self._sent[request.priority] += 1
+            self._total_wait[request.priority] += waited
+            self._max_wait[request.priority] = max(self._max_wait[request.priority], waited)
+            request.future.set_result(None)
+
+    async def _wait(self, delay: float):
+        """Sleeps for delay, wakes up earlier when a new request arrives"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    def _chat_window(self, chat_id: int | str | None) -> SlidingWindow | None:
+        if chat_id is None:
+            return None
+
+        if chat_id not in self._chats:
+            if len(self._chats) > 512:
+                self._chats = {key: window for key, window in self._chats.items() if not window.idle}
+            # String ids are channel usernames, negative ids are groups and channels
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            self._chats[chat_id] = SlidingWindow(*(self._group_limit if is_group else self._private_limit))
+        return self._chats[chat_id]
+
+    @property
+    def backlog(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict[str, Any]:
+        """Queue depth and wait time statistics per priority"""
+        depth = {priority.name.lower(): 0 for priority in Priority}
+        for priority, _, _ in self._queue:
+            depth[Priority(priority).name.lower()] += 1
+        return {
+            "queue_depth": depth,
+            "sent": {priority.name.lower(): count for priority, count in self._sent.items()},
+            "avg_wait": {
+                priority.name.lower(): round(self._total_wait[priority] / count, 6) if count else 0
+                for priority, count in self._sent.items()
+            },
+            "max_wait": {priority.name.lower(): round(wait, 6) for priority, wait in self._max_wait.items()},
+            "retry_after": self._retry_after_count,
+            "retries": self._retry_count,
+        }
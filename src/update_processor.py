@@ -0,0 +1,91 @@
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one at a time per key
+
+    ``key`` maps an update to e.g. the post it votes on or the user who sends a post, updates
+    with equal keys are processed in the order they arrived, others in parallel. Updates
+    without a key run right away. ``key`` is awaited, so it may look the post up; one that
+    doesn't suspend, e.g. finds it in a cache, keeps the arrival order.
+
+    An update whose key is busy is queued behind it and gives its concurrency slot back, the
+    task processing the key runs the queued ones after it. So a burst of votes on one post
+    takes a single slot and doesn't hold up other posts.
+
+    ``admit`` sees every update once it got a slot, before it waits for its key, updates it
+    returns False for are dropped. Work that doesn't come from an update, e.g. publishing an
+    assembled album, is serialized with the updates of its key by ``run_keyed``.
+    """
+
+    def __init__(
+            self,
+            max_concurrent_updates: int,
+            key: Callable[[object], Awaitable[Hashable | None]],
+            admit: Callable[[object], bool] | None = None,
+    ):
+        super().__init__(max_concurrent_updates)
+        self.key = key
+        self.admit = admit
+        self._pending: dict[Hashable, deque[Awaitable[Any]]] = {}
+        self._queued = 0
+
+    @property
+    def backlog(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self.admit is not None and not self.admit(update):
+            coroutine.close()
+            return
+
+        key = await self.key(update)
+        if key is None:
+            await coroutine
+            return
+
+        await self.run_keyed(key, coroutine)
+
+    async def run_keyed(self, key: Hashable, coroutine: Awaitable[Any]) -> None:
+        """Runs coroutine after the work queued for key, returns right away if the key is busy"""
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.append(coroutine)
+            self._queued += 1
+            return
+
+        self._pending[key] = pending = deque([coroutine])
+        try:
+            while pending:
+                try:
+                    await pending[0]
+                except Exception:
+                    # Handler errors are reported by the application, this is about the rest
+                    logger.exception("Failed to process update with key %s", key)
+                finally:
+                    pending.popleft()
+        finally:
+            # Cancelled on shutdown, updates queued behind are dropped
+            del self._pending[key]
+            for dropped in pending:
+                dropped.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "max_concurrent": self.max_concurrent_updates,
+            "busy_keys": len(self._pending),
+            "queued_total": self._queued,
+            "backlog": self.backlog,
+        }
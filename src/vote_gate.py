@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from typing import Hashable
+
+from telegram import CallbackQuery, Update
+
+import metrics
+from models import ButtonValues
+
+logger = logging.getLogger(__name__)
+
+VOTE_BUTTONS = {ButtonValues.POSITIVE_VOTE, ButtonValues.NEGATIVE_VOTE}
+# A click waiting longer than this is assumed lost, e.g. dropped on shutdown
+MAX_WAIT = 60
+
+
+class TokenBuckets:
+    """Token bucket per key holding up to ``burst`` tokens, refilled at ``rate`` tokens per second
+
+    Full buckets are forgotten, so only keys that spent tokens recently take memory.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        # Key -> (tokens, time they were counted at)
+        self._buckets: dict[Hashable, tuple[float, float]] = {}
+        self._swept = time.monotonic()
+
+    def take(self, key: Hashable) -> bool:
+        """Takes a token, returns False if there is none left"""
+        now = time.monotonic()
+        if now - self._swept > 60:
+            self._sweep(now)
+
+        tokens, counted = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - counted) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+    def _sweep(self, now: float):
+        self._buckets = {
+            key: (tokens, counted) for key, (tokens, counted) in self._buckets.items()
+            if tokens + (now - counted) * self.rate < self.burst
+        }
+        self._swept = now
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class VoteGate:
+    """Filters vote clicks as they arrive, before they wait for their post
+
+    Clicks above the per user and post rate or the per user rate are rejected. A click of a
+    user on a message that already has a click of theirs waiting is merged into it: the
+    handler of the first click gets all of them with ``take`` and applies them at once. Both
+    rejected and merged clicks are answered right away, so clients don't spin.
+    """
+
+    def __init__(self, post_rate: float, post_burst: float, user_rate: float, user_burst: float):
+        self._post_buckets = TokenBuckets(post_rate, post_burst)
+        self._user_buckets = TokenBuckets(user_rate, user_burst)
+        # (user, chat, message) -> when the first click arrived and buttons clicked since
+        self._waiting: dict[tuple[int, int, int], tuple[float, list[str]]] = {}
+        self._answers: set[asyncio.Task] = set()
+        self._rejected = 0
+        self._merged = 0
+
+    @staticmethod
+    def _key(query: CallbackQuery) -> tuple[int, int, int]:
+        return query.from_user.id, query.message.chat_id, query.message.message_id
+
+    def admit(self, update: object) -> bool:
+        """Whether update should be processed, False for rejected and merged clicks"""
+        if not isinstance(update, Update) or update.callback_query is None:
+            return True
+        query = update.callback_query
+        if query.data not in VOTE_BUTTONS or query.message is None:
+            return True
+
+        key = self._key(query)
+        now = time.monotonic()
+        waiting = self._waiting.get(key)
+        if waiting is not None and now - waiting[0] < MAX_WAIT:
+            waiting[1].append(query.data)
+            self._merged += 1
+            metrics.VOTES_DROPPED.labels("merged").inc()
+            self._answer(query)
+            return False
+
+        if not self._user_buckets.take(query.from_user.id) or not self._post_buckets.take(key):
+            self._rejected += 1
+            metrics.VOTES_DROPPED.labels("rejected").inc()
+            self._answer(query, "Слишком много голосов, попробуйте чуть позже")
+            return False
+
+        self._waiting[key] = (now, [query.data])
+        return True
+
+    def take(self, query: CallbackQuery) -> list[str]:
+        """Buttons clicked by the user on the message in order, the handled click included
+
+        Must be called by the handler of every admitted click, the merged ones are lost otherwise.
+        """
+        if query.data not in VOTE_BUTTONS or query.message is None:
+            return [query.data]
+        waiting = self._waiting.pop(self._key(query), None)
+        return waiting[1] if waiting is not None else [query.data]
+
+    def _answer(self, query: CallbackQuery, text: str | None = None):
+        task = asyncio.get_running_loop().create_task(query.answer(text))
+        self._answers.add(task)
+        task.add_done_callback(self._answered)
+
+    def _answered(self, task: asyncio.Task):
+        self._answers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to answer dropped vote: %s", task.exception())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "rejected": self._rejected,
+            "merged": self._merged,
+            "waiting": len(self._waiting),
+            "user_buckets": len(self._user_buckets),
+            "post_buckets": len(self._post_buckets),
+        }
+
+
+def votes_to_apply(vote: str | None, clicks: list[str]) -> list[str]:
+    """Fewest ``set_user_vote`` calls that take ``vote`` to where clicks one by one would
+
+    Votes toggle: a click adds a vote when there is none, removes it when the opposite button
+    is clicked and does nothing when the same one is.
+    """
+    final = vote
+    for click in clicks:
+        if final is None:
+            final = click
+        elif final != click:
+            final = None
+
+    if final == vote:
+        return []
+    if vote is None:
+        return [final]
+    other = ButtonValues.NEGATIVE_VOTE if vote == ButtonValues.POSITIVE_VOTE else ButtonValues.POSITIVE_VOTE
+    # Clicking the other button removes the vote, clicking it again adds the opposite one
+    return [other] if final is None else [other, other]
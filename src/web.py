@@ -0,0 +1,74 @@
+import hmac
+import json
+import logging
+from typing import Any, Callable
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def build_web_app(
+        application: Application,
+        stats: Callable[[], dict[str, Any]],
+        webhook_path: str | None = None,
+        secret_token: str | None = None,
+        metrics_enabled: bool = False,
+) -> Starlette:
+    """Web app serving health, readiness, stats and optionally metrics, and receiving updates when webhook_path is set"""
+
+    async def healthcheck(_: Request) -> Response:
+        """Liveness probe, the process is up and serving requests"""
+        return PlainTextResponse("Health check successful")
+
+    async def readiness(_: Request) -> Response:
+        """Readiness probe, updates are being processed and the database is reachable"""
+        if not application.running or not db.backend.connected:
+            return PlainTextResponse("Not ready", status_code=503)
+        return PlainTextResponse("Ready")
+
+    async def stats_view(_: Request) -> Response:
+        """Runtime counters, e.g. database pool saturation and Bot API queue"""
+        return JSONResponse(stats())
+
+    async def metrics_view(_: Request) -> Response:
+        """Prometheus metrics"""
+        content, content_type = metrics.render()
+        return Response(content, headers={"Content-Type": content_type})
+
+    async def webhook(request: Request) -> Response:
+        """Receives updates from Telegram and passes them to the application"""
+        token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode(), secret_token.encode()):
+            return Response(status_code=403)
+
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (json.JSONDecodeError, TypeError, KeyError):
+            logger.warning("Received malformed update")
+            return Response(status_code=400)
+
+        await application.update_queue.put(update)
+        return Response()
+
+    routes = [
+        Route("/healthz", healthcheck, methods=["GET"]),
+        Route("/readyz", readiness, methods=["GET"]),
+        Route("/stats", stats_view, methods=["GET"]),
+    ]
+    if metrics_enabled:
+        routes.append(Route("/metrics", metrics_view, methods=["GET"]))
+    if webhook_path is not None:
+        routes.append(Route(webhook_path, webhook, methods=["POST"]))
+
+    return Starlette(routes=routes)
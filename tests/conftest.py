@@ -0,0 +1,78 @@
+"""Fixtures of tests run against a real database
+
+Usage, from the repository root with DB_* variables pointing to a PostgreSQL server:
+
+    python -m pytest tests
+
+A fresh ``TEST_DB_NAME`` database (``bot_test`` by default) is created on the server and
+migrated, tests using it are skipped if the server can't be reached.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Chat ids and limits of the bot under test, variables set in the environment take precedence
+TEST_ENV = {
+    "TELEGRAM_BOT_TOKEN": "1:test",
+    "TELEGRAM_CHANNEL_ID": "-1001000000001",
+    "TELEGRAM_POPULAR_CHANNEL_ID": "-1001000000002",
+    "TELEGRAM_BEST_CHANNEL_ID": "-1001000000003",
+    "TELEGRAM_COMMENTS_GROUP_ID": "-1001000000004",
+    "TELEGRAM_COMMENTS_GROUP_TAG": "@test_comments",
+    # The fake Bot API of the load tests has no limits
+    "TELEGRAM_OVERALL_RATE_LIMIT": "1000000",
+    "TELEGRAM_GROUP_RATE_LIMIT": "1000000",
+    "TELEGRAM_PRIVATE_RATE_LIMIT": "1000000",
+    # Promotions happen while votes and comments are still coming rather than after the run
+    "PROMOTION_INTERVAL": "0.5",
+    "COMMENT_FLUSH_INTERVAL": "0.2",
+    "LOG_FILE": str(Path(tempfile.gettempdir()) / "bot_test.log"),
+    "VOTE_STORE_SNAPSHOT": str(Path(tempfile.gettempdir()) / "bot_test_votes.snapshot"),
+}
+for name, value in TEST_ENV.items():
+    os.environ.setdefault(name, value)
+os.environ["DB_NAME"] = os.getenv("TEST_DB_NAME", "bot_test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import psycopg2  # noqa: E402
+
+import db  # noqa: E402
+from migrate import migrate  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def loop():
+    """One event loop for all tests, the connection pool is bound to it"""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def database(loop):
+    params = db.connection_params()
+    try:
+        conn = psycopg2.connect(**{**params, "dbname": "postgres"}, connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is not reachable: {e}")
+
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{params["dbname"]}"')
+        cursor.execute(f'CREATE DATABASE "{params["dbname"]}"')
+    conn.close()
+
+    loop.run_until_complete(migrate())
+    yield
+    loop.run_until_complete(db.backend.close())
+
+
+@pytest.fixture
+def run(loop, database):
+    """Runs a coroutine on the test event loop against the migrated database"""
+    return loop.run_until_complete
@@ -0,0 +1,117 @@
+"""Compares per-query latency of database backends on the vote and comment paths
+
+Usage, from the repository root with DB_* variables pointing to a throwaway database:
+
+    python tests/load/bench_backends.py --iterations 2000 --output backends.json
+
+Caches are disabled, so every call goes to the database. Results are printed as JSON
+with latency percentiles in milliseconds per backend and query.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src"))
+
+import db  # noqa: E402
+from cache import PostCache, PostQuota  # noqa: E402
+from latency import percentiles  # noqa: E402
+from migrate import migrate  # noqa: E402
+from models import ButtonValues, Post  # noqa: E402
+
+POST_COUNT = 100
+
+
+def queries(posts: list[Post], rng: random.Random) -> dict[str, Callable[[int], Awaitable]]:
+    """Database calls made while handling a vote or a comment, by name"""
+    first_user_id = time.time_ns() // 1000
+
+    def post() -> Post:
+        return rng.choice(posts)
+
+    def vote() -> ButtonValues:
+        return rng.choice([ButtonValues.POSITIVE_VOTE, ButtonValues.NEGATIVE_VOTE])
+
+    def comments(count: int) -> dict[int, int]:
+        return {item["comment_thread_id"]: 1 for item in rng.sample(posts, count)}
+
+    return {
+        # Vote path
+        "get_post": lambda i: db.get_post(post()["message_id"]),
+        "set_user_vote": lambda i: db.set_user_vote(post()["message_id"], first_user_id + i, vote()),
+        "get_user_vote": lambda i: db.get_user_vote(post()["message_id"], first_user_id + i),
+        "get_rating": lambda i: db.get_rating(post()["message_id"]),
+        "get_promotion_candidates": lambda i: db.get_promotion_candidates(
+            [post()["message_id"]], popular_thresholds=(80, 20), best_thresholds=(60, 80, 5),
+        ),
+        # Comment path
+        "increase_comments_counters[1]": lambda i: db.increase_comments_counters(comments(1)),
+        "increase_comments_counters[10]": lambda i: db.increase_comments_counters(comments(10)),
+        # New post path
+        "get_post_count_for_user": lambda i: db.get_post_count_for_user(post()["user_id"]),
+    }
+
+
+async def bench_backend(name: str, iterations: int, warmup: int, seed: int) -> dict:
+    db.backend = db.create_backend(name)
+    try:
+        await migrate()
+        rng = random.Random(seed)
+        first_id = time.time_ns() // 1000
+        posts = [
+            await db.add_post(first_id + 2 * n, first_id + n, first_id + 2 * n + 1)
+            for n in range(POST_COUNT)
+        ]
+
+        results = {}
+        for query, call in queries(posts, rng).items():
+            # Warm up connections and, for asyncpg, prepared statements
+            for i in range(warmup):
+                await call(-1 - i)
+
+            latencies = []
+            for i in range(iterations):
+                started = time.perf_counter()
+                await call(i)
+                latencies.append(time.perf_counter() - started)
+            results[query] = percentiles(latencies)
+        return results
+    finally:
+        await db.backend.close()
+
+
+async def bench(args: argparse.Namespace) -> dict:
+    db.post_cache = PostCache(max_size=0, ttl=0)
+    db.post_quota = PostQuota(max_users=0, window=24 * 60 * 60)
+    return {
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "backends": {
+            name: await bench_backend(name, args.iterations, args.warmup, args.seed)
+            for name in args.backends
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["aiopg", "asyncpg"])
+    parser.add_argument("--iterations", type=int, default=1000, help="calls of every query")
+    parser.add_argument("--warmup", type=int, default=50, help="calls of every query before measuring")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="file to write results to as well")
+    args = parser.parse_args()
+
+    output = json.dumps(asyncio.run(bench(args)), indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Any
+from urllib.parse import parse_qsl
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+BOT = {"id": 1, "is_bot": True, "first_name": "Load test", "username": "load_test_bot"}
+
+
+class FakeBotApi:
+    """Local stand-in for the Telegram Bot API
+
+    Answers the methods the bot uses with plausible results after ``latency`` seconds and
+    counts calls per method. Message ids are unique across runs, so posts created by
+    different runs don't clash in the database. Copies are counted per source message and
+    target chat, a post copied to one channel twice is a duplicate promotion.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.copies: Counter[tuple[int, int]] = Counter()
+        self._message_ids = itertools.count(time.time_ns() // 1000)
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    def reset(self):
+        self.calls.clear()
+        self.copies.clear()
+
+    def build_app(self) -> Starlette:
+        return Starlette(routes=[Route("/bot{token}/{method}", self.handle, methods=["POST"])])
+
+    async def handle(self, request: Request) -> Response:
+        method = request.path_params["method"]
+        self.calls[method] += 1
+        params = {key: _decode(value) for key, value in parse_qsl((await request.body()).decode())}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result = self.answer(method, params)
+        if result is None:
+            return JSONResponse({"ok": False, "error_code": 404, "description": "Not Found: method not found"}, 404)
+        return JSONResponse({"ok": True, "result": result})
+
+    def answer(self, method: str, params: dict[str, Any]) -> Any:
+        chat = {"id": _chat_id(params.get("chat_id")), "type": "channel", "title": "Load test"}
+        match method:
+            case "getMe":
+                return BOT
+            case "sendMessage":
+                return self._message(chat, text=params.get("text", ""))
+            case "sendPhoto":
+                photo = {"file_id": "photo", "file_unique_id": "photo", "width": 1280, "height": 720}
+                return self._message(chat, photo=[photo])
+            case "sendVideo":
+                video = {"file_id": "video", "file_unique_id": "video", "width": 1280, "height": 720, "duration": 10}
+                return self._message(chat, video=video)
+            case "sendMediaGroup":
+                return [self._message(chat) for _ in params.get("media", [])]
+            case "copyMessage":
+                self.copies[(params.get("message_id"), _chat_id(params.get("chat_id")))] += 1
+                return {"message_id": self.next_message_id()}
+            case "editMessageReplyMarkup":
+                return self._message(chat, message_id=params.get("message_id"))
+            case "answerCallbackQuery" | "pinChatMessage" | "deleteMessage" | "setWebhook" | "deleteWebhook":
+                return True
+        return None
+
+    def _message(self, chat: dict, message_id: int | None = None, **fields) -> dict:
+        return {
+            "message_id": message_id or self.next_message_id(),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": BOT,
+            **fields,
+        }
+
+
+def _decode(value: str) -> Any:
+    """Parameters are sent as url-encoded form fields holding JSON values
+
+    The bot only sends files by file_id, so multipart uploads are not expected.
+    """
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def _chat_id(value: Any) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        # Channel usernames like @channel
+        return -1
@@ -0,0 +1,15 @@
+import statistics
+
+
+def percentiles(latencies: list[float]) -> dict[str, float]:
+    """Mean, p50, p95, p99 and max of latencies in seconds, in milliseconds"""
+    if len(latencies) < 2:
+        latencies = latencies * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "mean": round(statistics.fmean(latencies) * 1000, 3),
+        "p50": round(cuts[49] * 1000, 3),
+        "p95": round(cuts[94] * 1000, 3),
+        "p99": round(cuts[98] * 1000, 3),
+        "max": round(max(latencies) * 1000, 3),
+    }
@@ -0,0 +1,176 @@
+"""Runs synthetic traffic through the bot handlers against a fake Bot API and a real database
+
+Usage, from the repository root with DB_* variables pointing to a throwaway database:
+
+    python tests/load/run.py vote_storm --updates 2000 --concurrency 20 --output vote_storm.json
+
+Results are printed as JSON, see README.md for the fields.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Chat ids and limits of the bot under test, variables set in the environment take precedence
+BENCH_ENV = {
+    "TELEGRAM_BOT_TOKEN": "1:load-test",
+    "TELEGRAM_CHANNEL_ID": "-1001000000001",
+    "TELEGRAM_POPULAR_CHANNEL_ID": "-1001000000002",
+    "TELEGRAM_BEST_CHANNEL_ID": "-1001000000003",
+    "TELEGRAM_COMMENTS_GROUP_ID": "-1001000000004",
+    "TELEGRAM_COMMENTS_GROUP_TAG": "@load_test_comments",
+    "DB_MIGRATE_ON_STARTUP": "true",
+    # Bot API limits would measure the rate limiter rather than the bot
+    "TELEGRAM_OVERALL_RATE_LIMIT": "1000000",
+    "TELEGRAM_GROUP_RATE_LIMIT": "1000000",
+    "TELEGRAM_PRIVATE_RATE_LIMIT": "1000000",
+    # Promotions happen while votes are still coming rather than when draining
+    "PROMOTION_INTERVAL": "0.5",
+    "LOG_FILE": "load_test.log",
+}
+for name, value in BENCH_ENV.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src"))
+
+import uvicorn  # noqa: E402
+from telegram import Update  # noqa: E402
+
+import app  # noqa: E402
+import db  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+from latency import percentiles  # noqa: E402
+from workloads import WORKLOADS, Traffic  # noqa: E402
+
+async def run_workload(args: argparse.Namespace) -> dict:
+    post_count, build_updates = WORKLOADS[args.workload]
+    api = FakeBotApi(latency=args.api_latency)
+    server = uvicorn.Server(uvicorn.Config(
+        api.build_app(), host="127.0.0.1", port=args.api_port, lifespan="off", log_level="warning"
+    ))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    application = app.build_application(base_url=f"http://127.0.0.1:{args.api_port}/bot")
+    errors = Counter()
+
+    async def count_errors(_, context):
+        errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(count_errors)
+    traffic = Traffic(int(app.CHAT_ID_NEW), int(app.COMMENTS_GROUP_ID), seed=args.seed)
+    latencies: list[float] = []
+
+    async with application:
+        await app.on_startup(application)
+        await application.start()
+
+        # Posts the workload votes or comments on, authors are not among workload users
+        posts = [
+            await db.add_post(api.next_message_id(), traffic.user(-1 - n)["id"], api.next_message_id())
+            for n in range(post_count)
+        ]
+        updates = [Update.de_json(update, application.bot) for update in build_updates(traffic, posts, args.updates)]
+
+        api.reset()
+        # Every statement is one round trip to the database
+        queries_before = db.backend.queries
+        concurrency = asyncio.Semaphore(args.concurrency)
+
+        async def process(update: Update):
+            async with concurrency:
+                submitted = time.perf_counter()
+                handled = asyncio.get_running_loop().create_future()
+
+                async def handle():
+                    try:
+                        await application.process_update(update)
+                    finally:
+                        handled.set_result(None)
+
+                # Through the update processor like updates from Telegram, so per-post ordering applies.
+                # It returns as soon as an update is queued behind its key, so the handler is waited for.
+                handler = handle()
+                await application.update_processor.process_update(update, handler)
+                if inspect.getcoroutinestate(handler) != inspect.CORO_CLOSED or handled.done():
+                    await handled
+                # Otherwise dropped by the vote gate, answered right away
+                latencies.append(time.perf_counter() - submitted)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(process(update) for update in updates))
+        handled = time.perf_counter()
+
+        # Albums, comment counters, keyboard edits and promotions finish in the background
+        await application.stop()
+        await app.on_stop(application)
+        drained = time.perf_counter()
+        stats = app.stats()
+        queries = db.backend.queries - queries_before
+    await app.on_shutdown(application)
+
+    server.should_exit = True
+    await server_task
+
+    handlers_time = handled - started
+    return {
+        "workload": args.workload,
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "updates": len(updates),
+        "concurrency": args.concurrency,
+        "api_latency": args.api_latency,
+        "seed": args.seed,
+        "duration": {"handlers": round(handlers_time, 3), "drain": round(drained - handled, 3)},
+        "throughput": round(len(updates) / handlers_time, 1),
+        "latency_ms": percentiles(latencies),
+        "errors": dict(errors),
+        "sql": {
+            "backend": db.backend.name,
+            "queries": queries,
+            "per_update": round(queries / len(updates), 3),
+        },
+        "bot_api": {
+            "calls": api.calls.total(),
+            "per_update": round(api.calls.total() / len(updates), 3),
+            "by_method": dict(api.calls.most_common()),
+        },
+        # Posts copied to a channel, each counted once per channel
+        "promotions": len(api.copies),
+        # Posts copied to the same channel more than once
+        "duplicate_promotions": sum(1 for count in api.copies.values() if count > 1),
+        "stats": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("workload", choices=WORKLOADS)
+    parser.add_argument("--updates", type=int, default=1000, help="number of updates to send")
+    parser.add_argument("--concurrency", type=int, default=1, help="updates processed at the same time")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds the fake Bot API takes to answer")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="file to write results to as well")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    result = asyncio.run(run_workload(args))
+
+    output = json.dumps(result, indent=2, default=str)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    return 1 if result["duplicate_promotions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import itertools
+import random
+import time
+from typing import Callable
+
+from models import ButtonValues, Post
+
+
+class Traffic:
+    """Builds raw updates the way Telegram sends them to the bot
+
+    Users get fresh ids on every run, so daily post limits left by earlier runs don't apply.
+    """
+
+    def __init__(self, channel_id: int, comments_group_id: int, seed: int = 42):
+        self.channel_id = channel_id
+        self.comments_group_id = comments_group_id
+        self.random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._first_user_id = time.time_ns() // 1000
+
+    def user(self, n: int) -> dict:
+        user_id = self._first_user_id + n
+        return {"id": user_id, "is_bot": False, "first_name": f"User {n}", "username": f"user{user_id}"}
+
+    def _update(self, **fields) -> dict:
+        return {"update_id": next(self._update_ids), **fields}
+
+    def _message(self, chat: dict, user: dict, **fields) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat, "from": user, **fields}
+
+    def _private_chat(self, user: dict) -> dict:
+        return {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+
+    def vote(self, post: Post, user: dict, value: ButtonValues) -> dict:
+        message = {
+            "message_id": post["message_id"],
+            "date": int(time.time()),
+            "chat": {"id": self.channel_id, "type": "channel", "title": "New"},
+        }
+        return self._update(callback_query={
+            "id": str(self.random.getrandbits(63)),
+            "from": user,
+            "chat_instance": str(self.channel_id),
+            "message": message,
+            "data": str(value),
+        })
+
+    def comment(self, post: Post, user: dict) -> dict:
+        chat = {"id": self.comments_group_id, "type": "supergroup", "title": "Comments"}
+        return self._update(message=self._message(
+            chat, user, text="Comment", message_thread_id=post["comment_thread_id"], is_topic_message=False,
+        ))
+
+    def text_post(self, user: dict) -> dict:
+        return self._update(message=self._message(self._private_chat(user), user, text="Post text #load"))
+
+    def photo(self, user: dict, media_group: str | None = None, caption: str | None = None) -> dict:
+        file_id = f"photo{self.random.getrandbits(32)}"
+        photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 720}]
+        fields = {"photo": photo}
+        if media_group is not None:
+            fields["media_group_id"] = media_group
+        if caption is not None:
+            fields["caption"] = caption
+        return self._update(message=self._message(self._private_chat(user), user, **fields))
+
+
+def vote_storm(traffic: Traffic, posts: list[Post], count: int) -> list[dict]:
+    """Everyone votes on one post, every fifth vote changes or cancels an earlier one"""
+    voters = max(count * 4 // 5, 1)
+    return [
+        traffic.vote(posts[0], traffic.user(traffic.random.randrange(voters)), _random_vote(traffic))
+        for _ in range(count)
+    ]
+
+
+def spread_votes(traffic: Traffic, posts: list[Post], count: int) -> list[dict]:
+    """Votes on many posts at once, newer posts get more of them"""
+    weights = [index + 1 for index in range(len(posts))]
+    return [
+        traffic.vote(traffic.random.choices(posts, weights)[0], traffic.user(n), _random_vote(traffic))
+        for n in range(count)
+    ]
+
+
+def comment_flood(traffic: Traffic, posts: list[Post], count: int) -> list[dict]:
+    """Comments in the threads of a few posts"""
+    return [traffic.comment(traffic.random.choice(posts), traffic.user(n)) for n in range(count)]
+
+
+def album_uploads(traffic: Traffic, _: list[Post], count: int, album_size: int = 4) -> list[dict]:
+    """Albums of album_size photos from different users, items of one album arrive back to back"""
+    updates = []
+    for n in range(max(count // album_size, 1)):
+        user = traffic.user(n)
+        media_group = f"load{traffic.random.getrandbits(63)}"
+        for item in range(album_size):
+            updates.append(traffic.photo(user, media_group, caption="Album #load" if item == 0 else None))
+    return updates
+
+
+def new_post_burst(traffic: Traffic, _: list[Post], count: int) -> list[dict]:
+    """Text posts from different users"""
+    return [traffic.text_post(traffic.user(n)) for n in range(count)]
+
+
+def vote_spam(traffic: Traffic, posts: list[Post], count: int, spammers: int = 5) -> list[dict]:
+    """A few users clicking both buttons of one post over and over, mixed with regular votes"""
+    updates = []
+    for n in range(count):
+        if n % 4 == 3:
+            user = traffic.user(spammers + n)
+        else:
+            user = traffic.user(n % spammers)
+        updates.append(traffic.vote(posts[0], user, _random_vote(traffic)))
+    return updates
+
+
+def promotion_race(traffic: Traffic, posts: list[Post], count: int) -> list[dict]:
+    """Positive votes, repeated clicks and comments on a few posts, enough to make them popular and best
+
+    Run with high concurrency and a short PROMOTION_INTERVAL, the run result counts posts
+    copied to a channel more than once.
+    """
+    updates = []
+    for n in range(count):
+        if n % 10 == 9:
+            # Every tenth update, n // 2 of those would always pick the same post
+            updates.append(traffic.comment(posts[n // 10 % len(posts)], traffic.user(n)))
+            continue
+        post = posts[n // 2 % len(posts)]
+        user = traffic.user(n // 2)
+        # Every user clicks twice in a row, like impatient users do
+        updates.append(traffic.vote(post, user, ButtonValues.POSITIVE_VOTE))
+    return updates
+
+
+def _random_vote(traffic: Traffic) -> ButtonValues:
+    return ButtonValues.POSITIVE_VOTE if traffic.random.random() < 0.8 else ButtonValues.NEGATIVE_VOTE
+
+
+# Name: (posts created before the run, updates builder)
+WORKLOADS: dict[str, tuple[int, Callable[[Traffic, list[Post], int], list[dict]]]] = {
+    "vote_storm": (1, vote_storm),
+    "spread_votes": (100, spread_votes),
+    "comment_flood": (10, comment_flood),
+    "album_uploads": (0, album_uploads),
+    "new_post_burst": (0, new_post_burst),
+    "vote_spam": (1, vote_spam),
+    "promotion_race": (5, promotion_race),
+}
@@ -0,0 +1,79 @@
+-- Compares index sizes and vote path latency of the varchar key schema (before migration 011)
+-- with the bigint/smallint one on 10M synthetic votes.
+-- Run with: psql -v ON_ERROR_STOP=1 -f bench_key_schema.sql
+-- Takes a few minutes and about 2GB of disk, tables are temporary.
+\timing off
+
+CREATE TEMP TABLE votes_varchar (
+    message_id varchar(32) NOT NULL,
+    user_id varchar(32) NOT NULL,
+    vote varchar(1),
+    PRIMARY KEY (message_id, user_id)
+);
+CREATE INDEX votes_varchar_message_vote ON votes_varchar (message_id, vote);
+
+CREATE TEMP TABLE votes_bigint (
+    message_id bigint NOT NULL,
+    user_id bigint NOT NULL,
+    vote smallint NOT NULL,
+    PRIMARY KEY (message_id, user_id)
+);
+CREATE INDEX votes_bigint_message_vote ON votes_bigint (message_id, vote);
+
+-- 100k posts with 100 votes each, user ids look like real Telegram ones
+INSERT INTO votes_varchar (message_id, user_id, vote)
+SELECT post, 5000000000 + post * 7 + voter, CASE WHEN voter % 4 = 0 THEN '-' ELSE '+' END
+FROM generate_series(1, 100000) AS post, generate_series(1, 100) AS voter;
+
+INSERT INTO votes_bigint (message_id, user_id, vote)
+SELECT post, 5000000000 + post * 7 + voter, CASE WHEN voter % 4 = 0 THEN -1 ELSE 1 END
+FROM generate_series(1, 100000) AS post, generate_series(1, 100) AS voter;
+
+ANALYZE votes_varchar;
+ANALYZE votes_bigint;
+
+SELECT
+    schema,
+    pg_size_pretty(pg_relation_size(tbl)) AS table_size,
+    pg_size_pretty(pg_relation_size(pkey)) AS primary_key_size,
+    pg_size_pretty(pg_relation_size(idx)) AS message_vote_index_size
+FROM (VALUES
+    ('varchar', 'votes_varchar'::regclass, 'votes_varchar_pkey'::regclass, 'votes_varchar_message_vote'::regclass),
+    ('bigint', 'votes_bigint'::regclass, 'votes_bigint_pkey'::regclass, 'votes_bigint_message_vote'::regclass)
+) AS tables (schema, tbl, pkey, idx);
+
+-- Vote path: look up the user vote, toggle it on and off, 20k times on random posts
+DO
+$$
+DECLARE
+    started timestamptz;
+    post bigint;
+    voter bigint;
+    found_vote text;
+BEGIN
+ PERFORM setseed(0.42);
+ started := clock_timestamp();
+ FOR i IN 1..20000 LOOP
+    post := 1 + floor(random() * 100000);
+    voter := 9000000000 + i;
+    SELECT vote INTO found_vote FROM votes_varchar WHERE (message_id, user_id) = (post::text, voter::text);
+    INSERT INTO votes_varchar VALUES (post::text, voter::text, '+') ON CONFLICT DO NOTHING;
+    DELETE FROM votes_varchar WHERE (message_id, user_id) = (post::text, voter::text) AND vote <> '-';
+ END LOOP;
+ RAISE NOTICE 'varchar: % us per vote', round(extract(epoch FROM clock_timestamp() - started) * 1e6 / 20000, 1);
+
+ PERFORM setseed(0.42);
+ started := clock_timestamp();
+ FOR i IN 1..20000 LOOP
+    post := 1 + floor(random() * 100000);
+    voter := 9000000000 + i;
+    SELECT vote INTO found_vote FROM votes_bigint WHERE (message_id, user_id) = (post, voter);
+    INSERT INTO votes_bigint VALUES (post, voter, 1) ON CONFLICT DO NOTHING;
+    DELETE FROM votes_bigint WHERE (message_id, user_id) = (post, voter) AND vote <> -1;
+ END LOOP;
+ RAISE NOTICE 'bigint: % us per vote', round(extract(epoch FROM clock_timestamp() - started) * 1e6 / 20000, 1);
+END
+$$;
+
+DROP TABLE votes_varchar;
+DROP TABLE votes_bigint;
@@ -5,13 +5,20 @@ BEGIN
     INSERT INTO public.votes (
         message_id,
         user_id,
-        vote
+        vote,
+        post_date
     )
     VALUES (
         16, --message_id here
         i,
-        '+'
+        1,
+        (SELECT date FROM posts WHERE message_id = 16)
     );
  END LOOP;
 END
 $$
+;
+UPDATE posts SET
+    plus_count = (SELECT count(*) FROM votes WHERE message_id = 16 AND vote = 1),
+    minus_count = (SELECT count(*) FROM votes WHERE message_id = 16 AND vote = -1)
+WHERE message_id = 16; --message_id here
@@ -0,0 +1,40 @@
+import asyncio
+
+from keyboard_updater import KeyboardUpdater
+from models import PostKeyboard
+
+
+class FakeBot:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.shown: dict[tuple[str, int], tuple] = {}
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup):
+        await asyncio.sleep(self.latency)
+        self.shown[chat_id, message_id] = reply_markup
+
+
+def test_stop_sends_last_keyboard_of_every_message():
+    bot = FakeBot(latency=0.05)
+    updater = KeyboardUpdater(interval=10)
+    messages = [("-100", message_id) for message_id in range(1, 11)]
+
+    async def main():
+        await updater.start(bot)
+        for chat_id, message_id in messages:
+            updater.schedule(chat_id, message_id, PostKeyboard(rating=1))
+        # The first edits are being sent, newer keyboards of half of the messages wait for the interval
+        await asyncio.sleep(0.01)
+        for chat_id, message_id in messages[:5]:
+            updater.schedule(chat_id, message_id, PostKeyboard(rating=2))
+        updater.schedule("-100", 11, PostKeyboard(rating=3))
+        await updater.stop()
+
+    asyncio.run(main())
+
+    assert bot.shown == {
+        **{message: PostKeyboard(rating=2).to_reply_markup() for message in messages[:5]},
+        **{message: PostKeyboard(rating=1).to_reply_markup() for message in messages[5:]},
+        ("-100", 11): PostKeyboard(rating=3).to_reply_markup(),
+    }
+    assert updater.backlog == 0
@@ -0,0 +1,130 @@
+import asyncio
+import json
+
+import pytest
+
+import db
+from outbox import Outbox
+
+
+@pytest.fixture
+def outbox(run) -> Outbox:
+    run(db.backend.execute("DELETE FROM outbox;"))
+    return Outbox(workers=1, lease=60, poll_interval=0.05, max_attempts=5, retention=60)
+
+
+async def make_due(job_id: int):
+    await db.backend.execute("UPDATE outbox SET run_at = now() WHERE id = %(id)s;", {"id": job_id})
+
+
+async def fetch_job(job_id: int) -> dict:
+    job = dict(await db.backend.fetchrow(
+        "SELECT state::text, attempts, finished_at, failed, lease_token FROM outbox WHERE id = %(id)s;", {"id": job_id}
+    ))
+    job["state"] = json.loads(job["state"])
+    return job
+
+
+def test_retried_job_resumes_after_last_saved_step(run, outbox):
+    calls = []
+
+    async def runner(job, bot):
+        async def send(name: str) -> str:
+            calls.append(name)
+            if name == "second" and calls.count(name) == 1:
+                raise ConnectionError("Bot API is down")
+            return f"{name} sent"
+
+        await outbox.step(job, "first", lambda: send("first"))
+        await outbox.step(job, "second", lambda: send("second"))
+
+    outbox.register("send", runner)
+    run(outbox.enqueue("send", "send:1", {}))
+
+    job = run(db.claim_job(outbox.lease))
+    run(outbox._run(job))
+    assert run(fetch_job(job["id"]))["finished_at"] is None
+
+    run(make_due(job["id"]))
+    job = run(db.claim_job(outbox.lease))
+    assert job["state"] == {"first": "first sent"}
+    run(outbox._run(job))
+
+    assert calls == ["first", "second", "second"]
+    saved = run(fetch_job(job["id"]))
+    assert saved["state"] == {"first": "first sent", "second": "second sent"}
+    assert saved["attempts"] == 2
+    assert saved["finished_at"] is not None and not saved["failed"]
+
+
+def test_expired_lease_is_taken_over(run, outbox):
+    run(outbox.enqueue("send", "send:1", {}))
+    stale = run(db.claim_job(0.1))
+    assert run(db.claim_job(outbox.lease)) is None
+
+    run(asyncio.sleep(0.2))
+    job = run(db.claim_job(outbox.lease))
+    assert job["id"] == stale["id"] and job["lease_token"] != stale["lease_token"]
+
+    # The worker that lost the lease can neither save its steps nor finish the job
+    stale["state"]["sent"] = 1
+    with pytest.raises(db.JobLeaseLost):
+        run(db.save_job_state(stale))
+    run(db.finish_job(stale))
+    assert run(fetch_job(job["id"]))["finished_at"] is None
+
+    job["state"]["sent"] = 2
+    run(db.save_job_state(job))
+    run(db.finish_job(job))
+    saved = run(fetch_job(job["id"]))
+    assert saved["state"] == {"sent": 2}
+    assert saved["finished_at"] is not None
+
+
+def test_lease_is_renewed_while_job_runs(run, outbox):
+    outbox.lease = 0.3
+
+    async def runner(job, bot):
+        # E.g. waiting for the rate limiter for longer than the lease
+        await asyncio.sleep(1)
+        await outbox.step(job, "sent", lambda: asyncio.sleep(0, result=True))
+
+    outbox.register("send", runner)
+    run(outbox.enqueue("send", "send:1", {}))
+    job = run(db.claim_job(outbox.lease))
+
+    async def run_and_take_over() -> list:
+        running = asyncio.create_task(outbox._run(job))
+        taken = []
+        while not running.done():
+            taken.append(await db.claim_job(outbox.lease))
+            await asyncio.sleep(0.1)
+        return taken
+
+    assert not any(run(run_and_take_over()))
+    saved = run(fetch_job(job["id"]))
+    assert saved["state"] == {"sent": True}
+    assert saved["finished_at"] is not None and not saved["failed"]
+
+
+def test_job_is_cancelled_when_lease_is_lost(run, outbox):
+    outbox.lease = 0.3
+    cancelled = asyncio.Event()
+
+    async def runner(job, bot):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    outbox.register("send", runner)
+    run(outbox.enqueue("send", "send:1", {}))
+    job = run(db.claim_job(outbox.lease))
+    # Another worker took the job over, e.g. after this one stalled past the lease
+    run(db.backend.execute("UPDATE outbox SET lease_token = 'other' WHERE id = %(id)s;", {"id": job["id"]}))
+
+    run(asyncio.wait_for(outbox._run(job), timeout=2))
+    assert cancelled.is_set()
+    saved = run(fetch_job(job["id"]))
+    assert saved["lease_token"] == "other" and saved["finished_at"] is None
@@ -0,0 +1,29 @@
+import asyncio
+
+from outbox import Outbox
+from promotion import PromotionEngine
+
+
+def test_marked_posts_are_checked_again_after_failure():
+    outbox = Outbox(workers=1, lease=60, poll_interval=0.05, max_attempts=5, retention=60)
+    engine = PromotionEngine(interval=0.01, batch_size=100, sweep_hours=0, outbox=outbox)
+    checked = []
+
+    async def promote(message_ids):
+        checked.append(message_ids)
+        if len(checked) == 2:
+            raise ConnectionError("database is down")
+
+    engine.promote = promote
+
+    async def main():
+        await engine.start()
+        engine.mark(1)
+        engine.mark(2)
+        await asyncio.sleep(0.05)
+        await engine.stop()
+
+    asyncio.run(main())
+
+    # Nothing marked before start, then the failed check is retried
+    assert checked[:3] == [[], [1, 2], [1, 2]]
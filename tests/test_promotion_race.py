@@ -0,0 +1,28 @@
+import argparse
+import socket
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "load"))
+
+from run import run_workload  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_concurrent_votes_and_comments_promote_once(run):
+    # Double clicks and comments on 5 posts, processed 200 at a time through the update processor
+    args = argparse.Namespace(
+        workload="promotion_race", updates=2000, concurrency=200, api_latency=0.0, api_port=free_port(), seed=42,
+    )
+
+    result = run(run_workload(args))
+
+    assert result["errors"] == {}
+    assert result["duplicate_promotions"] == 0
+    # Every post became both popular and best
+    assert result["promotions"] == 5 * 2
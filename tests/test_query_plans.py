@@ -0,0 +1,156 @@
+"""Fails if a statement the bot runs while handling updates plans a sequential scan
+
+The statements are not copies: database functions are called against a seeded database
+and every statement they send is recorded and explained with its parameters. Caches are
+emptied first, so each function goes to the database.
+"""
+import inspect
+import re
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+import db
+from backends.base import Connection
+from cache import PostQuota, VoteStore
+from models import ButtonValues, OutboxJob
+
+SEED = """
+INSERT INTO posts (message_id, user_id, date, comment_thread_id, popular_id, best_id, media_group)
+SELECT
+    i,
+    i % 5000,
+    now() - (i || ' minutes')::interval,
+    i + 1000000,
+    CASE WHEN i % 50 = 0 THEN i + 2000000 END,
+    CASE WHEN i % 500 = 0 THEN i + 3000000 END,
+    CASE WHEN i % 10 = 0 THEN 'group' || i END
+FROM generate_series(1, 100000) AS i;
+
+INSERT INTO votes (message_id, user_id, vote, post_date)
+SELECT posts.message_id, i, CASE WHEN i % 4 = 0 THEN -1 ELSE 1 END, posts.date
+FROM generate_series(1, 500000) AS i
+JOIN posts ON posts.message_id = i % 100000 + 1;
+
+-- Mostly finished jobs, like after a day of posting with the default retention
+INSERT INTO outbox (kind, idempotency_key, payload, author_id, created_at, finished_at)
+SELECT
+    'publish_post',
+    'post:' || i,
+    '{}',
+    i % 5000,
+    now() - (i || ' seconds')::interval,
+    CASE WHEN i > 100 THEN now() - (i || ' seconds')::interval END
+FROM generate_series(1, 50000) AS i;
+
+UPDATE outbox SET lease_token = 'token', locked_until = now() + interval '1 hour' WHERE id = 7;
+
+ANALYZE posts;
+ANALYZE votes;
+ANALYZE outbox;
+"""
+
+# Ids of seeded jobs start from 1
+CLEAN = "TRUNCATE posts, votes, outbox RESTART IDENTITY;"
+
+LEASED_JOB = OutboxJob(id=7, kind="publish_post", payload={}, state={"sent": 1}, attempts=1, lease_token="token")
+
+# Database functions run by handlers and background workers, with arguments of seeded rows
+HOT_PATH: dict[str, Callable[[], Awaitable[Any]]] = {
+    "warm_up": lambda: db.warm_up(24),
+    "get_recent_votes": lambda: db.get_recent_votes(42),
+    "get_user_vote": lambda: db.get_user_vote(42, 42),
+    "set_user_vote": lambda: db.set_user_vote(42, 7, ButtonValues.POSITIVE_VOTE),
+    "get_rating": lambda: db.get_rating(42),
+    "add_post": lambda: db.add_post(200001, 42, 1200001),
+    "get_post": lambda: db.get_post(42),
+    "get_post_by_popular_id": lambda: db.get_post_by_popular_id(2000050),
+    "get_post_by_best_id": lambda: db.get_post_by_best_id(3000500),
+    "get_post_by_media_group": lambda: db.get_post_by_media_group("group10"),
+    "increase_comments_counters": lambda: db.increase_comments_counters({1000042: 3, 1000043: 1}),
+    "get_post_count_for_user": lambda: db.get_post_count_for_user(42),
+    "add_to_popular": lambda: db.add_to_popular(43, 1),
+    "add_to_best": lambda: db.add_to_best(43, 1),
+    "get_promotion_candidates": lambda: db.get_promotion_candidates(
+        [42, 43], popular_thresholds=(80, 20), best_thresholds=(60, 80, 5),
+    ),
+    "get_promotion_candidates[startup]": lambda: db.get_promotion_candidates(
+        None, popular_thresholds=(80, 20), best_thresholds=(60, 80, 5), hours=48,
+    ),
+    "enqueue_job": lambda: db.enqueue_job("publish_post", "post:new", {}, author_id=42),
+    "claim_job": lambda: db.claim_job(60),
+    "save_job_state": lambda: db.save_job_state(LEASED_JOB),
+    "extend_job_lease": lambda: db.extend_job_lease(LEASED_JOB, 60),
+    # Release the job the ones above hold, so they go last
+    "retry_job": lambda: db.retry_job(LEASED_JOB, 1, "error"),
+    "finish_job": lambda: db.finish_job(LEASED_JOB),
+    "delete_finished_jobs": lambda: db.delete_finished_jobs(24 * 60 * 60),
+}
+
+NOT_CHECKED = {
+    # Statements of their callers are checked
+    "read_row",
+    "read_rows",
+    # Don't query
+    "connect",
+    "restore_votes",
+    "save_votes",
+    # Maintenance commands compare counters of every post by design
+    "get_inconsistent_vote_counters",
+    "fix_vote_counters",
+}
+
+
+@pytest.fixture(scope="module")
+def seeded(loop, database):
+    loop.run_until_complete(db.backend.execute(CLEAN + SEED))
+    yield
+    loop.run_until_complete(db.backend.execute(CLEAN))
+
+
+@pytest.fixture
+def statements(monkeypatch) -> list[tuple[str, dict | None]]:
+    """Statements sent to the database, with their parameters"""
+    sent = []
+    for method in ("fetch", "fetchrow", "execute"):
+        def record(self, stmt, params=None, *args, _send=getattr(Connection, method), **kwargs):
+            sent.append((stmt, params))
+            return _send(self, stmt, params, *args, **kwargs)
+
+        monkeypatch.setattr(Connection, method, record)
+
+    db.post_cache.clear()
+    monkeypatch.setattr(db, "post_quota", PostQuota(max_users=0, window=24 * 60 * 60))
+    monkeypatch.setattr(db, "vote_store", VoteStore(window=0))
+    return sent
+
+
+def test_every_database_function_is_classified():
+    functions = {
+        name for name, function in vars(db).items()
+        if inspect.iscoroutinefunction(function) and function.__module__ == "db" and not name.startswith("_")
+    }
+    checked = {name.partition("[")[0] for name in HOT_PATH}
+    assert functions - checked - NOT_CHECKED == set(), "add new functions to HOT_PATH or NOT_CHECKED"
+    assert (checked | NOT_CHECKED) - functions == set()
+
+
+@pytest.mark.parametrize("name", HOT_PATH)
+def test_no_sequential_scans(name, run, seeded, statements, monkeypatch):
+    if name == "get_recent_votes":
+        # Loads votes of recent posts only when they are kept in memory
+        monkeypatch.setattr(db, "vote_store", VoteStore(window=db.VOTE_STORE_WINDOW))
+
+    run(HOT_PATH[name]())
+    sent = list(statements)
+    assert sent, f"{name} sent no statements, caches answered it"
+
+    monkeypatch.undo()
+    for stmt, params in sent:
+        plan = "\n".join(row[0] for row in run(db.backend.fetch("EXPLAIN " + stmt, params)))
+        scanned = re.findall(r"Seq Scan on (\w+)", plan)
+        # Partitions of months to come are empty, reading them costs nothing
+        sizes = run(db.backend.fetch(
+            "SELECT relname, pg_relation_size(oid) FROM pg_class WHERE relname = ANY(%(names)s);", {"names": scanned}
+        ))
+        assert not [name for name, size in sizes if size > 0], f"Sequential scan in plan of:\n{stmt}\n{plan}"
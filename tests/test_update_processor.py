@@ -0,0 +1,37 @@
+import asyncio
+
+from update_processor import KeyedUpdateProcessor
+
+
+def test_work_of_one_key_runs_in_order():
+    copies = {("popular", 7): 1, ("new", 1): 1, ("new", 2): 2}
+    log = []
+
+    async def key(update):
+        # Copies of a post resolve to the post, like votes clicked in the popular channel
+        await asyncio.sleep(0)
+        return copies[update]
+
+    async def handle(name: str, delay: float):
+        log.append(f"{name} started")
+        await asyncio.sleep(delay)
+        log.append(f"{name} done")
+
+    async def main():
+        processor = KeyedUpdateProcessor(max_concurrent_updates=10, key=key)
+        await asyncio.gather(
+            processor.do_process_update(("new", 1), handle("vote", 0.05)),
+            processor.do_process_update(("popular", 7), handle("vote on copy", 0)),
+            processor.do_process_update(("new", 2), handle("other post", 0)),
+        )
+        # Not an update, e.g. an assembled album, queued behind the work of its key
+        first = asyncio.create_task(processor.do_process_update(("new", 1), handle("vote again", 0.05)))
+        await asyncio.sleep(0.01)
+        await processor.run_keyed(1, handle("album", 0))
+        await first
+
+    asyncio.run(main())
+
+    assert log.index("vote done") < log.index("vote on copy started")
+    assert log.index("other post done") < log.index("vote done")
+    assert log.index("vote again done") < log.index("album started")
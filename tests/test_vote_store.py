@@ -0,0 +1,41 @@
+import asyncio
+
+import db
+from cache import VoteStore
+from models import ButtonValues
+
+
+def test_concurrent_callers_load_votes_once(run, monkeypatch):
+    run(db.add_post(9001, 1, 9002))
+    run(db.set_user_vote(9001, 10, ButtonValues.POSITIVE_VOTE))
+    # As after a restart: neither the post nor its votes are in memory
+    db.post_cache.clear()
+    monkeypatch.setattr(db, "vote_store", VoteStore(window=db.VOTE_STORE_WINDOW))
+
+    async def load_concurrently():
+        # The second caller arrives while the first one looks the post up
+        return await asyncio.gather(db.get_recent_votes(9001), db.get_recent_votes(9001))
+
+    first, second = run(load_concurrently())
+
+    assert db.vote_store.loads == 1
+    assert first is not None and first.get(10) == 1
+    # Reads votes from the database until the load finishes
+    assert second is None
+    assert not db.vote_store.is_loading(9001)
+
+
+def test_warm_up_keeps_restored_votes(run, monkeypatch):
+    run(db.add_post(9101, 1, 9102))
+    run(db.add_post(9103, 1, 9104))
+    run(db.set_user_vote(9101, 10, ButtonValues.POSITIVE_VOTE))
+    run(db.set_user_vote(9103, 10, ButtonValues.NEGATIVE_VOTE))
+    monkeypatch.setattr(db, "vote_store", VoteStore(window=db.VOTE_STORE_WINDOW))
+    # As restored from the snapshot, with a vote the query would not return
+    post = run(db.get_post(9101))
+    db.vote_store.add(9101, db.post_timestamp(post), [(10, 1), (11, -1)])
+
+    run(db.warm_up(1))
+
+    assert dict(db.vote_store.get(9101).votes) == {10: 1, 11: -1}
+    assert dict(db.vote_store.get(9103).votes) == {10: -1}